@@ -0,0 +1,347 @@
+from collections import namedtuple
+import ctypes
+import socket
+import struct
+import time
+
+from knockutil import PORT_START, PORT_END
+import metrics
+
+
+# Capture backends
+#
+# The listener reads knocks through a capture backend:
+#    item = backend.tail()    # next captured item, or None on timeout
+#    knock = backend.match(item)
+# where knock is a KnockEvent, or None if the item isn't a knock. The source
+# IP is an IPv4 or IPv6 address string.
+#
+# tcpdump.Tcpdump is the backend that parses tcpdump output. AfPacket below
+# captures in-process on an AF_PACKET socket.
+#
+# For use with an event loop, async_fd() puts the backend in non-blocking
+# mode and returns the fd to wait on; read_available() then returns the
+# items that can be read without blocking. Backends that can't do this
+# return None from async_fd() and are read with tail() in a thread. (For
+# tcpdump in file mode, the fd is the inotify fd watching the file.)
+#
+# set_blocklist() gives the backend the source IPs the listener is ignoring,
+# for backends that can drop them before they reach the listener.
+KnockEvent = namedtuple('KnockEvent', 'ts saddr dport len')
+
+
+class Capture:
+    def tail(self):
+        raise NotImplementedError
+
+    def match(self, item):
+        raise NotImplementedError
+
+    def async_fd(self):
+        return None
+
+    def read_available(self):
+        raise NotImplementedError
+
+    def set_blocklist(self, source_ips):
+        pass
+
+    def close(self):
+        pass
+
+
+ETH_P_ALL = 0x0003
+ETH_P_IP = 0x0800
+ETH_P_IPV6 = 0x86dd
+PACKET_OUTGOING = 4
+SO_ATTACH_FILTER = getattr(socket, 'SO_ATTACH_FILTER', 26)
+SO_TIMESTAMPNS = getattr(socket, 'SO_TIMESTAMPNS', 35)
+SCM_TIMESTAMPNS = SO_TIMESTAMPNS
+IPPROTO_UDP = 17
+# Largest IP datagram accepted, by the length in the IP header. Both
+# backends filter on the header field rather than the captured length,
+# which includes the link header (tcpdump's 'less') and any Ethernet
+# padding, so they accept the same packets on any interface. IPv6 has a 20
+# byte larger header.
+IP6_HDR_LEN = 40
+MAX_IP_LEN = 51
+MAX_IP6_LEN = 71
+SNAPLEN = 83
+# Most blocked sources put in the filter. Jump offsets are 8 bits, so the
+# filter must stay under 256 instructions.
+MAX_FILTER_BLOCKLIST = 200
+
+# Classic BPF opcodes (linux/filter.h)
+BPF_LD, BPF_LDX, BPF_JMP, BPF_RET = 0x00, 0x01, 0x05, 0x06
+BPF_W, BPF_H, BPF_B = 0x00, 0x08, 0x10
+BPF_ABS, BPF_IND, BPF_LEN, BPF_MSH = 0x20, 0x40, 0x80, 0xa0
+BPF_JEQ, BPF_JGT, BPF_JGE, BPF_JSET = 0x10, 0x20, 0x30, 0x40
+BPF_K = 0x00
+SKF_AD_OFF = -0x1000
+SKF_AD_PROTOCOL = 0
+SKF_AD_PKTTYPE = 4
+
+
+def bpf_stmt(code, k):
+    return (code, 0, 0, k & 0xffffffff)
+
+
+def bpf_jump(code, k, jt, jf):
+    return (code, jt, jf, k & 0xffffffff)
+
+
+# Build the BPF equivalent of the tcpdump filter:
+#    inbound and udp and dst portrange PORT_START-PORT_END and not port 53
+#    and ((ip and ip[2:2] <= 51 and not src host <blocked> ...)
+#         or (ip6 and ip6[4:2] <= 31))
+# The socket is SOCK_DGRAM, so offsets are from the start of the IP header.
+# IPv6 packets with extension headers are dropped, knocks don't have any.
+# Blocked IPv6 sources aren't in the filter, the listener drops them. The
+# IPv6 part comes first, so its jumps to 'drop' span the blocklist.
+def bpf_program(blocked=()):
+    # (label, instruction) - jumps reference labels and are resolved below
+    prog = [
+        (None, bpf_stmt(BPF_LD | BPF_W | BPF_ABS, SKF_AD_OFF + SKF_AD_PKTTYPE)),
+        (None, ('jeq', PACKET_OUTGOING, 'drop', None)),
+        (None, bpf_stmt(BPF_LD | BPF_H | BPF_ABS, SKF_AD_OFF + SKF_AD_PROTOCOL)),
+        (None, ('jeq', ETH_P_IP, 'ip4', None)),
+        (None, ('jeq', ETH_P_IPV6, None, 'drop')),
+        # ip6 next header
+        (None, bpf_stmt(BPF_LD | BPF_B | BPF_ABS, 6)),
+        (None, ('jeq', IPPROTO_UDP, None, 'drop')),
+        # ip6 payload length
+        (None, bpf_stmt(BPF_LD | BPF_H | BPF_ABS, 4)),
+        (None, ('jgt', MAX_IP6_LEN - IP6_HDR_LEN, 'drop', None)),
+        # udp source and dest port
+        (None, bpf_stmt(BPF_LD | BPF_H | BPF_ABS, 40)),
+        (None, ('jeq', 53, 'drop', None)),
+        (None, bpf_stmt(BPF_LD | BPF_H | BPF_ABS, 42)),
+        (None, ('jge', PORT_START, None, 'drop')),
+        (None, ('jgt', PORT_END, 'drop', None)),
+        (None, bpf_stmt(BPF_RET | BPF_K, SNAPLEN)),
+        # ip proto
+        ('ip4', bpf_stmt(BPF_LD | BPF_B | BPF_ABS, 9)),
+        (None, ('jeq', IPPROTO_UDP, None, 'drop')),
+        # only first fragments carry the udp header
+        (None, bpf_stmt(BPF_LD | BPF_H | BPF_ABS, 6)),
+        (None, ('jset', 0x1fff, 'drop', None)),
+        # ip total length
+        (None, bpf_stmt(BPF_LD | BPF_H | BPF_ABS, 2)),
+        (None, ('jgt', MAX_IP_LEN, 'drop', None)),
+        # X = ip header length
+        (None, bpf_stmt(BPF_LDX | BPF_B | BPF_MSH, 0)),
+        # udp source port
+        (None, bpf_stmt(BPF_LD | BPF_H | BPF_IND, 0)),
+        (None, ('jeq', 53, 'drop', None)),
+        # udp dest port
+        (None, bpf_stmt(BPF_LD | BPF_H | BPF_IND, 2)),
+        (None, ('jge', PORT_START, None, 'drop')),
+        (None, ('jgt', PORT_END, 'drop', None)),
+    ]
+    if blocked:
+        # ip source address
+        prog.append((None, bpf_stmt(BPF_LD | BPF_W | BPF_ABS, 12)))
+        for ip in blocked:
+            if ':' in ip:
+                continue
+            prog.append((None, ('jeq', struct.unpack('!I', socket.inet_aton(ip))[0], 'drop', None)))
+    prog += [
+        (None, bpf_stmt(BPF_RET | BPF_K, SNAPLEN)),
+        ('drop', bpf_stmt(BPF_RET | BPF_K, 0)),
+    ]
+
+    labels = {label: i for i, (label, _) in enumerate(prog) if label}
+    ops = {'jeq': BPF_JEQ, 'jgt': BPF_JGT, 'jge': BPF_JGE, 'jset': BPF_JSET}
+    instrs = []
+    for i, (_, ins) in enumerate(prog):
+        if isinstance(ins[0], str):
+            op, k, jt, jf = ins
+            # jump offsets are relative to the next instruction
+            jt = labels[jt] - i - 1 if jt else 0
+            jf = labels[jf] - i - 1 if jf else 0
+            ins = bpf_jump(BPF_JMP | ops[op] | BPF_K, k, jt, jf)
+        instrs.append(ins)
+
+    return instrs
+
+
+def attach_filter(sock, instrs):
+    filters = b''.join(struct.pack('HBBI', *ins) for ins in instrs)
+    buf = ctypes.create_string_buffer(filters)
+    # struct sock_fprog { unsigned short len; struct sock_filter *filter; }
+    fprog = struct.pack('HL', len(instrs), ctypes.addressof(buf))
+    sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
+
+
+# Decode an IPv4/UDP or IPv6/UDP datagram into a knock. Returns None for
+# anything that isn't a well-formed knock, so it's safe to feed unfiltered
+# data.
+def decode_packet(data, ts):
+    if len(data) < 20:
+        return None
+    version = data[0] >> 4
+    if version == 4:
+        udp = (data[0] & 0x0f) * 4
+        if udp < 20 or data[9] != IPPROTO_UDP or len(data) < udp + 8:
+            return None
+        saddr = socket.inet_ntoa(data[12:16])
+    elif version == 6:
+        # no extension headers
+        udp = 40
+        if data[6] != IPPROTO_UDP or len(data) < udp + 8:
+            return None
+        saddr = socket.inet_ntop(socket.AF_INET6, data[8:24])
+    else:
+        return None
+    sport, dport, udp_len = struct.unpack_from('!HHH', data, udp)
+    if udp_len < 8 or sport == 53 or not (PORT_START <= dport <= PORT_END):
+        return None
+
+    return KnockEvent(int(ts), saddr, dport, udp_len - 8)
+
+
+# pcap file magic numbers: (byte order, nanosecond timestamps)
+PCAP_MAGIC = {b'\xd4\xc3\xb2\xa1': ('<', False),
+              b'\xa1\xb2\xc3\xd4': ('>', False),
+              b'\x4d\x3c\xb2\xa1': ('<', True),
+              b'\xa1\xb2\x3c\x4d': ('>', True)}
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_LINUX_SLL2 = 276
+
+
+# Address families in LINKTYPE_NULL headers: AF_INET, and AF_INET6 on
+# the BSDs, macOS and Linux
+NULL_AF_IP = {2, 10, 24, 28, 30}
+
+
+# Strip the link layer header. Returns the IPv4 or IPv6 packet, or None for
+# other protocols and for outgoing packets where the link type records
+# direction.
+def link_payload(linktype, data):
+    if linktype == LINKTYPE_ETHERNET:
+        off = 12
+        # skip VLAN tags
+        while data[off:off+2] == b'\x81\x00':
+            off += 4
+        return data[off+2:] if data[off:off+2] in (b'\x08\x00', b'\x86\xdd') else None
+    elif linktype == LINKTYPE_LINUX_SLL:
+        pkttype, proto = struct.unpack_from('!H12xH', data)
+        return data[16:] if proto in (ETH_P_IP, ETH_P_IPV6) and pkttype != PACKET_OUTGOING else None
+    elif linktype == LINKTYPE_LINUX_SLL2:
+        proto, pkttype = struct.unpack_from('!H8xB', data)
+        return data[20:] if proto in (ETH_P_IP, ETH_P_IPV6) and pkttype != PACKET_OUTGOING else None
+    elif linktype == LINKTYPE_NULL:
+        # address family, in the byte order of the capturing host
+        af = int.from_bytes(data[:4], 'little')
+        if af > 0xffff:
+            af = int.from_bytes(data[:4], 'big')
+        return data[4:] if af in NULL_AF_IP else None
+    elif linktype == LINKTYPE_RAW:
+        return data
+    return None
+
+
+# Read a pcap (not pcapng) file. Yields (timestamp, IP packet).
+def read_pcap(f):
+    hdr = f.read(24)
+    if hdr[:4] not in PCAP_MAGIC:
+        raise ValueError("Not a pcap file. (pcapng is not supported.)")
+    endian, nano = PCAP_MAGIC[hdr[:4]]
+    linktype = struct.unpack(endian + 'I', hdr[20:24])[0] & 0xffff
+    rec_hdr = struct.Struct(endian + 'IIII')
+
+    while True:
+        rec = f.read(rec_hdr.size)
+        if len(rec) < rec_hdr.size:
+            return
+        sec, frac, incl_len, orig_len = rec_hdr.unpack(rec)
+        data = f.read(incl_len)
+        try:
+            pkt = link_payload(linktype, data)
+        except struct.error:
+            continue
+        if pkt is not None:
+            yield sec + frac / (1e9 if nano else 1e6), pkt
+
+
+class AfPacket(Capture):
+    def __init__(self, cfg, logger, timeout=2):
+        self.logger = logger
+        self.timeout = timeout
+        self.sock = socket.socket(socket.AF_PACKET, socket.SOCK_DGRAM, socket.htons(ETH_P_ALL))
+        attach_filter(self.sock, bpf_program())
+        self.sock.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+        self.drain()
+        self.sock.settimeout(None if timeout == 0 else timeout)
+        self.ancbufsize = socket.CMSG_SPACE(struct.calcsize('ll'))
+        self.logger.debug("Capturing knocks on AF_PACKET socket")
+
+
+    def drain(self):
+        # Packets received between socket() and attaching the filter
+        # were not filtered, so throw them away.
+        self.sock.setblocking(False)
+        try:
+            while True:
+                self.sock.recv(SNAPLEN)
+        except BlockingIOError:
+            pass
+
+
+    def tail(self):
+        try:
+            data, ancdata, flags, addr = self.sock.recvmsg(SNAPLEN, self.ancbufsize)
+        except socket.timeout:
+            return None
+        return data, ancdata
+
+
+    def async_fd(self):
+        self.sock.setblocking(False)
+        return self.sock.fileno()
+
+
+    def read_available(self):
+        items = []
+        while True:
+            try:
+                data, ancdata, flags, addr = self.sock.recvmsg(SNAPLEN, self.ancbufsize)
+            except BlockingIOError:
+                return items
+            items.append((data, ancdata))
+
+
+    def match(self, item):
+        if not item:
+            return None
+        data, ancdata = item
+        ts = None
+        for level, type, cdata in ancdata:
+            if level == socket.SOL_SOCKET and type == SCM_TIMESTAMPNS:
+                sec, nsec = struct.unpack('ll', cdata[:struct.calcsize('ll')])
+                ts = sec + nsec / 1e9
+        if ts is None:
+            ts = time.time()
+        metrics.packets_captured.value += 1
+        knock = decode_packet(data, ts)
+        if knock is None:
+            metrics.parse_misses.value += 1
+        else:
+            metrics.packets_parsed.value += 1
+        return knock
+
+
+    def set_blocklist(self, source_ips):
+        # Replacing the filter is atomic, so no packets get through unfiltered.
+        # Past the filter's limit the newest blocks are kept; the listener
+        # still drops the rest.
+        blocked = source_ips[-MAX_FILTER_BLOCKLIST:]
+        attach_filter(self.sock, bpf_program(blocked))
+        self.logger.debug(f"Capture filter blocklist: {len(blocked)} sources")
+
+
+    def close(self):
+        self.sock.close()
@@ -0,0 +1,113 @@
+import os
+import signal
+
+import inotify
+import knocktrack
+
+
+# Reloads client configs while the listener runs, on SIGHUP or when inotify
+# reports a change in the client_cfg directory.
+#
+# Only files that changed are re-read (see Config.reload_clients), and only
+# their clients are touched:
+#   - new file: a new KnockTrack is added to the index
+#   - deleted file: the client's KnockTrack and sessions are removed. Rules
+#     it already opened stay until they expire.
+#   - changed file: if the secret, pin, knock count and skew are the same,
+#     the new config (ports, open duration, name) is swapped in and the
+#     client's sessions are kept; otherwise the client is replaced.
+#
+# poll() is called by the Housekeeper once per second, so reloads happen
+# between knocks and need no locking.
+class ClientReloader:
+    watch_mask = inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO | inotify.IN_MOVED_FROM | inotify.IN_DELETE
+
+    def __init__(self, cfg, logger, kindex, fw, clock):
+        self.cfg = cfg
+        self.logger = logger
+        self.kindex = kindex
+        self.fw = fw
+        self.clock = clock
+        self.requested = False
+        # ktracks: { path: KnockTrack, ... }
+        by_clicfg = {id(kt.clicfg): kt for kt in kindex.clients}
+        self.ktracks = {f: by_clicfg[id(c)] for f, (key, c) in cfg.client_files.items()
+                        if c and id(c) in by_clicfg}
+
+        self.client_dir = os.path.realpath(cfg.listener.client_cfg)
+        self.inotify = None
+        try:
+            self.inotify = inotify.Inotify()
+            self.inotify.add_watch(self.client_dir, self.watch_mask)
+        except OSError as e:
+            logger.warning(f"Can't watch {self.client_dir} for changes ({e}). " + \
+                           "Send SIGHUP to reload client configs.")
+            if self.inotify:
+                self.inotify.close()
+            self.inotify = None
+
+
+    def install_signal_handler(self):
+        signal.signal(signal.SIGHUP, lambda signum, frame: self.request())
+
+
+    def request(self):
+        self.requested = True
+
+
+    def poll(self):
+        if self.requested:
+            self.requested = False
+            self.logger.info("SIGHUP received, reloading client configs")
+            self.reload()
+            # the full check covers anything inotify has queued
+            if self.inotify:
+                self.inotify.read()
+            return
+
+        if not self.inotify:
+            return
+        events = self.inotify.read()
+        if not events:
+            return
+        if any(mask & inotify.IN_Q_OVERFLOW for wd, mask, cookie, name in events):
+            self.reload()
+            return
+        paths = {os.path.join(self.client_dir, name) for wd, mask, cookie, name in events
+                 if name.endswith('.toml')}
+        if paths:
+            self.reload(paths)
+
+
+    def reload(self, paths=None):
+        changes = self.cfg.reload_clients(self.logger, paths)
+        epoch = int(self.clock.time())
+        for f, (old, new) in changes.items():
+            kt = self.ktracks.pop(f, None)
+            if kt and new and same_totp(old, new):
+                self.logger.info(f"Updating client '{new.name}'")
+                kt.clicfg = new
+                self.ktracks[f] = kt
+                continue
+
+            if kt:
+                self.logger.info(f"Removing client '{old.name}'")
+                self.kindex.remove_client(kt)
+            if new:
+                self.logger.info(f"Adding client '{new.name}'")
+                kt = knocktrack.KnockTrack(self.cfg, new, self.logger, self.fw, self.clock,
+                                           self.kindex.sessions)
+                self.kindex.add_client(kt, epoch)
+                self.ktracks[f] = kt
+        return changes
+
+
+    def close(self):
+        if self.inotify:
+            self.inotify.close()
+
+
+# True if a client's knock sequences are the same under both configs
+def same_totp(old, new):
+    return (old.secret, old.pin, old.knock_cnt, old.totp_skew) == \
+           (new.secret, new.pin, new.knock_cnt, new.totp_skew)
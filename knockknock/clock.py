@@ -0,0 +1,23 @@
+import time
+
+
+# Source of the current time for the listener. Everything that needs "now"
+# (totp windows, session and rule expiry) asks a clock instead of calling
+# time.time() directly, so replay can run on packet time.
+class Clock:
+    def time(self):
+        return time.time()
+
+
+# Clock that only moves when told to, e.g., to the timestamp of each packet
+# being replayed.
+class VirtualClock(Clock):
+    def __init__(self, start=0):
+        self.now = start
+
+    def time(self):
+        return self.now
+
+    def advance_to(self, ts):
+        if ts > self.now:
+            self.now = ts
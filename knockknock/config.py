@@ -1,5 +1,6 @@
 from collections import namedtuple
 import glob
+import json
 #import log
 import os
 #import sys
@@ -7,16 +8,48 @@ import os
 import tomllib
 
 
+# One record type for every client config
+Client = namedtuple('client', 'secret pin name ports knock_cnt open_duration totp_skew')
+
+# Bump when the cached form of a client changes
+CACHE_FORMAT = 1
+
+
 class Config():
 
     maincfg = {
         'listener': {
             'knock_expiration': 10,
+            'event_loop': "blocking",
             'pidfile': "/var/run/knock.pid",
             'client_cfg': "/etc/knockknock/conf.d",
+            'client_cache': "/var/cache/knockknock/clients.cache",
             'failopen': True,
             'failopen_ports': ["22/tcp"],
             'failopen_min_time': 60,
+            'max_sessions': 65536,
+            'max_sessions_per_source': 16,
+            'rate_limit': 2,
+            'rate_limit_burst': 24,
+            'block_time': 60,
+            'workers': 0,
+            'state_dir': "/var/lib/knockknock",
+        },
+        'firewall': {
+            'backend': "ufw",
+            'iptables_cmd': "/usr/sbin/iptables",
+            'iptables_restore_cmd': "/usr/sbin/iptables-restore",
+            'chain': "knockknock",
+            'ipset_cmd': "/usr/sbin/ipset",
+            'set_prefix': "knock",
+            'reconcile_interval': 300,
+            'max_concurrent': 4,
+            'dry_run': False,
+        },
+        'metrics': {
+            'listen': "",
+            'snapshot_file': "",
+            'snapshot_interval': 60,
         },
         'ufw': {
             'ufw_cmd': "/usr/sbin/ufw",
@@ -25,19 +58,24 @@ class Config():
         'logging': {
             'log_level': "info",
             'syslog': False,
+            'queued': True,
         },
         'tcpdump': {
+            'backend': "tcpdump",
+            'capture': "pipe",
             'log_file': "/tmp/tcpdump-knock.out",
             'cmd': "/usr/bin/tcpdump",
+            'truncate_size': 100,
         },
     }
     clicfg = {
         'secret': None,
-        'pin': None,
+        'pin': "",
         'name': None,
         'ports': ["22/tcp"],
         'knock_cnt': 3,
         'open_duration': 10,
+        'totp_skew': 0,
     }
 
 
@@ -62,6 +100,8 @@ class Config():
     def _process_global_config(self):
         self.listener = self._process_listener_section()
         self.logging = self._process_main_section('logging')
+        self.firewall = self._process_main_section('firewall')
+        self.metrics = self._process_main_section('metrics')
         self.ufw = self._process_main_section('ufw')
         self.tcpdump = self._process_main_section('tcpdump')
 
@@ -93,43 +133,166 @@ class Config():
         return listener._replace(failopen_ports=new_list)
 
 
-    def _process_client_configs(self):
+    def _client_files(self):
         loc = os.path.realpath(self.listener.client_cfg + '/' + '*.toml')
-        client_files = glob.glob(loc)
-
-        for f in client_files:
-
-            c = self._load_config(f)
-            default = self.clicfg
-
-            if c:
-                # Set defaults for undefined configs
-                if not c.get('name'):
-                    c['name'] = os.path.basename(os.path.splitext(f)[0])
-
-                for k, v in default.items():
-                    if k not in c:
-                        if v is not None:
-                            c[k] = v
-
-                if not (1 <= c['knock_cnt'] <= 8):
-                    self.logger.error(f"Invalid client config for '{c['name']}'. " + \
-                                       "knock_count out of range. Skipping client.")
-                    continue
-
-                ports = []
-                for pp in c.get('ports'):
-                    # Entry can be port, 22, or port/proto, e.g., 22/tcp
-                    # We want to convert this to (22, None) or (22, tcp)
-                    l = str(pp).split('/')
-                    l[0] = int(l[0])
-                    if len(l) == 1:
-                        l.append(None)
-                    ports.append(l)
-
-                # overwrite ports from ["22/tcp", "53"] to be list of 
-                # lists, e.g., [[22,'tcp'], [53,None]]
-                c['ports'] = ports
-                # self.clients.append(c)
-                Obj = namedtuple('client', ' '.join(c.keys()))
-                self.clients.append(Obj(**c))
+        return glob.glob(loc)
+
+
+    def _process_client_configs(self):
+        # client_files: { path: (stat_key, client or None if invalid), ... }
+        # Files whose stat_key matches the cache aren't parsed again.
+        cache = self._read_cache()
+        self.client_files = {}
+        for f in self._client_files():
+            key = self._stat_key(f)
+            cached = cache.get(f)
+            if cached and cached[0] == key:
+                self.client_files[f] = cached
+            else:
+                self.client_files[f] = (key, self._load_client(f))
+        self.clients = [c for key, c in self.client_files.values() if c]
+        self._write_cache(cache)
+
+
+    # The cache holds the validated configs of the valid client files, as
+    # { path: [mtime_ns, size, ino, [client fields]], ... }, so a restart
+    # only has to stat the client files, not parse them. It holds the
+    # client secrets, so it's only readable by the owner.
+    def _read_cache(self):
+        path = self.listener.client_cache
+        if not path:
+            return {}
+        try:
+            with open(path, 'rb') as f:
+                data = json.loads(f.read())
+            if data.get('format') != CACHE_FORMAT:
+                return {}
+            return {f: (tuple(entry[:3]), Client(*entry[3]))
+                    for f, entry in data['files'].items()}
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError, TypeError, KeyError, AttributeError) as e:
+            self.logger.warning(f"Ignoring client config cache {path}: {e}")
+            return {}
+
+
+    def _write_cache(self, cache):
+        # Only rewritten if something changed since it was read
+        path = self.listener.client_cache
+        files = {f: entry for f, entry in self.client_files.items() if entry[1]}
+        if not path or files == cache:
+            return
+        data = {'format': CACHE_FORMAT,
+                'files': {f: [*key, list(c)] for f, (key, c) in files.items()}}
+        tmp = f"{path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with open(fd, 'wb') as f:
+                f.write(json.dumps(data, separators=(',', ':')).encode())
+            os.replace(tmp, path)
+        except OSError as e:
+            self.logger.warning(f"Can't write client config cache {path}: {e}")
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+
+
+    @staticmethod
+    def _stat_key(f):
+        # Changes when the file is rewritten or replaced. None if it's gone.
+        try:
+            st = os.stat(f)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+    def _load_client(self, f):
+        c = self._load_config(f)
+        default = self.clicfg
+
+        if not c:
+            return None
+
+        # Set defaults for undefined configs
+        if not c.get('name'):
+            c['name'] = os.path.basename(os.path.splitext(f)[0])
+
+        for k, v in default.items():
+            if k not in c:
+                if v is not None:
+                    c[k] = v
+
+        if not (1 <= c['knock_cnt'] <= 8):
+            self.logger.error(f"Invalid client config for '{c['name']}'. " + \
+                               "knock_count out of range. Skipping client.")
+            return None
+
+        if not (0 <= c['totp_skew'] <= 10):
+            self.logger.error(f"Invalid client config for '{c['name']}'. " + \
+                               "totp_skew out of range. Skipping client.")
+            return None
+
+        if not c.get('secret'):
+            self.logger.error(f"Invalid client config for '{c['name']}'. " + \
+                               "No secret. Skipping client.")
+            return None
+
+        unknown = set(c) - set(Client._fields)
+        if unknown:
+            self.logger.warning(f"Ignoring unknown settings {sorted(unknown)} in " + \
+                                f"client config for '{c['name']}'.")
+
+        ports = []
+        for pp in c.get('ports'):
+            # Entry can be port, 22, or port/proto, e.g., 22/tcp
+            # We want to convert this to (22, None) or (22, tcp)
+            l = str(pp).split('/')
+            l[0] = int(l[0])
+            if len(l) == 1:
+                l.append(None)
+            ports.append(l)
+
+        # overwrite ports from ["22/tcp", "53"] to be list of 
+        # lists, e.g., [[22,'tcp'], [53,None]]
+        c['ports'] = ports
+        return Client(*(c[k] for k in Client._fields))
+
+
+    def reload_clients(self, logger, paths=None):
+        # Re-read the client files added, changed or removed since they were
+        # last read. paths limits the check to those files (e.g., from
+        # inotify), otherwise the whole directory is checked.
+        # Returns { path: (old client, new client), ... } for the clients that
+        # changed, with None for a client that didn't exist or isn't valid.
+        self.logger = logger
+        if paths is None:
+            paths = set(self.client_files) | set(self._client_files())
+
+        changes = {}
+        for f in paths:
+            key = self._stat_key(f)
+            old_key, old = self.client_files.get(f, (None, None))
+            if key == old_key:
+                continue
+
+            new = None
+            if key is None:
+                del self.client_files[f]
+            else:
+                try:
+                    new = self._load_client(f)
+                except (OSError, ValueError) as e:
+                    # tomllib.TOMLDecodeError is a ValueError
+                    logger.error(f"Error loading client config {f}: {e}")
+                self.client_files[f] = (key, new)
+
+            if old or new:
+                changes[f] = (old, new)
+
+        if changes:
+            self.clients = [c for key, c in self.client_files.values() if c]
+        self.logger = None
+        return changes
@@ -1,17 +1,55 @@
-
+import asyncio
+from collections import namedtuple
+from contextlib import contextmanager
+import heapq
+import itertools
 import re
+import shlex
 import subprocess
 import time
 
+import clock as kclock
+import metrics
 
-class Firewall:
-    def __init__(self, cfg, logger):
+
+# A firewall rule added by knock.
+#   kind   - 'allow' (opened by a knock) or 'fail' (failopen)
+#   src_ip - source IP, or 'anywhere' for failopen rules
+#   proto  - 'tcp', 'udp' or None for both
+#   id     - client name for allow rules, None for failopen rules
+#   expire - epoch after which the rule is removed
+Rule = namedtuple('Rule', 'kind src_ip proto port id expire')
+
+
+# Rules are unique per source/proto/port. ufw reports 'Anywhere'.
+def rule_key(rule):
+    return (rule.src_ip.lower(), rule.proto, rule.port)
+
+
+def mk_comment(rule):
+    if rule.kind == 'allow':
+        return f"knock type:allow id:{rule.id} expire:{rule.expire}"
+    else:
+        return f"knock type:fail expire:{rule.expire}"
+
+
+# Firewall backends turn a batch of rule additions and deletions into the
+# commands that apply them, and parse the rules knock has added out of the
+# firewall's status output. The commands are run by Firewall.
+#
+# commands: [ (argv, stdin), ... ]   stdin is bytes or None
+#
+# command_groups() splits a batch's commands into groups that touch
+# different rules: the commands in a group run in order, the groups may run
+# at the same time (see AsyncFirewall).
+#   groups: [ commands, ... ]
+class UfwBackend:
+    # ufw handles IPv6 sources itself (IPV6=yes in /etc/default/ufw)
+    ipv6 = True
+
+    def __init__(self, cfg, logger, clock):
         self.logger = logger
-        self.base_cmd = [cfg.ufw.ufw_cmd]
-        if cfg.ufw.use_sudo:
-            self.base_cmd = ['sudo'] + self.base_cmd
-        self.rules_present = True
-        self.cfg = cfg
+        self.ufw_cmd = cfg.ufw.ufw_cmd
 
         # groups: port/proto, action, from, comment
         self.re_rule = re.compile(r'^(\d+(?:/\w+)?)\s+(\S+)\s+(\S+)\s+#\s*knock\s+(.*)$')
@@ -22,21 +60,12 @@ class Firewall:
         self.re_cmt_fopen = re.compile(r'^\s*type:\s*(\w+)\s+expire:\s*(\d+).*$')
 
 
-    def mk_allow_comment(self, id, expire):
-        return f"knock type:allow id:{id} expire:{expire}"
-    
-
-    def mk_failopen_comment(self):
-        expire = int(time.time()) + int(self.cfg.listener.failopen_min_time)
-        return f"knock type:fail expire:{expire}"
-
-
     def mk_allow_rule(self, src_ip, proto, dest_port, comment):
         if proto:
-            return ["allow", "from", src_ip, "proto", proto, "to", "any", 
+            return ["allow", "from", src_ip, "proto", proto, "to", "any",
                     "port", f"{dest_port}", "comment", comment]
         else:
-            return ["allow", "from", src_ip, "to", "any", 
+            return ["allow", "from", src_ip, "to", "any",
                     "port", f"{dest_port}", "comment", comment]
 
 
@@ -62,7 +91,44 @@ class Firewall:
                         "to", "any", "port", f"{dest_port}"]
 
 
-    def parse_ufw_rules(self, rule_output):
+    def setup(self, run):
+        pass
+
+
+    def needs_delete(self, rule):
+        return True
+
+
+    def status_command(self):
+        return [self.ufw_cmd, 'status']
+
+
+    # ufw has no way to apply several changes at once, so this is still
+    # one ufw process per rule.
+    def commands(self, adds, deletes):
+        cmds = []
+        for r in deletes:
+            cmds.append(([self.ufw_cmd] + self.mk_delete_rule(r.src_ip, r.proto, r.port), None))
+        for r in adds:
+            if r.kind == 'allow':
+                args = self.mk_allow_rule(r.src_ip, r.proto, r.port, mk_comment(r))
+            else:
+                args = self.mk_failopen_rule(r.proto, r.port, mk_comment(r))
+            cmds.append(([self.ufw_cmd] + args, None))
+        return cmds
+
+
+    # one group per rule key, its delete before its add
+    def command_groups(self, adds, deletes):
+        by_key = {}
+        for r in deletes:
+            by_key.setdefault(rule_key(r), ([], []))[1].append(r)
+        for r in adds:
+            by_key.setdefault(rule_key(r), ([], []))[0].append(r)
+        return [self.commands(a, d) for a, d in by_key.values()]
+
+
+    def parse_rules(self, rule_output):
         allow_rules = []
         failopen_rules = []
         for line in rule_output.splitlines():
@@ -71,115 +137,636 @@ class Firewall:
                 continue
             l = m.group(1).split('/')
             proto = None if len(l) < 2 else l[1].lower()
-            rule = { 'port': int(l[0]),
-                     'proto': proto,
-                     'action': m.group(2).lower(),
-                     'from': m.group(3) }
+            port = int(l[0])
+            frm = m.group(3)
             comment_text = m.group(4)
 
             c = self.re_cmt_allow.match(comment_text)
             if c and c.group(1) == 'allow':
                 # allow rule
-                rule['id'] = c.group(2)  # id
-                rule['expire'] = c.group(3)  # expire
-                allow_rules.append(rule)
+                allow_rules.append(Rule('allow', frm, proto, port, c.group(2), int(c.group(3))))
             else:
                 c = self.re_cmt_fopen.match(comment_text)
                 if c and c.group(1) == 'fail':
-                    rule['expire'] = c.group(2)
-                    failopen_rules.append(rule)
+                    failopen_rules.append(Rule('fail', frm, proto, port, None, int(c.group(2))))
                 else:
-                    print("Error parsing comment: '{}'".format(comment_text))
+                    self.logger.error(f"Error parsing comment: '{comment_text}'")
 
         return allow_rules, failopen_rules
 
 
-    def get_active_rules(self):
-        rc, out, err = self.run_ufw(['status'])
+# Keeps knock's rules in a dedicated chain, jumped to from INPUT, and applies
+# each batch with iptables-restore --noflush: one transaction for the adds,
+# then one for the deletes. A -D for a rule that's no longer there (e.g.,
+# deleted by hand) fails its whole transaction, and mustn't take a client's
+# new rule with it. Rules that failed to delete are still in the firewall,
+# so the next reconcile puts them back in the table to expire again.
+class IptablesBackend:
+    # iptables only; a rule for an IPv6 source would fail the whole batch
+    ipv6 = False
+
+    def __init__(self, cfg, logger, clock):
+        self.logger = logger
+        self.iptables_cmd = cfg.firewall.iptables_cmd
+        self.restore_cmd = cfg.firewall.iptables_restore_cmd
+        self.chain = cfg.firewall.chain
+        self.re_comment = re.compile(r'^knock\s+type:(\w+)(?:\s+id:(\S+.*))?\s+expire:(\d+)')
+
+
+    # iptables-restore only understands double quotes
+    def quote_args(self, args):
+        return ' '.join(f'"{a}"' if ' ' in a else a for a in args)
+
+
+    def mk_rule_specs(self, rule):
+        # iptables needs a protocol to match on a port, so a rule without
+        # a protocol becomes a tcp and a udp rule
+        specs = []
+        for proto in [rule.proto] if rule.proto else ['tcp', 'udp']:
+            spec = []
+            if rule.src_ip.lower() != 'anywhere':
+                spec += ['-s', rule.src_ip]
+            spec += ['-p', proto, '-m', proto, '--dport', str(rule.port),
+                     '-m', 'comment', '--comment', mk_comment(rule), '-j', 'ACCEPT']
+            specs.append(spec)
+        return specs
+
+
+    def setup(self, run):
+        # Done with plain iptables because declaring the chain to
+        # iptables-restore would flush it. Creating the chain fails
+        # harmlessly if it already exists.
+        run([self.iptables_cmd, '-N', self.chain])
+        rc, out, err = run([self.iptables_cmd, '-C', 'INPUT', '-j', self.chain])
         if rc != 0:
-            print("Error running command '{cmd}'. Stderr: {err}".format(cmd=self.base_cmd, err=err))
-            return None
-    
-        allow_rules, failopen_rules = self.parse_ufw_rules(out)
-        if allow_rules == [] and failopen_rules == []:
-            self.rules_present = False
-        else:
-            self.rules_present = True
+            rc, out, err = run([self.iptables_cmd, '-I', 'INPUT', '1', '-j', self.chain])
+            if rc != 0:
+                self.logger.error(f"Error adding jump to chain '{self.chain}': '{err}'")
+
+
+    def needs_delete(self, rule):
+        return True
+
+
+    def status_command(self):
+        return [self.iptables_cmd, '-S', self.chain]
+
+
+    def restore_command(self, op, rules):
+        lines = ['*filter']
+        for r in rules:
+            for spec in self.mk_rule_specs(r):
+                lines.append(self.quote_args([op, self.chain] + spec))
+        lines.append('COMMIT')
+        script = '\n'.join(lines) + '\n'
+        return ([self.restore_cmd, '--noflush'], script.encode())
+
+
+    # Adding first is safe: the comment holds the expiration, so a refreshed
+    # rule's delete doesn't match its replacement.
+    def commands(self, adds, deletes):
+        cmds = []
+        if adds:
+            cmds.append(self.restore_command('-A', adds))
+        if deletes:
+            cmds.append(self.restore_command('-D', deletes))
+        return cmds
+
+
+    # the batch's transactions run in order
+    def command_groups(self, adds, deletes):
+        return [self.commands(adds, deletes)]
+
+
+    def parse_rules(self, rule_output):
+        allow_rules = []
+        failopen_rules = []
+        for line in rule_output.decode().splitlines():
+            args = shlex.split(line)
+            if len(args) < 2 or args[0] != '-A' or args[1] != self.chain:
+                continue
+            opts = {}
+            for i, a in enumerate(args[:-1]):
+                if a.startswith('-'):
+                    opts.setdefault(a, args[i+1])
+            c = self.re_comment.match(opts.get('--comment', ''))
+            if not c or '--dport' not in opts:
+                continue
+
+            src_ip = opts.get('-s', 'anywhere')
+            if src_ip.endswith('/32'):
+                src_ip = src_ip[:-3]
+            rule = Rule(c.group(1), src_ip, opts.get('-p'), int(opts['--dport']),
+                        c.group(2), int(c.group(3)))
+            if rule.kind == 'allow':
+                allow_rules.append(rule)
+            elif rule.kind == 'fail':
+                failopen_rules.append(rule)
 
         return allow_rules, failopen_rules
 
 
-    def remove_expired_rules(self):
-        current_epoch = int(time.time())
-        # record the nearest expiration that is not yet expired
-        # we'll use this to know when we need to check here again,
-        # but we'll check at least every 6 seconds
-        next_expiration = current_epoch + 6
-
-        # If we know there are no rules present, then just return
-        if not self.rules_present:
-            return next_expiration
-        
-        knock_rules, fail_rules = self.get_active_rules()
-
-        self.logger.debug("Check for expired firewall rules")
-
-        def delete_rule(expire, frm, proto, port):
-            nonlocal next_expiration
-            expire = int(expire)
-            if current_epoch > expire:
-                del_rule = self.mk_delete_rule(frm, proto, port)
-                rc, out, err = self.run_ufw(del_rule)
-                if rc:
-                    self.logger.error(f"Error deleting knock rule: '{err}'")
-                else:
-                    self.logger.info(f"Deleted firewall rule: {del_rule} " + \
-                                     f"expiration: {expire}, current time: {current_epoch}")
+# Keeps one ipset per (port, proto), each matched by a single rule in knock's
+# iptables chain. A knock adds the source IP to the port's set with a timeout
+# of open_duration, so the kernel matches it in O(1) however many clients are
+# open and removes it on time by itself; allow rules are never deleted.
+# Failopen entries are added without a timeout (they must outlive the
+# listener) and are deleted by Firewall like with the other backends.
+class IpsetBackend(IptablesBackend):
+    # 'anywhere', since hash:net sets can't hold a /0
+    failopen_nets = ['0.0.0.0/1', '128.0.0.0/1']
+
+    def __init__(self, cfg, logger, clock):
+        super().__init__(cfg, logger, clock)
+        self.clock = clock
+        self.ipset_cmd = cfg.firewall.ipset_cmd
+        self.set_prefix = cfg.firewall.set_prefix
+        self.known_sets = set()
+
+        # create the sets for all configured ports up front
+        self.ports = set()
+        for clicfg in cfg.clients:
+            for port, proto in clicfg.ports:
+                self.ports.add((int(port), proto))
+        for item in cfg.listener.failopen_ports:
+            if item:
+                self.ports.add((int(item[0]), item[1] if len(item) > 1 else None))
+
+        # groups: set name, net, timeout, comment
+        self.re_entry = re.compile(r'^add\s+(\S+)\s+(\S+)\s+timeout\s+(\d+)\s+comment\s+"(.*)"')
+
+
+    def set_name(self, port, proto):
+        return f"{self.set_prefix}-{port}-{proto}"
+
+
+    def mk_set_rule(self, name, port, proto):
+        return ['-p', proto, '-m', proto, '--dport', str(port),
+                '-m', 'set', '--match-set', name, 'src', '-j', 'ACCEPT']
+
+
+    def mk_create_set(self, name):
+        return f"create {name} hash:net family inet timeout 0 comment"
+
+
+    def mk_entries(self, rule):
+        # [ (set name, proto, net), ... ]
+        nets = self.failopen_nets if rule.src_ip.lower() == 'anywhere' else [rule.src_ip]
+        return [(self.set_name(rule.port, proto), proto, net)
+                for proto in ([rule.proto] if rule.proto else ['tcp', 'udp'])
+                for net in nets]
+
+
+    def setup(self, run):
+        super().setup(run)
+        for port, proto in sorted(self.ports, key=str):
+            for p in [proto] if proto else ['tcp', 'udp']:
+                name = self.set_name(port, p)
+                rc, out, err = run([self.ipset_cmd, '-exist'] + self.mk_create_set(name).split())
+                if rc != 0:
+                    self.logger.error(f"Error creating ipset '{name}': '{err}'")
+                    continue
+                spec = self.mk_set_rule(name, port, p)
+                rc, out, err = run([self.iptables_cmd, '-C', self.chain] + spec)
+                if rc != 0:
+                    run([self.iptables_cmd, '-A', self.chain] + spec)
+                self.known_sets.add(name)
+
+
+    def needs_delete(self, rule):
+        return rule.kind != 'allow'
+
+
+    def status_command(self):
+        return [self.ipset_cmd, 'save']
+
+
+    def commands(self, adds, deletes):
+        now = int(self.clock.time())
+        creates, lines, new_sets = [], [], []
+        for r in deletes:
+            for name, proto, net in self.mk_entries(r):
+                lines.append(f"del {name} {net}")
+        for r in adds:
+            timeout = max(1, r.expire - now) if r.kind == 'allow' else 0
+            for name, proto, net in self.mk_entries(r):
+                if name not in self.known_sets:
+                    # port not known at startup, e.g., a client added since
+                    self.known_sets.add(name)
+                    creates.append(self.mk_create_set(name))
+                    new_sets.append(([self.iptables_cmd, '-A', self.chain] +
+                                     self.mk_set_rule(name, r.port, proto), None))
+                lines.append(f'add {name} {net} timeout {timeout} comment "{mk_comment(r)}"')
+
+        script = '\n'.join(creates + lines) + '\n'
+        # -exist so deleting an entry the kernel has already expired, or
+        # re-adding one, isn't an error
+        return [([self.ipset_cmd, '-exist', 'restore'], script.encode())] + new_sets
+
+
+    def parse_rules(self, rule_output):
+        allow_rules = []
+        failopen_rules = []
+        for line in rule_output.decode().splitlines():
+            m = self.re_entry.match(line)
+            if not m or not m.group(1).startswith(self.set_prefix + '-'):
+                continue
+            c = self.re_comment.match(m.group(4))
+            if not c:
+                continue
+            port, proto = m.group(1)[len(self.set_prefix)+1:].split('-')
+            src_ip = 'anywhere' if m.group(2) in self.failopen_nets else m.group(2)
+            rule = Rule(c.group(1), src_ip, proto, int(port), c.group(2), int(c.group(3)))
+            if rule.kind == 'allow':
+                allow_rules.append(rule)
+            elif rule.kind == 'fail':
+                failopen_rules.append(rule)
+
+        return allow_rules, failopen_rules
+
+
+def observe_command(rc, duration):
+    metrics.firewall_commands.value += 1
+    metrics.firewall_seconds.observe(duration)
+    if rc != 0:
+        metrics.firewall_errors.value += 1
+
+
+class CommandRunner:
+    def __init__(self, sudo=False):
+        self.sudo = ['sudo'] if sudo else []
+
+    def run(self, args, stdin=None):
+        p = subprocess.run(self.sudo + args, input=stdin, capture_output=True)
+        return (p.returncode, p.stdout, p.stderr)
+
+
+# Logs and records commands instead of running them, so a backend can be
+# exercised without root. Every command succeeds and status commands
+# return status_output.
+class DryRunRunner:
+    def __init__(self, logger, status_output=b''):
+        self.logger = logger
+        self.status_output = status_output
+        self.commands = []
+
+    def run(self, args, stdin=None):
+        self.commands.append((args, stdin))
+        self.logger.info(f"Dry run: {args}" + (f" stdin: {stdin.decode()!r}" if stdin else ""))
+        return (0, self.status_output, b'')
+
+    async def arun(self, args, stdin=None):
+        return self.run(args, stdin)
+
+
+# Runs commands as asyncio subprocesses, at most max_concurrent at a time
+class AsyncCommandRunner:
+    def __init__(self, sudo=False, max_concurrent=4):
+        self.sudo = ['sudo'] if sudo else []
+        self.semaphore = asyncio.Semaphore(max_concurrent)
+
+    async def arun(self, args, stdin=None):
+        async with self.semaphore:
+            p = await asyncio.create_subprocess_exec(
+                *(self.sudo + args),
+                stdin=asyncio.subprocess.PIPE if stdin else asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+            out, err = await p.communicate(stdin)
+            return (p.returncode, out, err)
+
+
+class Firewall:
+    backends = {'ufw': UfwBackend, 'iptables': IptablesBackend, 'ipset': IpsetBackend}
+
+    def __init__(self, cfg, logger, runner=None, clock=None):
+        self.logger = logger
+        self.cfg = cfg
+        self.clock = clock or kclock.Clock()
+        if runner is None:
+            if cfg.firewall.dry_run:
+                runner = DryRunRunner(logger)
             else:
-                if next_expiration == 0 or next_expiration > expire:
-                    next_expiration = expire
+                runner = CommandRunner(cfg.ufw.use_sudo)
+        self.runner = runner
+        self.reconcile_interval = int(cfg.firewall.reconcile_interval)
+
+        backend = cfg.firewall.backend
+        if backend not in self.backends:
+            logger.warning(f"Unknown firewall backend '{backend}'. Using 'ufw'.")
+            backend = 'ufw'
+        self.backend = self.backends[backend](cfg, logger, self.clock)
+
+        # Rule changes are collected while a batch is open and applied
+        # together when the outermost batch closes.
+        self.batch_depth = 0
+        self.pending_adds = []
+        self.pending_deletes = []
+
+        # The rules knock has added, and a min-heap of their expirations.
+        # The table is authoritative; the firewall is only read back to
+        # reconcile, at startup and every reconcile_interval seconds.
+        #   rules: { rule_key: Rule, ... }
+        #   expiry: [ (expire, seq, rule_key), ... ]
+        # seq breaks ties so keys are never compared. A heap entry is stale
+        # (and skipped) if its rule has been removed or replaced with a later
+        # expiration.
+        self.rules = {}
+        self.expiry = []
+        self.expiry_seq = itertools.count()
+        self.next_reconcile = 0
+        # told about every rule table change, if set (see statestore.StateStore)
+        self.journal = None
+
+        self.backend.setup(self.run)
+        self.reconcile()
+
+
+    @contextmanager
+    def batch(self):
+        self.batch_depth += 1
+        try:
+            yield self
+        finally:
+            self.batch_depth -= 1
+            if self.batch_depth == 0:
+                self.commit()
+
+
+    def commit(self):
+        adds, deletes = self.pending_adds, self.pending_deletes
+        self.pending_adds, self.pending_deletes = [], []
+        if not adds and not deletes:
+            return
+
+        for r in deletes:
+            self.logger.info(f"Deleting firewall rule: {r}")
+        self.apply(self.backend.command_groups(adds, deletes))
+
+
+    def apply(self, groups):
+        for cmds in groups:
+            for args, stdin in cmds:
+                rc, out, err = self.run(args, stdin)
+                if rc != 0:
+                    self.logger.error(f"Error applying firewall changes with '{args}'. Error msg:'{err}'")
+
+
+    def get_active_rules(self):
+        rc, out, err = self.run(self.backend.status_command())
+        if rc != 0:
+            self.logger.error(f"Error getting firewall status. Stderr: {err}")
+            return None
+
+        return self.backend.parse_rules(out)
+
+
+    def reconcile(self):
+        # Replace the rule table with the knock rules actually in the firewall
+        # to catch drift, e.g., rules left from a previous run or deleted by
+        # hand. A rule we've since refreshed keeps its later expiration.
+        self.next_reconcile = int(self.clock.time()) + self.reconcile_interval
+        active = self.get_active_rules()
+        if active is None:
+            return
+
+        self.update_rule_table(*active)
+
+
+    def update_rule_table(self, allow_rules, failopen_rules, keep=()):
+        # keep: keys of rules added or deleted after the status was
+        # requested. The table is newer than the firewall's listing for them.
+        self.logger.debug("Reconciling rule table with firewall")
+        rules = {k: self.rules[k] for k in keep if k in self.rules}
+        for rule in allow_rules + failopen_rules:
+            key = rule_key(rule)
+            if key in keep:
+                continue
+            known = self.rules.get(key)
+            if known and known.expire > rule.expire:
+                rule = known
+            rules[key] = rule
+
+        self.rules = rules
+        self.expiry = [(r.expire, next(self.expiry_seq), k) for k, r in rules.items()]
+        heapq.heapify(self.expiry)
+        if self.journal:
+            self.journal.rules_replaced()
+
+
+    def restore_rules(self, rules):
+        # Rules from the saved listener state, taken to be in the firewall
+        # already. The next reconcile corrects the table if they aren't.
+        for rule in rules:
+            key = rule_key(rule)
+            known = self.rules.get(key)
+            if known and known.expire >= rule.expire:
+                continue
+            self.rules[key] = rule
+            heapq.heappush(self.expiry, (rule.expire, next(self.expiry_seq), key))
+
+
+    def add_rule(self, rule):
+        key = rule_key(rule)
+        with self.batch():
+            old = self.rules.get(key)
+            if old in self.pending_adds:
+                self.pending_adds.remove(old)
+            elif old:
+                # rule comments carry the expiration, so replace the old rule
+                self.pending_deletes.append(old)
+            self.rules[key] = rule
+            heapq.heappush(self.expiry, (rule.expire, next(self.expiry_seq), key))
+            self.pending_adds.append(rule)
+            if self.journal:
+                self.journal.rule_added(rule)
 
-        for rule in knock_rules:
-            delete_rule(int(rule['expire']), rule['from'], rule['proto'], rule['port'])
 
-        for rule in fail_rules:
-            delete_rule(int(rule['expire']), rule['from'], rule['proto'], rule['port'])
+    def remove_expired_rules(self):
+        # Returns the epoch of the next time this needs to run
+        current_epoch = int(self.clock.time())
+        if current_epoch >= self.next_reconcile:
+            self.reconcile()
+
+        with self.batch():
+            while self.expiry and current_epoch > self.expiry[0][0]:
+                expire, seq, key = heapq.heappop(self.expiry)
+                rule = self.rules.get(key)
+                if rule is None or rule.expire != expire:
+                    continue
+                self.logger.debug("Rule expired: %s, current time: %d", rule, current_epoch)
+                self.delete_rule(key, rule)
 
+        next_expiration = self.next_reconcile
+        if self.expiry:
+            next_expiration = min(next_expiration, self.expiry[0][0] + 1)
         return next_expiration
 
 
+    def delete_rule(self, key, rule):
+        del self.rules[key]
+        if self.backend.needs_delete(rule):
+            self.pending_deletes.append(rule)
+        if self.journal:
+            self.journal.rule_removed(rule)
+
+
+    def remove_failopen_rules(self):
+        # e.g., left from the last run's shutdown
+        with self.batch():
+            for key, rule in list(self.rules.items()):
+                if rule.kind == 'fail':
+                    self.logger.info(f"Removing failopen rule: {rule}")
+                    self.delete_rule(key, rule)
+
+
     def add_new_rule(self, src_ip, proto, dest_port, id, duration):
-        epoch = int(time.time())
-        self.logger.debug(f"Adding new fw rule at time {epoch}. Src:{src_ip}, " + \
-                         f"Port:{dest_port}, Id:{id}, Duration: {duration}")
-        rule = self.mk_allow_rule(src_ip, proto, dest_port, 
-                                  self.mk_allow_comment(id, int(duration) + epoch))
-        rc, out, err = self.run_ufw(rule)
-        self.rules_present = True
-        if rc != 0:
-            self.logger.error(f"Error adding firewall rule:'{rule}'. Error msg:'{err}'")
+        if ':' in src_ip and not self.backend.ipv6:
+            self.logger.warning("The %s firewall backend can't open ports for IPv6 source %s",
+                                self.cfg.firewall.backend, src_ip)
+            return
+        epoch = int(self.clock.time())
+        self.logger.debug("Adding new fw rule at time %d. Src:%s, Port:%s, Id:%s, Duration: %s",
+                          epoch, src_ip, dest_port, id, duration)
+        self.add_rule(Rule('allow', src_ip, proto, dest_port, id, int(duration) + epoch))
 
 
     def add_failopen_rules(self):
         if self.cfg.listener.failopen:
             self.logger.info("Adding failopen rules for ports: {}".format(self.cfg.listener.failopen_ports))
-            for item in self.cfg.listener.failopen_ports:
-                if not item:
-                    continue
-                elif len(item) == 1:
-                    item.append(None)
-
-                c = self.mk_failopen_comment()
-                rule = self.mk_failopen_rule(item[1], int(item[0]), c)
-                rc, out, err = self.run_ufw(rule)
-                self.rules_present = True
-                if rc != 0:
-                    self.logger.error(f"Error adding failopen rule: {err}")
+            expire = int(self.clock.time()) + int(self.cfg.listener.failopen_min_time)
+            with self.batch():
+                for item in self.cfg.listener.failopen_ports:
+                    if not item:
+                        continue
+                    elif len(item) == 1:
+                        item.append(None)
+
+                    self.add_rule(Rule('fail', 'anywhere', item[1], int(item[0]), None, expire))
         else:
             self.logger.info("Failopen is disabled. Skipping.")
 
 
-    def run_ufw(self, args):
+    def run(self, args, stdin=None):
+        start = time.perf_counter()
+        rc, out, err = self.runner.run(args, stdin)
+        observe_command(rc, time.perf_counter() - start)
+        return rc, out, err
+
+
+# Firewall for the asyncio listener. Batches and reconciliation run as
+# background tasks through an async runner, so callers (i.e., the packet
+# path) never wait on a firewall command. Backend setup at startup still
+# runs synchronously. Must be created with the event loop running.
+class AsyncFirewall(Firewall):
+    def __init__(self, cfg, logger, runner=None, arunner=None, clock=None):
+        if runner is None and cfg.firewall.dry_run:
+            runner = DryRunRunner(logger)
+        if arunner is None:
+            if isinstance(runner, DryRunRunner):
+                arunner = runner
+            else:
+                arunner = AsyncCommandRunner(cfg.ufw.use_sudo, cfg.firewall.max_concurrent)
+        self.arunner = arunner
+        self.tasks = set()
+        # the last batch's task, the next batch waits for it
+        self.last_batch = None
+        # keys of rules added or deleted while a reconcile is queued or in
+        # flight, else None
+        self.reconcile_keys = None
+        super().__init__(cfg, logger, runner, clock)
+
+
+    def spawn(self, coro):
+        task = asyncio.get_running_loop().create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+
+    # Batches are applied in the order they were committed, each after the
+    # one before it has finished: e.g., an expiry's delete and a re-knock's
+    # add for the same rule can't overtake each other. Within a batch, the
+    # groups of commands for different rules run at the same time.
+    def apply(self, groups):
+        self.last_batch = self.spawn(self.apply_async(groups, self.last_batch))
+
+
+    async def apply_async(self, groups, previous):
+        if previous:
+            # its errors are its own
+            await asyncio.wait([previous])
+        await asyncio.gather(*(self.apply_group(cmds) for cmds in groups))
+
+
+    async def apply_group(self, cmds):
+        for args, stdin in cmds:
+            rc, out, err = await self.arun(args, stdin)
+            if rc != 0:
+                self.logger.error(f"Error applying firewall changes with '{args}'. Error msg:'{err}'")
+
+
+    # A reconcile is queued like a batch, so the firewall's listing is of
+    # the rules as they are once the batches before it have been applied,
+    # i.e., the rule table as it is now. Rules added or deleted from here on
+    # are kept as they are in the table.
+    def reconcile(self):
+        self.next_reconcile = int(self.clock.time()) + self.reconcile_interval
+        if self.reconcile_keys is None:
+            self.reconcile_keys = set()
+            self.last_batch = self.spawn(self.reconcile_async(self.last_batch))
+
+
+    async def reconcile_async(self, previous):
+        if previous:
+            await asyncio.wait([previous])
+        rc, out, err = await self.arun(self.backend.status_command())
+        keep, self.reconcile_keys = self.reconcile_keys, None
+        if rc != 0:
+            self.logger.error(f"Error getting firewall status. Stderr: {err}")
+            return
+        self.update_rule_table(*self.backend.parse_rules(out), keep=keep)
+
+
+    async def arun(self, args, stdin=None):
+        start = time.perf_counter()
+        rc, out, err = await self.arunner.arun(args, stdin)
+        observe_command(rc, time.perf_counter() - start)
+        return rc, out, err
+
+
+    def add_rule(self, rule):
+        if self.reconcile_keys is not None:
+            self.reconcile_keys.add(rule_key(rule))
+        super().add_rule(rule)
+
+
+    def delete_rule(self, key, rule):
+        if self.reconcile_keys is not None:
+            self.reconcile_keys.add(key)
+        super().delete_rule(key, rule)
+
+
+    async def drain(self):
+        # wait for all outstanding firewall commands
+        while self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+
+
+# Firewall for replaying recorded traffic. Commands go to a DryRunRunner and
+# every rule change is recorded in history as (epoch, 'add'|'delete', Rule).
+# There's no real firewall to reconcile with.
+class RecordingFirewall(Firewall):
+    def __init__(self, cfg, logger, clock=None):
+        self.history = []
+        super().__init__(cfg, logger, DryRunRunner(logger), clock)
+
+
+    def reconcile(self):
+        self.next_reconcile = int(self.clock.time()) + self.reconcile_interval
+
 
-        p = subprocess.run(self.base_cmd + args, capture_output=True)
-        return (p.returncode, p.stdout, p.stderr)
\ No newline at end of file
+    def commit(self):
+        now = int(self.clock.time())
+        self.history += [(now, 'delete', r) for r in self.pending_deletes]
+        self.history += [(now, 'add', r) for r in self.pending_adds]
+        super().commit()
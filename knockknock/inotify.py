@@ -0,0 +1,92 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+
+
+# Minimal inotify(7) binding through ctypes
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+
+# struct inotify_event { int wd; uint32_t mask, cookie, len; char name[]; }
+EVENT = struct.Struct('iIII')
+
+_libc = None
+
+
+def libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    return _libc
+
+
+def check(ret):
+    if ret < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return ret
+
+
+# events: [ (wd, mask, cookie, name), ... ]   name is '' for events on the
+# watched path itself
+class Inotify:
+    def __init__(self):
+        self.fd = check(libc().inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC))
+        self.watches = {}
+
+
+    def add_watch(self, path, mask):
+        wd = check(libc().inotify_add_watch(self.fd, os.fsencode(path), mask))
+        self.watches[wd] = path
+        return wd
+
+
+    def rm_watch(self, wd):
+        if self.watches.pop(wd, None) is not None:
+            # fails if the kernel already removed it (IN_IGNORED)
+            libc().inotify_rm_watch(self.fd, wd)
+
+
+    def fileno(self):
+        return self.fd
+
+
+    def read(self, timeout=0):
+        # Events available now, or within timeout seconds (None waits for
+        # ever). Returns [] on timeout.
+        if timeout != 0 and not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return []
+
+        events = []
+        pos = 0
+        while pos < len(data):
+            wd, mask, cookie, name_len = EVENT.unpack_from(data, pos)
+            pos += EVENT.size
+            name = data[pos:pos + name_len].rstrip(b'\0')
+            pos += name_len
+            events.append((wd, mask, cookie, os.fsdecode(name)))
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+        return events
+
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
@@ -1,22 +1,53 @@
 #!/usr/bin/env python3
 
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+import csv
 import io
+import json
 import pyotp
 import qrcode
 import qrcode.image.svg
 import os
+import re
 import sys
+import tempfile
+import time
 
 import config
 import log
 
 
-def output_svg(uri, output_file):
-    factory = qrcode.image.svg.SvgImage
-    img = qrcode.make(uri, image_factory=factory)
-    with open(output_file, "xt") as f:
-        f.write(img.to_string(encoding='unicode'))
+# Writes the file in one go: the text goes to a temporary file in the same
+# directory, which is then linked to path. Like open(path, "x"), this fails
+# with FileExistsError if path exists, and path is never seen half written,
+# e.g., by the listener's config reload. Files are only readable by the
+# owner, they hold client secrets.
+def write_atomic(path, text):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix='.tmp-')
+    try:
+        with open(fd, 'w') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        try:
+            os.link(tmp, path)
+        except FileExistsError:
+            raise FileExistsError(f"{path} already exists") from None
+    finally:
+        os.unlink(tmp)
+
+
+# fast is for bulk mode: the QR code is drawn as one SVG path rather than a
+# rect per module, and with a fixed mask pattern instead of scoring all
+# eight (any mask is valid, scanners read it from the code), which makes it
+# about 4 times quicker.
+def output_svg(uri, output_file, fast=False):
+    if fast:
+        img = qrcode.make(uri, image_factory=qrcode.image.svg.SvgPathImage, mask_pattern=0)
+    else:
+        img = qrcode.make(uri, image_factory=qrcode.image.svg.SvgImage)
+    write_atomic(output_file, img.to_string(encoding='unicode'))
 
 
 def output_qrcode(uri):
@@ -28,23 +59,165 @@ def output_qrcode(uri):
     print(f.read())
 
 
-def setup_totp(client_name):
-    print(f"client_name={client_name}")
+def mk_totp(client_name):
     secret = pyotp.random_base32()
     totp = pyotp.TOTP(secret)
     uri = totp.provisioning_uri(name=client_name, issuer_name="Port Knock App")
     return secret, uri
 
 
+def setup_totp(client_name):
+    print(f"client_name={client_name}")
+    return mk_totp(client_name)
+
+
+# A TOML basic string. JSON string escapes are valid in TOML too, except
+# that TOML also wants DEL escaped.
+def toml_str(s):
+    return json.dumps(s, ensure_ascii=False).replace('\x7f', '\\u007f')
+
+
+PORT_RE = re.compile(r'([0-9]{1,5})(/(tcp|udp))?', re.IGNORECASE)
+
+
+def to_int(field, v):
+    if isinstance(v, int) and not isinstance(v, bool):
+        return v
+    if isinstance(v, str) and re.fullmatch(r'[0-9]+', v.strip()):
+        return int(v)
+    raise ValueError(f"{field} must be a whole number, not {v!r}")
+
+
+# Checks a client's settings before its config is written, so the listener
+# doesn't get a config it can't load. Raises ValueError for a bad value, and
+# returns the settings in the types the config file needs.
+def check_client(name, pin, ports, knock_cnt, open_duration):
+    knock_cnt = to_int('knock_cnt', knock_cnt)
+    if not (1 <= knock_cnt <= 8):
+        raise ValueError(f"knock_cnt must be from 1 to 8, not {knock_cnt}")
+    open_duration = to_int('open_duration', open_duration)
+    if open_duration < 1:
+        raise ValueError(f"open_duration must be at least 1, not {open_duration}")
+    if not ports:
+        raise ValueError("no ports")
+    for p in ports:
+        m = PORT_RE.fullmatch(str(p))
+        if not m or not (1 <= int(m[1]) <= 65535):
+            raise ValueError(f"bad port {p!r}, expected NNNN or NNNN/proto (tcp or udp)")
+    ports = [str(p).lower() for p in ports]
+    if isinstance(pin, int) and not isinstance(pin, bool):
+        pin = str(pin)
+    # the name ends up in firewall rule comments
+    for field, v in (('client_name', name), ('pin', pin)):
+        if v is None:
+            continue
+        if not isinstance(v, str):
+            raise ValueError(f"{field} must be a string, not {v!r}")
+        if any(ch < ' ' or ch == '\x7f' for ch in v):
+            raise ValueError(f"{field} contains control characters")
+    return name, pin, ports, knock_cnt, open_duration
+
+
 def output_config(client_file, name, secret, pin, port, knock_cnt, open_duration):
-    with open(client_file, "xt") as f:
-        if name:
-            f.write(f'name = "{name}"\n')
-        f.write(f'secret = "{secret}"\n')
-        f.write(f'pin = "{pin}"\n')
-        f.write(f'ports = {port}\n')
-        f.write(f'knock_cnt = {knock_cnt}\n')
-        f.write(f'open_duration = {open_duration}\n')
+    text = ''
+    if name:
+        text += f'name = {toml_str(name)}\n'
+    text += f'secret = {toml_str(secret)}\n'
+    text += f'pin = {toml_str(pin)}\n'
+    text += f'ports = [{", ".join(toml_str(p) for p in port)}]\n'
+    text += f'knock_cnt = {int(knock_cnt)}\n'
+    text += f'open_duration = {int(open_duration)}\n'
+    write_atomic(client_file, text)
+
+
+# Bulk mode
+#
+# The manifest is a CSV file with a header row, or a JSON list of objects,
+# with these fields for each client (only filename is required; the others
+# default to the command line options):
+#   filename, client_name, pin, knock_cnt, open_duration, ports
+# ports is a list in JSON, and space separated in CSV, e.g., "22/tcp 443".
+MANIFEST_FIELDS = ['filename', 'client_name', 'pin', 'knock_cnt', 'open_duration', 'ports']
+
+
+def read_manifest(path):
+    with open(path, newline='') as f:
+        if path.endswith('.json'):
+            rows = json.load(f)
+        else:
+            rows = list(csv.DictReader(f))
+    for row in rows:
+        unknown = set(row) - set(MANIFEST_FIELDS)
+        if unknown:
+            raise ValueError(f"{path}: unknown fields {sorted(unknown)}")
+        if isinstance(row.get('ports'), str):
+            row['ports'] = row['ports'].split()
+    return rows
+
+
+def mk_job(row, args, client_dir):
+    # Fills in the defaults for a manifest row. Empty CSV fields count as
+    # not given.
+    job = {k: v for k, v in row.items() if v not in (None, '', [])}
+    job.setdefault('pin', args.pin)
+    job.setdefault('knock_cnt', args.knock_cnt)
+    job.setdefault('open_duration', args.open_duration)
+    job.setdefault('ports', args.port or [])
+    job['ports'] = [str(p) for p in job['ports']]
+    job['client_dir'] = client_dir
+    job['svg_dir'] = args.svg_dir if args.qr_fmt != 'none' else None
+    return job
+
+
+def provision(job):
+    # Runs in a worker process. Returns the client's summary entry.
+    filename = job.get('filename', '')
+    if not filename.endswith(".toml"):
+        filename += ".toml"
+    cname = job.get('client_name') or os.path.splitext(filename)[0]
+    result = {'filename': filename, 'name': cname, 'config': None, 'svg': None,
+              'uri': None, 'status': 'ok'}
+    try:
+        if os.path.basename(filename) != filename or filename == '.toml':
+            raise ValueError("filename must be a plain file name")
+        settings = check_client(job.get('client_name'), job['pin'], job['ports'],
+                                job['knock_cnt'], job['open_duration'])
+        secret, uri = mk_totp(cname)
+        client_file = os.path.join(job['client_dir'], filename)
+        output_config(client_file, settings[0], secret, *settings[1:])
+        result['config'] = client_file
+        result['uri'] = uri
+        if job['svg_dir']:
+            svg_file = os.path.join(job['svg_dir'], os.path.splitext(filename)[0] + '.svg')
+            output_svg(uri, svg_file, fast=True)
+            result['svg'] = svg_file
+    except (OSError, ValueError) as e:
+        result['status'] = f"error: {e}"
+    return result
+
+
+def bulk_add(args, client_dir):
+    start = time.perf_counter()
+    jobs = [mk_job(row, args, client_dir) for row in read_manifest(args.manifest)]
+    summary = args.summary or os.path.splitext(args.manifest)[0] + '.summary.json'
+    # the summary is the only record of the new clients' URIs
+    if os.path.exists(summary):
+        print(f"{summary} already exists", file=sys.stderr)
+        return 1
+    if args.qr_fmt != 'none':
+        os.makedirs(args.svg_dir, exist_ok=True)
+    workers = args.jobs or os.cpu_count() or 1
+    with ProcessPoolExecutor(workers) as pool:
+        # a few chunks per worker, so one process isn't left with the tail
+        results = list(pool.map(provision, jobs, chunksize=max(1, len(jobs) // (8 * workers))))
+
+    write_atomic(summary, json.dumps(results, indent=2) + '\n')
+    failed = [r for r in results if r['status'] != 'ok']
+    for r in failed:
+        print(f"{r['filename']}: {r['status']}", file=sys.stderr)
+    print(f"Added {len(results) - len(failed)} of {len(results)} clients in " + \
+          f"{time.perf_counter() - start:.1f}s. Summary in {summary}")
+    return 1 if failed else 0
 
 
 def main(argv):
@@ -75,7 +248,7 @@ def main(argv):
                       help="Number of seconds to keep port(s) open following a successful " + \
                         "knock sequence. Default is 10 seconds.")
     argp.add_argument('--port',
-                      required=True,
+                      required=False,
                       action='append',
                       help="Port/proto to open. This option may be specified multiple times. " + \
                            "Proto is optional. Example values: 22, 22/tcp, 443/tcp")
@@ -91,7 +264,31 @@ def main(argv):
                       default="qrcode.svg",
                       help="Name of file to write QR code to in SVG format. Only applicable " + \
                         "--qr_fmt option is set to 'svg'.")
+    argp.add_argument('--manifest',
+                      required=False,
+                      default=None,
+                      help="Add all the clients in this CSV or JSON manifest instead of one " + \
+                        "client. Fields: filename, client_name, pin, knock_cnt, open_duration, " + \
+                        "ports. Missing fields default to the options above.")
+    argp.add_argument('--svg-dir',
+                      required=False,
+                      default="qrcodes",
+                      help="With --manifest, directory to write each client's SVG QR code " + \
+                        "to, unless --qr-fmt is 'none'.")
+    argp.add_argument('--summary',
+                      required=False,
+                      default=None,
+                      help="With --manifest, file to write the summary of the clients added " + \
+                        "to (JSON, includes the provisioning URIs). Default is the " + \
+                        "manifest name with .summary.json.")
+    argp.add_argument('--jobs',
+                      type=int,
+                      required=False,
+                      default=None,
+                      help="With --manifest, number of worker processes. Default is the " + \
+                        "number of CPUs.")
     argp.add_argument('filename',
+                      nargs='?',
                       help="Name of file to store this configuration. Do not include " + \
                            "path or extension.")
 
@@ -100,6 +297,17 @@ def main(argv):
     # load config
     cfg = config.Config(args.config_file, tmp_logger, False)
 
+    if args.manifest:
+        return bulk_add(args, os.path.normpath(cfg.listener.client_cfg))
+    if not args.filename or not args.port:
+        argp.error("filename and --port are required without --manifest")
+
+    try:
+        settings = check_client(args.client_name, args.pin, args.port,
+                                args.knock_cnt, args.open_duration)
+    except ValueError as e:
+        argp.error(str(e))
+
     print(f"args={args}")
 
     if not args.filename.endswith(".toml"):
@@ -110,8 +318,7 @@ def main(argv):
     secret, totp_uri = setup_totp(cname)
 
     client_file = os.path.normpath(cfg.listener.client_cfg + "/" + args.filename)
-    output_config(client_file, args.client_name, secret, args.pin, 
-                  args.port, args.knock_cnt, args.open_duration)
+    output_config(client_file, settings[0], secret, *settings[1:])
 
     if args.qr_fmt in ["ascii", "all"]:
         output_qrcode(totp_uri)
@@ -121,4 +328,4 @@ def main(argv):
 
 
 if __name__ == '__main__':
-    main(sys.argv)
+    sys.exit(main(sys.argv))
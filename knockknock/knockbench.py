@@ -0,0 +1,751 @@
+#!/usr/bin/env python3
+
+import argparse
+from contextlib import nullcontext
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import namedtuple
+
+import pyotp
+
+import capture
+import clientreload
+import clock
+import config
+import knockindex
+import knocktrack
+import knockutil
+import log
+import metrics
+import ratelimit
+import scheduler
+import sessionstore
+import shard
+import tcpdump
+
+
+# Stands in for firewall.Firewall so no ufw commands are run
+class FakeFirewall:
+    def __init__(self):
+        self.rules = []
+
+    def batch(self):
+        return nullcontext(self)
+
+    def add_new_rule(self, src_ip, proto, dest_port, id, duration):
+        self.rules.append((src_ip, proto, dest_port, id, duration))
+
+    def remove_expired_rules(self):
+        pass
+
+
+def mk_cfg(knock_expiration=10):
+    Listener = namedtuple('listener', 'knock_expiration')
+    Cfg = namedtuple('cfg', 'listener')
+    return Cfg(Listener(knock_expiration))
+
+
+def mk_clients(n, knock_cnt=3, totp_skew=0):
+    return [config.Client(pyotp.random_base32(), '', f"client{i}", [[22, 'tcp']], knock_cnt, 10, totp_skew)
+            for i in range(n)]
+
+
+def mk_ktracks(clients, logger, fw, sessions=None):
+    cfg = mk_cfg()
+    kindex = knockindex.KnockIndex(logger, sessions)
+    for c in clients:
+        kt = knocktrack.KnockTrack(cfg, c, logger, fw, sessions=kindex.sessions)
+        kindex.add_client(kt, int(time.time()))
+    return kindex.clients, kindex
+
+
+def mk_rand_ip(rnd):
+    return '.'.join(str(rnd.randrange(1, 255)) for _ in range(4))
+
+
+# Generate 'count' knock entries. Mostly random noise in the knock port range
+# with a valid knock sequence for a random client mixed in every 'knock_every'
+# packets.
+def mk_packets(ktrack, count, knock_every=50, seed=1):
+    rnd = random.Random(seed)
+    now = int(time.time())
+    packets = []
+    while len(packets) < count:
+        if ktrack and len(packets) % knock_every == 0:
+            kd = rnd.choice(ktrack).totp_mgr.knock_data
+            sip = mk_rand_ip(rnd)
+            for port, msg_len in zip(kd['ports'], kd['lens']):
+                packets.append(capture.KnockEvent(now, sip, port, msg_len))
+        else:
+            packets.append(capture.KnockEvent(now, mk_rand_ip(rnd),
+                                              rnd.randint(knockutil.PORT_START, knockutil.PORT_END),
+                                              rnd.randrange(16)))
+    return packets[:count]
+
+
+def run_dispatch(packets, ktrack, kindex):
+    start = time.perf_counter()
+    for p in packets:
+        kindex.dispatch(p)
+    return time.perf_counter() - start
+
+
+# The per-client housekeeping from before the Housekeeper: each client
+# checks its totp and expires sessions (with a second of slop) itself.
+def client_housekeeping(kt):
+    kt.totp_mgr.rotate_totp()
+    kt.sessions.remove_expired(int(kt.clock.time()) - 1)
+
+
+# The pre-index behavior: every packet goes to every client, each of which
+# runs its own housekeeping.
+def run_fanout(packets, ktrack, kindex):
+    start = time.perf_counter()
+    for p in packets:
+        for k in ktrack:
+            client_housekeeping(k)
+            k.process_knock(p)
+    return time.perf_counter() - start
+
+
+def bench_dispatch(args, logger):
+    print(f"{'clients':>8} {'mode':>8} {'packets':>8} {'us/packet':>10} {'doors':>6}")
+    for n in args.clients:
+        clients = mk_clients(n, args.knock_cnt)
+        modes = [('index', run_dispatch, args.packets)]
+        if n <= args.fanout_max:
+            # fan-out is O(clients) per packet, so scale packet count down
+            modes.append(('fanout', run_fanout, max(100, args.packets * 10 // n)))
+
+        for mode, fn, pkt_cnt in modes:
+            fw = FakeFirewall()
+            ktrack, kindex = mk_ktracks(clients, logger, fw)
+            packets = mk_packets(ktrack, pkt_cnt)
+            elapsed = fn(packets, ktrack, kindex)
+            print(f"{n:>8} {mode:>8} {pkt_cnt:>8} {elapsed / pkt_cnt * 1e6:>10.2f} {len(fw.rules):>6}")
+
+
+# Regex and timestamp parse used by Tcpdump.match before tcpdump was run
+# with -tt, for comparison.
+LEGACY_RE = re.compile(r'^([\d:.]+)\s.+\sIn\s+IP\s+(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})\.\d{1,5}[\s>]+'
+                       r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}\.(\d{1,5}):.+UDP.+length\s+(\d+)')
+
+
+def legacy_match(logger, parse, log_line):
+    m = LEGACY_RE.match(log_line)
+    if m is None:
+        return m
+    logger.debug('Groups from line parse: {}'.format(m.groups()))
+    return dict(ts=int(parse(m.group(1)).timestamp()), saddr=m.group(2),
+                dport=int(m.group(3)), len=int(m.group(4)))
+
+
+# The single regex Tcpdump.match used before the prefilter, for comparison
+REGEX_RE = re.compile(r'^(\d+)\.\d*\s.+\sIn\s+IP\s+(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})\.\d{1,5}[\s>]+'
+                      r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}\.(\d{1,5}):.+UDP.+length\s+(\d+)')
+
+
+def regex_match(log_line):
+    m = REGEX_RE.match(log_line)
+    if m is None:
+        return m
+    return dict(ts=int(m.group(1)), saddr=m.group(2),
+                dport=int(m.group(3)), len=int(m.group(4)))
+
+
+def mk_rand_ip6(rnd):
+    return '2001:db8:' + ':'.join(f"{rnd.randrange(65536):x}" for _ in range(6))
+
+
+# kind is 'ip', 'ip6', or 'other' for lines that aren't knocks: outgoing,
+# TCP and ICMP
+def mk_tcpdump_lines(count, epoch_ts=True, seed=1, kind='ip'):
+    rnd = random.Random(seed)
+    now = time.time()
+    lines = []
+    for i in range(count):
+        ts = now + i / 1000
+        if epoch_ts:
+            ts_str = f"{ts:.6f}"
+        else:
+            ts_str = time.strftime('%H:%M:%S', time.localtime(ts)) + f".{int(ts % 1 * 1e6):06d}"
+        dport = rnd.randint(knockutil.PORT_START, knockutil.PORT_END)
+        if kind == 'ip6':
+            lines.append(f"{ts_str} eth0  In  IP6 {mk_rand_ip6(rnd)}.{rnd.randint(1024, 65535)} > " +
+                         f"2001:db8::1.{dport}: UDP, length {rnd.randrange(16)}")
+        elif kind == 'other':
+            src = mk_rand_ip(rnd)
+            lines.append(rnd.choice([
+                f"{ts_str} eth0  Out IP 10.0.0.1.{dport} > {src}.53: UDP, length 12",
+                f"{ts_str} eth0  In  IP {src}.{dport} > 10.0.0.1.22: Flags [S], seq 1, win 64240, length 0",
+                f"{ts_str} eth0  In  IP {src} > 10.0.0.1: ICMP echo request, id 1, seq 1, length 64"]))
+        else:
+            lines.append(f"{ts_str} eth0  In  IP {mk_rand_ip(rnd)}.{rnd.randint(1024, 65535)} > " +
+                         f"10.0.0.1.{dport}: UDP, length {rnd.randrange(16)}")
+    return lines
+
+
+# A Tcpdump object for calling match() on; 'true' stands in for tcpdump
+def mk_tcpdump(logger):
+    Tcp = namedtuple('tcpdump', 'backend cmd capture log_file truncate_size')
+    Cfg = namedtuple('cfg', 'tcpdump')
+    cfg = Cfg(Tcp('tcpdump', shutil.which('true'), 'pipe', '', 0))
+    return tcpdump.Tcpdump(cfg, logger)
+
+
+def time_lines(fn, lines):
+    start = time.perf_counter()
+    for l in lines:
+        fn(l)
+    return len(lines) / (time.perf_counter() - start)
+
+
+def bench_match(args, logger):
+    td = mk_tcpdump(logger)
+    print(f"{'parser':>24} {'lines/s':>12}")
+
+    try:
+        from dateutil.parser import parse
+    except ImportError:
+        print(f"{'dateutil (before)':>24} {'skipped, python-dateutil not installed':>12}")
+    else:
+        lines = mk_tcpdump_lines(args.lines, epoch_ts=False)
+        rate = time_lines(lambda l: legacy_match(logger, parse, l), lines)
+        print(f"{'dateutil (before)':>24} {rate:>12,.0f}")
+
+    for kind in ('ip', 'ip6', 'other'):
+        lines = mk_tcpdump_lines(args.lines, kind=kind)
+        if kind != 'ip6':
+            rate = time_lines(regex_match, lines)
+            print(f"{'regex (before), ' + kind:>24} {rate:>12,.0f}")
+        rate = time_lines(td.match, lines)
+        print(f"{'Tcpdump.match, ' + kind:>24} {rate:>12,.0f}")
+
+
+def mk_line(ts, saddr, dport, msg_len, sport=40000):
+    return f"{ts:.6f} eth0  In  IP {saddr}.{sport} > 10.0.0.1.{dport}: UDP, length {msg_len}"
+
+
+# Synthetic tcpdump output: 'flood' is the fraction of lines that are noise
+# (random source, port and length in the knock range); the rest are complete,
+# valid knock sequences for random clients.
+def mk_traffic_lines(ktrack, count, flood, seed=1):
+    rnd = random.Random(seed)
+    now = time.time()
+    lines = []
+    while len(lines) < count:
+        if rnd.random() >= flood:
+            kd = rnd.choice(ktrack).totp_mgr.knock_data
+            sip = mk_rand_ip(rnd)
+            for port, msg_len in zip(kd['ports'], kd['lens']):
+                lines.append(mk_line(now, sip, port, msg_len))
+        else:
+            lines.append(mk_line(now, mk_rand_ip(rnd),
+                                 rnd.randint(knockutil.PORT_START, knockutil.PORT_END),
+                                 rnd.randrange(16)))
+    return lines[:count]
+
+
+# Run lines through the listener's per-packet path. Returns per-line
+# latencies in ns.
+def run_pipeline(td, kindex, lines):
+    housekeeper = scheduler.Housekeeper(kindex, FakeFirewall(), time.time())
+    latencies = []
+    perf_ns = time.perf_counter_ns
+    for l in lines:
+        start = perf_ns()
+        entry = td.match(l)
+        if entry:
+            housekeeper.tick(int(time.time()))
+            kindex.dispatch(entry)
+        latencies.append(perf_ns() - start)
+    return latencies
+
+
+def percentile(sorted_values, pct):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * pct / 100))]
+
+
+def run_suite_case(td, logger, n_clients, knock_cnt, flood, n_lines):
+    clients = mk_clients(n_clients, knock_cnt)
+
+    # Memory: clients (totp managers, index) and the growth from processing
+    # the traffic (sessions), measured on a separate untimed pass because
+    # tracemalloc slows everything down.
+    tracemalloc.start()
+    ktrack, kindex = mk_ktracks(clients, logger, FakeFirewall())
+    clients_bytes = tracemalloc.get_traced_memory()[0]
+    lines = mk_traffic_lines(ktrack, n_lines, flood)
+    tracemalloc.reset_peak()
+    base = tracemalloc.get_traced_memory()[0]
+    run_pipeline(td, kindex, lines)
+    processing_peak = tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+
+    fw = FakeFirewall()
+    ktrack, kindex = mk_ktracks(clients, logger, fw)
+    lines = mk_traffic_lines(ktrack, n_lines, flood)
+    start = time.perf_counter()
+    latencies = run_pipeline(td, kindex, lines)
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+
+    # Cost of computing a totp step's knock data for every client, as is
+    # done (in the background) once per totp step
+    start = time.perf_counter()
+    for kt in ktrack:
+        kt.totp_mgr.mk_knock_data(kt.totp_mgr.curr_step + 1)
+    rotate_elapsed = time.perf_counter() - start
+
+    return {
+        'clients': n_clients,
+        'knock_cnt': knock_cnt,
+        'flood': flood,
+        'lines': n_lines,
+        'lines_per_sec': round(n_lines / elapsed),
+        'latency_ns': {'p50': percentile(latencies, 50),
+                       'p90': percentile(latencies, 90),
+                       'p99': percentile(latencies, 99),
+                       'max': latencies[-1]},
+        'doors_opened': len(fw.rules),
+        'rotate_totp_us_per_client': round(rotate_elapsed / n_clients * 1e6, 2),
+        'mem_clients_kb': round(clients_bytes / 1024),
+        'mem_processing_peak_kb': round(processing_peak / 1024),
+    }
+
+
+def bench_suite(args, logger):
+    td = mk_tcpdump(logger)
+    results = []
+    if not args.json:
+        print(f"{'clients':>8} {'knocks':>6} {'flood':>6} {'lines/s':>10} {'p50 us':>7} " +
+              f"{'p99 us':>7} {'max us':>8} {'rotate us':>9} {'clients kb':>10} {'peak kb':>8}")
+    for n_clients, knock_cnt, flood in itertools.product(args.clients, args.knock_cnt, args.flood):
+        r = run_suite_case(td, logger, n_clients, knock_cnt, flood, args.lines)
+        results.append(r)
+        if not args.json:
+            lat = r['latency_ns']
+            print(f"{n_clients:>8} {knock_cnt:>6} {flood:>6} {r['lines_per_sec']:>10,} " +
+                  f"{lat['p50'] / 1e3:>7.1f} {lat['p99'] / 1e3:>7.1f} {lat['max'] / 1e3:>8.1f} " +
+                  f"{r['rotate_totp_us_per_client']:>9} {r['mem_clients_kb']:>10} " +
+                  f"{r['mem_processing_peak_kb']:>8}")
+
+    report = {'benchmark': 'suite',
+              'time': int(time.time()),
+              'python': sys.version.split()[0],
+              'results': results}
+    if args.json:
+        print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+# First knocks for random clients from random (spoofed) sources, i.e., the
+# traffic that creates the most sessions.
+def mk_first_knocks(ktrack, count, seed=1):
+    rnd = random.Random(seed)
+    now = int(time.time())
+    packets = []
+    for i in range(count):
+        kd = rnd.choice(ktrack).totp_mgr.knock_data
+        packets.append(capture.KnockEvent(now, mk_rand_ip(rnd), kd['ports'][0], kd['lens'][0]))
+    return packets
+
+
+def bench_flood(args, logger):
+    clients = mk_clients(args.clients)
+    print(f"{'max_sessions':>12} {'packets':>8} {'sessions':>8} {'evicted':>8} " +
+          f"{'mem kb':>8} {'bytes/session':>13} {'us/packet':>10}")
+    for cap in args.max_sessions:
+        # 0 for no cap, i.e., sessions only go away when they expire
+        sessions = sessionstore.SessionStore(cap or sys.maxsize, args.max_per_source)
+        ktrack, kindex = mk_ktracks(clients, logger, FakeFirewall(), sessions)
+        packets = mk_first_knocks(ktrack, args.packets)
+        evicted = metrics.sessions_evicted.value
+        elapsed = run_dispatch(packets, ktrack, kindex)
+        evicted = metrics.sessions_evicted.value - evicted
+
+        # memory on a separate pass, tracemalloc slows everything down
+        ktrack, kindex = mk_ktracks(clients, logger, FakeFirewall(),
+                                    sessionstore.SessionStore(cap or sys.maxsize, args.max_per_source))
+        # new packets, the totp may have rotated since the first pass
+        packets = mk_first_knocks(ktrack, args.packets)
+        tracemalloc.start()
+        base = tracemalloc.get_traced_memory()[0]
+        run_dispatch(packets, ktrack, kindex)
+        mem = tracemalloc.get_traced_memory()[0] - base
+        tracemalloc.stop()
+
+        print(f"{cap or 'none':>12} {args.packets:>8} {len(sessions):>8} {evicted:>8} " +
+              f"{mem // 1024:>8} {mem // max(1, len(sessions)):>13} " +
+              f"{elapsed / args.packets * 1e6:>10.2f}")
+
+
+def mk_limited_index(clients, logger, fw):
+    ktrack, kindex = mk_ktracks(clients, logger, fw)
+    kindex.limiter = ratelimit.RateLimiter(logger, 2, 24, 60)
+    return ktrack, kindex
+
+
+# A shard.run_worker without the housekeeping and firewall applier: sets up
+# the clients, says it's ready, dispatches knocks until the pipe closes, then
+# reports the number of doors opened.
+def shard_worker(clients, logger, ends, knock_conn, result_conn):
+    shard.close_all(ends, keep=[knock_conn, result_conn])
+    fw = FakeFirewall()
+    ktrack, kindex = mk_limited_index(clients, logger, fw)
+    result_conn.send_bytes(b'ready')
+    try:
+        while True:
+            for knock in shard.unpack_knocks(knock_conn.recv_bytes()):
+                kindex.dispatch(knock)
+    except EOFError:
+        pass
+    result_conn.send_bytes(len(fw.rules).to_bytes(4, 'big'))
+
+
+def run_sharded(clients, logger, packets, n):
+    ctx = multiprocessing.get_context('fork')
+    knock_pipes = [ctx.Pipe(duplex=False) for _ in range(n)]
+    result_pipes = [ctx.Pipe(duplex=False) for _ in range(n)]
+    ends = [c for pipe in knock_pipes + result_pipes for c in pipe]
+    procs = [ctx.Process(target=shard_worker,
+                         args=(clients, logger, ends, knock_pipes[i][0], result_pipes[i][1]))
+             for i in range(n)]
+    for p in procs:
+        p.start()
+    for recv, send in knock_pipes:
+        recv.close()
+    for recv, send in result_pipes:
+        send.close()
+        recv.recv_bytes()
+
+    start = time.perf_counter()
+    shards = shard.Shards([send for recv, send in knock_pipes])
+    # the front end gets the packets a read's worth at a time
+    for i in range(0, len(packets), 64):
+        for knock in packets[i:i + 64]:
+            shards.send(knock)
+        shards.flush()
+    shards.close()
+    doors = sum(int.from_bytes(recv.recv_bytes(), 'big') for recv, send in result_pipes)
+    elapsed = time.perf_counter() - start
+    for p in procs:
+        p.join()
+    return elapsed, doors
+
+
+def bench_shard(args, logger):
+    clients = mk_clients(args.clients)
+    ktrack, kindex = mk_limited_index(clients, logger, FakeFirewall())
+    packets = mk_packets(ktrack, args.packets)
+    print(f"{os.cpu_count()} cpus")
+    print(f"{'workers':>8} {'packets':>8} {'packets/s':>10} {'doors':>6}")
+
+    fw = FakeFirewall()
+    ktrack, kindex = mk_limited_index(clients, logger, fw)
+    elapsed = run_dispatch(packets, ktrack, kindex)
+    print(f"{'none':>8} {args.packets:>8} {args.packets / elapsed:>10,.0f} {len(fw.rules):>6}")
+
+    for n in args.workers:
+        elapsed, doors = run_sharded(clients, logger, packets, n)
+        print(f"{n:>8} {args.packets:>8} {args.packets / elapsed:>10,.0f} {doors:>6}")
+
+
+# A knock.toml and n client config files in directory d, with the client
+# config cache in d too
+def mk_config_dir(d, n):
+    client_dir = os.path.join(d, 'conf.d')
+    os.mkdir(client_dir)
+    toml_file = os.path.join(d, 'knock.toml')
+    with open(toml_file, 'w') as f:
+        f.write(f'[listener]\nclient_cfg = "{client_dir}"\n' +
+                f'client_cache = "{os.path.join(d, "clients.cache")}"\n')
+    for i in range(n):
+        with open(os.path.join(client_dir, f"client{i}.toml"), 'w') as f:
+            f.write(f'secret = "{pyotp.random_base32()}"\npin = ""\nports = ["22/tcp"]\n')
+    return toml_file, client_dir
+
+
+# What knocklisten.setup_clients does, minus the rate limiter
+def mk_listener_index(cfg, logger, fw, clk):
+    kindex = knockindex.KnockIndex(logger)
+    for c in cfg.clients:
+        kt = knocktrack.KnockTrack(cfg, c, logger, fw, clk, kindex.sessions)
+        kindex.add_client(kt, int(clk.time()))
+    return kindex
+
+
+def time_startup(toml_file, logger):
+    start = time.perf_counter()
+    cfg = config.Config(toml_file, logger)
+    loaded = time.perf_counter()
+    mk_listener_index(cfg, logger, FakeFirewall(), clock.Clock())
+    return loaded - start, time.perf_counter() - loaded
+
+
+def bench_startup(args, logger):
+    # cold: no cache yet; warm: every file cached; stale: one file changed
+    print(f"{'clients':>8} {'cold ms':>8} {'warm ms':>8} {'stale ms':>8} {'setup ms':>9} " +
+          f"{'cache kb':>9}")
+    for n in args.clients:
+        with tempfile.TemporaryDirectory() as d:
+            toml_file, client_dir = mk_config_dir(d, n)
+            cold, setup = time_startup(toml_file, logger)
+            warm, setup = time_startup(toml_file, logger)
+            with open(os.path.join(client_dir, "client0.toml"), 'a') as f:
+                f.write('open_duration = 20\n')
+            stale, setup = time_startup(toml_file, logger)
+            size = os.path.getsize(os.path.join(d, "clients.cache"))
+            print(f"{n:>8} {cold * 1e3:>8.1f} {warm * 1e3:>8.1f} {stale * 1e3:>8.1f} " +
+                  f"{setup * 1e3:>9.1f} {size // 1024:>9}")
+
+
+def bench_reload(args, logger):
+    print(f"{'clients':>8} {'load ms':>8} {'scan ms':>8} {'inotify ms':>10} {'kept':>6}")
+    for n in args.clients:
+        with tempfile.TemporaryDirectory() as d:
+            toml_file, client_dir = mk_config_dir(d, n)
+            start = time.perf_counter()
+            cfg = config.Config(toml_file, logger)
+            load = time.perf_counter() - start
+
+            fw = FakeFirewall()
+            clk = clock.Clock()
+            kindex = mk_listener_index(cfg, logger, fw, clk)
+            reloader = clientreload.ClientReloader(cfg, logger, kindex, fw, clk)
+            reloader.close()
+            # a session for every client, to check they're kept
+            for i, kt in enumerate(kindex.clients):
+                kindex.sessions.add(kt, kt.totp_mgr.knock_data, int(clk.time()) + 10,
+                                    f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}")
+
+            # one changed file: found by stat()ing the whole directory (SIGHUP)
+            # or given by inotify. Same secret, so the client is updated in place.
+            path = os.path.join(client_dir, "client0.toml")
+            with open(path) as f:
+                orig = f.read()
+            timings = []
+            for paths, duration in ((None, 20), ({path}, 300)):
+                with open(path, 'w') as f:
+                    f.write(orig + f'open_duration = {duration}\n')
+                start = time.perf_counter()
+                changes = reloader.reload(paths)
+                timings.append(time.perf_counter() - start)
+                assert len(changes) == 1
+
+            print(f"{n:>8} {load * 1e3:>8.1f} {timings[0] * 1e3:>8.2f} {timings[1] * 1e3:>10.3f} " +
+                  f"{len(kindex.sessions):>6}")
+
+
+# A log destination that takes delay seconds per record, like a busy syslog
+class SlowStream:
+    def __init__(self, delay):
+        self.delay = delay
+
+    def write(self, text):
+        time.sleep(self.delay)
+
+    def flush(self):
+        pass
+
+
+def time_calls(fn, n):
+    start = time.perf_counter()
+    for _ in range(n):
+        fn()
+    return (time.perf_counter() - start) / n
+
+
+def bench_logging(args, logger):
+    # The first knock debug message, logged for each of a client's live
+    # steps on every packet that reaches it
+    ktrack, kindex = mk_ktracks(mk_clients(1), logger, FakeFirewall())
+    kd = ktrack[0].totp_mgr.knock_data
+    dport, msg_len = kd['ports'][0], kd['lens'][0]
+
+    print("debug call with the level at info (ns per call)")
+    logger.set_level("info")
+    calls = [
+        ("f-string", lambda: logger.debug(f"Testing first knock: curr={kd}. dport={dport}, len={msg_len}")),
+        ("%-args", lambda: logger.debug("Testing first knock: curr=%s. dport=%d, len=%d", kd, dport, msg_len)),
+        ("isEnabledFor guard", lambda: logger.isEnabledFor(logging.DEBUG) and \
+            logger.debug("Testing first knock: curr=%s. dport=%d, len=%d", kd, dport, msg_len)),
+    ]
+    for name, fn in calls:
+        print(f"{name:>24} {time_calls(fn, args.calls) * 1e9:>10.0f}")
+
+    print(f"\ninfo call to a destination taking {args.delay * 1e3:g} ms per record (us per call)")
+    print(f"{'handler':>24} {'caller':>10} {'close':>10}")
+    for queued in (False, True):
+        qlog = log.Log("info", False, queued)
+        qlog.handler.setStream(SlowStream(args.delay))
+        per_call = time_calls(lambda: qlog.info("Opening port %s for %s", "22/tcp", "10.1.2.3"),
+                              args.records)
+        start = time.perf_counter()
+        qlog.close()
+        close = time.perf_counter() - start
+        print(f"{'queued' if queued else 'sync':>24} {per_call * 1e6:>10.1f} {close * 1e3:>8.0f}ms")
+
+
+def main(argv):
+    argp = argparse.ArgumentParser(prog='knockbench',
+                                   description='Benchmarks for the knock processing path.')
+    sub = argp.add_subparsers(dest='bench', required=True)
+
+    p = sub.add_parser('dispatch',
+                       help="Per-packet cost of knock dispatch as the number of clients grows.")
+    p.add_argument('--clients',
+                   type=int,
+                   nargs='+',
+                   default=[10, 100, 1000, 10000],
+                   help="Client counts to benchmark.")
+    p.add_argument('--packets',
+                   type=int,
+                   default=100000,
+                   help="Number of packets to dispatch per client count.")
+    p.add_argument('--knock-cnt',
+                   type=int,
+                   default=3,
+                   help="Knock count for each client.")
+    p.add_argument('--fanout-max',
+                   type=int,
+                   default=1000,
+                   help="Largest client count to also run the per-client fan-out for comparison.")
+
+    p = sub.add_parser('match',
+                       help="Throughput of Tcpdump.match on synthetic tcpdump output.")
+    p.add_argument('--lines',
+                   type=int,
+                   default=100000,
+                   help="Number of tcpdump lines to parse.")
+
+    p = sub.add_parser('suite',
+                       help="Knock processing throughput, latency and memory over a parameter grid.")
+    p.add_argument('--clients',
+                   type=int,
+                   nargs='+',
+                   default=[10, 1000],
+                   help="Client counts.")
+    p.add_argument('--knock-cnt',
+                   type=int,
+                   nargs='+',
+                   default=[1, 3, 8],
+                   help="Knock sequence lengths (1-8).")
+    p.add_argument('--flood',
+                   type=float,
+                   nargs='+',
+                   default=[0.0, 0.9, 0.99],
+                   help="Fractions of traffic that is noise rather than valid knocks.")
+    p.add_argument('--lines',
+                   type=int,
+                   default=20000,
+                   help="Number of tcpdump lines per case.")
+    p.add_argument('--json',
+                   action='store_true',
+                   help="Print results as JSON instead of a table.")
+    p.add_argument('--output',
+                   default=None,
+                   help="Also write the JSON results to this file.")
+
+    p = sub.add_parser('flood',
+                       help="Session table size and memory under a spoofed-source first knock flood.")
+    p.add_argument('--clients',
+                   type=int,
+                   default=100,
+                   help="Number of clients.")
+    p.add_argument('--packets',
+                   type=int,
+                   default=200000,
+                   help="Number of flood packets, all within one knock expiration.")
+    p.add_argument('--max-sessions',
+                   type=int,
+                   nargs='+',
+                   default=[0, 65536, 8192],
+                   help="Session caps to compare (0 for none).")
+    p.add_argument('--max-per-source',
+                   type=int,
+                   default=16,
+                   help="Per-source session cap.")
+
+    p = sub.add_parser('reload',
+                       help="Client config reload time with one changed file.")
+    p.add_argument('--clients',
+                   type=int,
+                   nargs='+',
+                   default=[100, 1000, 10000],
+                   help="Client counts.")
+
+    p = sub.add_parser('shard',
+                       help="Knock dispatch throughput with the knocks sharded over worker processes.")
+    p.add_argument('--clients',
+                   type=int,
+                   default=1000,
+                   help="Number of clients.")
+    p.add_argument('--packets',
+                   type=int,
+                   default=200000,
+                   help="Number of packets, mostly noise from random sources.")
+    p.add_argument('--workers',
+                   type=int,
+                   nargs='+',
+                   default=[1, 2, 4],
+                   help="Worker process counts.")
+
+    p = sub.add_parser('startup',
+                       help="Client config load and client setup time at listener startup.")
+    p.add_argument('--clients',
+                   type=int,
+                   nargs='+',
+                   default=[100, 1000, 10000],
+                   help="Client counts.")
+
+    p = sub.add_parser('logging',
+                       help="Per-packet logging cost, with the level disabled and with a slow handler.")
+    p.add_argument('--calls',
+                   type=int,
+                   default=200000,
+                   help="Number of disabled debug calls to time.")
+    p.add_argument('--records',
+                   type=int,
+                   default=1000,
+                   help="Number of records to log to the slow handler.")
+    p.add_argument('--delay',
+                   type=float,
+                   default=0.0002,
+                   help="Seconds the slow handler takes per record.")
+
+    args = argp.parse_args(argv[1:])
+    logger = log.Log("warning", False)
+
+    if args.bench == 'dispatch':
+        bench_dispatch(args, logger)
+    elif args.bench == 'match':
+        bench_match(args, logger)
+    elif args.bench == 'suite':
+        bench_suite(args, logger)
+    elif args.bench == 'flood':
+        bench_flood(args, logger)
+    elif args.bench == 'shard':
+        bench_shard(args, logger)
+    elif args.bench == 'startup':
+        bench_startup(args, logger)
+    elif args.bench == 'reload':
+        bench_reload(args, logger)
+    elif args.bench == 'logging':
+        bench_logging(args, logger)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import argparse
+import asyncio
 import os
 import socket
 import sys
@@ -9,66 +10,283 @@ import time
 import knockutil
 #import pyotp
 
-def get_totp():
+TOTP_STEP = 30
+
+def get_totp(secret=None, step=None):
     import pyotp
-    secret = os.environ.get('KNOCK_SECRET', None)
+    if secret is None:
+        secret = os.environ.get('KNOCK_SECRET', None)
     if secret is None:
         print("KNOCK_SECRET environment variable not set.", file=sys.stderr)
         return None
     p = pyotp.TOTP(secret)
+    if step is not None:
+        return p.at(step * TOTP_STEP)
     return p.now()
 
-def open_udpsocket():
-    return socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+def open_udpsocket(family=socket.AF_INET):
+    return socket.socket(family, socket.SOCK_DGRAM)
+
+
+# Host file: one host per line, optionally followed by settings for that
+# host, e.g.,
+#   bastion1.example.com
+#   bastion2.example.com pin=1234 cnt=4 secret=JBSWY3DPEHPK3PXP wait=22
+# Settings not given come from the command line. Blank lines and lines
+# starting with '#' are skipped.
+def read_host_file(path):
+    targets = []
+    with open(path) as f:
+        for line in f:
+            fields = line.split()
+            if not fields or fields[0].startswith('#'):
+                continue
+            target = {'host': fields[0]}
+            for field in fields[1:]:
+                key, sep, value = field.partition('=')
+                if not sep or key not in ('pin', 'cnt', 'secret', 'wait'):
+                    raise ValueError(f"{path}: bad setting '{field}' for {fields[0]}")
+                target[key] = value
+            targets.append(target)
+    return targets
+
+
+# Knocks for many hosts. Hosts that share a secret, pin and count share the
+# totp and port computation, and each host name is only looked up once, with
+# all the lookups running at the same time. A host is knocked at the first
+# address its lookup returns, IPv4 or IPv6.
+#
+# Knock-and-wait: for a target with a 'wait' port, after knocking the port
+# is probed with TCP connects until it accepts one or probe_timeout passes.
+# If it doesn't open, the target is knocked again at the start of the next
+# totp step, with that step's sequence, until deadline seconds after the
+# start. The result then says how long the port took to open, overall and
+# after the last knock of the sequence that opened it (i.e., roughly the
+# listener's capture and firewall latency).
+class MultiKnock:
+    # a connect attempt waits this long for an answer
+    connect_timeout = 0.5
+
+    def __init__(self, gap=0.5, probe_timeout=5, probe_interval=0.1, deadline=90):
+        self.gap = gap
+        self.probe_timeout = probe_timeout
+        self.probe_interval = probe_interval
+        self.deadline = deadline
+        self.otps = {}
+        self.sequences = {}
+        self.ips = {}
+
 
+    def otp(self, secret, step=None):
+        if (secret, step) not in self.otps:
+            self.otps[(secret, step)] = get_totp(secret, step)
+        return self.otps[(secret, step)]
 
-def send_knock(sock, ip, port, len):
-    msg = bytes(len)
-    sock.sendto(msg, (ip, port))
 
+    def sequence(self, otp, pin, cnt):
+        key = (otp, pin, int(cnt))
+        if key not in self.sequences:
+            self.sequences[key] = knockutil.calc_ports_lengths(otp, pin, cnt)
+        return self.sequences[key]
 
-def get_ip(host):
-    return socket.gethostbyname(host)
+
+    async def resolve(self, hosts):
+        loop = asyncio.get_running_loop()
+        hosts = [h for h in dict.fromkeys(hosts) if h not in self.ips]
+        results = await asyncio.gather(*(loop.getaddrinfo(h, None, family=socket.AF_UNSPEC,
+                                                          type=socket.SOCK_DGRAM)
+                                         for h in hosts),
+                                       return_exceptions=True)
+        for host, res in zip(hosts, results):
+            # an exception is kept too, so it's reported for each target
+            self.ips[host] = res if isinstance(res, Exception) else res[0][4][0]
+
+
+    # One socket for each address family that's knocked, opened when first
+    # needed
+    def udpsocket(self, socks, ip):
+        family = socket.AF_INET6 if ':' in ip else socket.AF_INET
+        if family not in socks:
+            sock = open_udpsocket(family)
+            sock.setblocking(False)
+            socks[family] = sock
+        return socks[family]
+
+
+    async def knock(self, sock, ip, ports, lengths):
+        loop = asyncio.get_running_loop()
+        for i, (port, msg_len) in enumerate(zip(ports, lengths)):
+            if i:
+                await asyncio.sleep(self.gap)
+            await loop.sock_sendto(sock, bytes(msg_len), (ip, port))
+
+
+    async def probe(self, ip, port, timeout):
+        # Returns the time the port accepted a connection, or None
+        loop = asyncio.get_running_loop()
+        end = loop.time() + timeout
+        while loop.time() < end:
+            try:
+                conn = asyncio.open_connection(ip, port)
+                reader, writer = await asyncio.wait_for(conn, self.connect_timeout)
+                writer.close()
+                return time.perf_counter()
+            except (OSError, asyncio.TimeoutError):
+                # a refused connect comes back right away
+                await asyncio.sleep(self.probe_interval)
+        return None
+
+
+    async def knock_and_wait(self, sock, target, ip, result, start):
+        port = int(target['wait'])
+        otp = target['otp']
+        while True:
+            result['attempts'] += 1
+            ports, lengths = self.sequence(otp, target['pin'], target['cnt'])
+            await self.knock(sock, ip, ports, lengths)
+            knocked = time.perf_counter()
+            left = self.deadline - (knocked - start)
+            opened = await self.probe(ip, port, min(self.probe_timeout, max(0, left)))
+            if opened:
+                result['open_seconds'] = opened - start
+                result['after_knock'] = opened - knocked
+                return True
+
+            if target['secret'] is None and 'KNOCK_SECRET' not in os.environ:
+                result['error'] = f"port {port} not open (can't knock again with --otp)"
+                return False
+            # the next sequence is good from the start of the next totp step
+            step = int(time.time()) // TOTP_STEP + 1
+            wait = step * TOTP_STEP - time.time()
+            if time.perf_counter() + wait - start >= self.deadline:
+                result['error'] = f"port {port} not open after {result['attempts']} attempts"
+                return False
+            await asyncio.sleep(wait)
+            otp = self.otp(target['secret'], step)
+
+
+    async def knock_target(self, socks, target, start):
+        # Returns the target's result:
+        #   {host, ip, ok, error, seconds, attempts, open_seconds, after_knock}
+        result = dict(host=target['host'], ip=None, ok=False, error=None,
+                      attempts=0, open_seconds=None, after_knock=None)
+        ip = self.ips[target['host']]
+        if isinstance(ip, Exception):
+            result['error'] = f"lookup failed: {ip}"
+        elif target['otp'] is None:
+            result['error'] = "no one-time-password"
+        else:
+            result['ip'] = ip
+            try:
+                sock = self.udpsocket(socks, ip)
+                if target.get('wait'):
+                    result['ok'] = await self.knock_and_wait(sock, target, ip, result, start)
+                else:
+                    result['attempts'] = 1
+                    ports, lengths = self.sequence(target['otp'], target['pin'], target['cnt'])
+                    await self.knock(sock, ip, ports, lengths)
+                    result['ok'] = True
+            except OSError as e:
+                result['error'] = str(e)
+        result['seconds'] = time.perf_counter() - start
+        return result
+
+
+    async def run(self, targets):
+        start = time.perf_counter()
+        for t in targets:
+            if t['otp'] is None:
+                t['otp'] = self.otp(t['secret'])
+        await self.resolve([t['host'] for t in targets])
+
+        socks = {}
+        try:
+            return await asyncio.gather(*(self.knock_target(socks, t, start) for t in targets))
+        finally:
+            for sock in socks.values():
+                sock.close()
+
+
+def print_results(results):
+    for r in results:
+        if not r['ok']:
+            status = f"failed: {r['error']}"
+        elif r['open_seconds'] is not None:
+            status = f"open after {r['open_seconds'] * 1000:.1f} ms " + \
+                     f"({r['after_knock'] * 1000:.1f} ms after the last knock, " + \
+                     f"attempt {r['attempts']})"
+        else:
+            status = 'ok'
+        print(f"{r['host']:<30} {r['ip'] or '-':<15} {r['seconds'] * 1000:>8.1f} ms  {status}")
 
 
 def main(argv):
-    print(argv)
     argp = argparse.ArgumentParser(prog='knockclient',
                                    description='Knock to open port(s).')
     argp.add_argument('-p',
-                      '--pin', 
+                      '--pin',
                       required=False,
                       default='',
                       help="Pin value.")
     argp.add_argument('--host',
-                      required=True,
-                      help="Hostname or IP address of host to contact.")
+                      required=False,
+                      action='append',
+                      default=[],
+                      help="Hostname or IP address of host to contact. Can be given " + \
+                        "more than once; the hosts are knocked at the same time.")
+    argp.add_argument('--host-file',
+                      required=False,
+                      default=None,
+                      help="File listing hosts to contact, one per line, optionally " + \
+                        "with pin=, cnt= and secret= settings for that host.")
     argp.add_argument('--cnt',
                       required=False,
                       default=3,
-                      help="Hostname or IP address of host to contact.")
+                      help="Number of knocks in the sequence.")
     argp.add_argument("--otp",
                       required=False,
                       default=None,
                       help="One-time-password. If otp not present, use " \
                         "authenticator key in KNOCK_SECRET environment variable.")
+    argp.add_argument('--gap',
+                      type=float,
+                      default=0.5,
+                      help="Seconds between the knocks of a sequence.")
+    argp.add_argument('--wait',
+                      type=int,
+                      default=None,
+                      metavar='PORT',
+                      help="After knocking, wait for this TCP port to accept connections, " + \
+                        "knocking again with the next TOTP step's sequence if it doesn't.")
+    argp.add_argument('--probe-timeout',
+                      type=float,
+                      default=5,
+                      help="Seconds to wait for the port to open after each knock sequence.")
+    argp.add_argument('--deadline',
+                      type=float,
+                      default=90,
+                      help="Seconds to keep trying for the port to open, in all.")
+
+    v = argp.parse_args(argv[1:])
 
-    v = argp.parse_args()
-    print(v)
+    targets = [{'host': h} for h in v.host]
+    if v.host_file:
+        targets += read_host_file(v.host_file)
+    if not targets:
+        argp.error("no hosts given, use --host or --host-file")
 
-    if v.otp is None:
-        v.otp = get_totp()
-    ports, lengths = knockutil.calc_ports_lengths(v.otp, v.pin, v.cnt)
-    print(f"ports={ports} lengths={lengths}")
-    sock = open_udpsocket()
-    ip = get_ip(v.host)
-    cnt = int(v.cnt)
+    for t in targets:
+        t.setdefault('pin', v.pin)
+        t.setdefault('cnt', v.cnt)
+        t.setdefault('wait', v.wait)
+        # a host's own secret wins over --otp
+        t['otp'] = v.otp if 'secret' not in t else None
+        t.setdefault('secret', None)
 
-    for i in range(0, cnt):
-        print(f"sending {lengths[i]} bytes to {ports[i]}")
-        send_knock(sock, ip, ports[i], lengths[i])
-        if i < cnt-1:
-            time.sleep(0.5)
+    mk = MultiKnock(v.gap, v.probe_timeout, deadline=v.deadline)
+    results = asyncio.run(mk.run(targets))
+    print_results(results)
+    return 0 if all(r['ok'] for r in results) else 1
 
 if __name__ == '__main__':
-    main(sys.argv)
+    sys.exit(main(sys.argv))
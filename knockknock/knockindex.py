@@ -0,0 +1,125 @@
+# Dispatch index shared by all clients.
+#
+# Rather than handing every captured packet to every KnockTrack object, the
+# index maps each expected (dport, len) pair to the clients whose current or
+# previous knock sequence contains it. A packet then only touches the clients
+# it could actually belong to, so the per-packet cost no longer grows with the
+# number of configured clients.
+#
+# index: { (dport, len): [ (step, ktrack, kd), ... ], ... }
+#
+#   step   - position of (dport, len) in the knock sequence (0 = first knock)
+#   ktrack - KnockTrack object for the client
+#   kd     - TotpMgr knock_data the entry was generated from
+#
+# client_entries: { ktrack: [ (kd, [key, ...]), ... ], ... }
+#
+# sessions is the SessionStore shared by the clients in the index. limiter,
+# if set, is the ratelimit.RateLimiter every knock goes through first.
+
+import time
+
+import metrics
+import sessionstore
+
+
+class KnockIndex:
+    def __init__(self, logger, sessions=None, limiter=None):
+        self.logger = logger
+        self.sessions = sessions if sessions is not None else sessionstore.SessionStore()
+        self.limiter = limiter
+        self.index = {}
+        self.client_entries = {}
+        self.clients = []
+
+
+    def add_client(self, kt, epoch):
+        self.clients.append(kt)
+        self.update(kt, epoch)
+
+
+    def rotate_totp(self, epoch):
+        # Called by the listener's Housekeeper at the start of each totp step
+        for kt in self.clients:
+            if kt.totp_mgr.rotate_totp():
+                self.update(kt, epoch)
+
+
+    def add_knock_data(self, kt, kd):
+        keys = []
+        for step, key in enumerate(zip(kd['ports'], kd['lens'])):
+            self.index.setdefault(key, []).append((step, kt, kd))
+            keys.append(key)
+        self.client_entries.setdefault(kt, []).append((kd, keys))
+
+
+    def remove_knock_data(self, kt, kd, keys):
+        for key in keys:
+            entries = self.index.get(key)
+            if not entries:
+                continue
+            entries[:] = [e for e in entries if not (e[1] is kt and e[2] is kd)]
+            if not entries:
+                del self.index[key]
+
+
+    def update(self, kt, epoch):
+        # Called when the client's TOTP rotates. Index any knock data that is
+        # new and retire knock data that no in-progress session can still be
+        # using, i.e., past its expiration plus the knock expiration.
+        live = kt.totp_mgr.live_knock_data()
+        entries = self.client_entries.get(kt, [])
+
+        for kd in live:
+            if kd['ports'] and not any(kd is e[0] for e in entries):
+                self.add_knock_data(kt, kd)
+
+        entries = self.client_entries.get(kt, [])
+        keep = []
+        for kd, keys in entries:
+            if not any(kd is l for l in live) and epoch > kd['expiration'] + kt.knock_expiration:
+                self.remove_knock_data(kt, kd, keys)
+            else:
+                keep.append((kd, keys))
+        self.client_entries[kt] = keep
+
+
+    def remove_client(self, kt):
+        if kt in self.clients:
+            self.clients.remove(kt)
+        self.sessions.remove_client(kt)
+        for kd, keys in self.client_entries.pop(kt, []):
+            self.remove_knock_data(kt, kd, keys)
+
+
+    def lookup(self, dport, msg_len):
+        return self.index.get((dport, msg_len), [])
+
+
+    def dispatch(self, knock):
+        # Every packet in the knock range counts toward the rate limit, not
+        # just those that hit the index: spraying the range is the abuse.
+        if self.limiter and not self.limiter.allow(knock.saddr, knock.ts):
+            return
+        entries = self.index.get((knock.dport, knock.len))
+        if not entries:
+            return
+        # Only knocks that hit the index are timed; noise never gets here.
+        start = time.perf_counter()
+        metrics.index_hits.value += 1
+
+        source_ip = knock.saddr
+        # A client can be in the same bucket more than once (e.g., the same
+        # port/len pair in the current and previous sequence), but must only
+        # see the knock once.
+        handled = set()
+        for step, kt, kd in entries:
+            if kt in handled:
+                continue
+            # A knock past the first can only matter if there's an
+            # in-progress session from this source.
+            if step and not kt.sessions.has_source(source_ip):
+                continue
+            handled.add(kt)
+            kt.process_knock(knock)
+        metrics.process_seconds.observe(time.perf_counter() - start)
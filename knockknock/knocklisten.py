@@ -1,14 +1,25 @@
 #!/usr/bin/env python3
 
 import argparse
+import asyncio
 import os
 import sys
 import time
 
+import capture
+import clientreload
+import clock
 import config
 import firewall
+import knockindex
 import knocktrack
 import log
+import metrics
+import ratelimit
+import scheduler
+import sessionstore
+import shard
+import statestore
 import tcpdump
 
 
@@ -24,51 +35,213 @@ def create_pidfile(cfg, logger):
     pf.close()
 
 
+def setup_clients(cfg, logger, fw, clk=None):
+    clk = clk or clock.Clock()
+    sessions = sessionstore.SessionStore(cfg.listener.max_sessions,
+                                         cfg.listener.max_sessions_per_source)
+    limiter = None
+    if cfg.listener.rate_limit > 0:
+        limiter = ratelimit.RateLimiter(logger, cfg.listener.rate_limit,
+                                        cfg.listener.rate_limit_burst, cfg.listener.block_time)
+    kindex = knockindex.KnockIndex(logger, sessions, limiter)
+    # Create one knocktrack object for each client
+    for clicfg in cfg.clients:
+        logger.debug("clicfg.name = '{}'".format(clicfg.name))
+        kt = knocktrack.KnockTrack(cfg, clicfg, logger, fw, clk, sessions)
+        kindex.add_client(kt, int(clk.time()))
+    return kindex
+
+
 def main_loop(cfg, logger):
 
     fw = firewall.Firewall(cfg, logger)
 
-    td = tcpdump.Tcpdump(cfg, logger)
-
-    ktrack = []
-    # Create one knocktrack object for each client
-    for clicfg in cfg.clients:
-        logger.debug("clicfg.name = '{}'".format(clicfg.name))
-        kt = knocktrack.KnockTrack(cfg, clicfg, logger, fw)
-        ktrack.append(kt)
+    # Wake at least every second for housekeeping and rule expiry
+    td = tcpdump.open_capture(cfg, logger, timeout=1)
 
-    next_fw_rule_check = 0
-    knock_housekeeping_due = int(time.time()) + 5
+    kindex = setup_clients(cfg, logger, fw)
+    metrics.track_listener(kindex, fw)
+    state = statestore.open_state(cfg, logger)
+    if state:
+        state.restore(kindex, fw, int(time.time()))
+    reloader = clientreload.ClientReloader(cfg, logger, kindex, fw, clock.Clock())
+    reloader.install_signal_handler()
+    housekeeper = scheduler.Housekeeper(kindex, fw, time.time(), td, reloader=reloader,
+                                        state=state)
 
     try:
         while True:
             # line = next(tail)
             line = td.tail()
-            current_epoch = int(time.time())
+            # Housekeeping, once per second
+            housekeeper.tick(int(time.time()))
+
             if line:
                 # entry = ul.match(line)
                 entry = td.match(line)
                 if entry:
-                    logger.debug('Log line entry: {}'.format(entry))
-                    for k in ktrack:
-                        k.process_knock(entry)
-                    # do housekeeping at least every 5 seconds
-                    knock_housekeeping_due = current_epoch + 5
-
-            # Housekeeping
-            if next_fw_rule_check <= current_epoch:
-                next_fw_rule_check = fw.remove_expired_rules()
-            # knock track housekeeping is run on every process_knock, but do this
-            # in case there are no knocks to process
-            if current_epoch > knock_housekeeping_due:
-                for k in ktrack:
-                    k.housekeeping()
+                    logger.debug('Log line entry: %s', entry)
+                    kindex.dispatch(entry)
     except Exception as e:
         logger.critical(e)
         raise e
     finally:
+        reloader.close()
         logger.info("Attempting to add failopen rules if enabled.")
         fw.add_failopen_rules()
+        if state:
+            state.close()
+
+
+async def async_main_loop(cfg, logger):
+    loop = asyncio.get_running_loop()
+
+    fw = firewall.AsyncFirewall(cfg, logger)
+
+    td = tcpdump.open_capture(cfg, logger, timeout=1)
+
+    kindex = setup_clients(cfg, logger, fw)
+    metrics.track_listener(kindex, fw)
+    state = statestore.open_state(cfg, logger)
+    if state:
+        state.restore(kindex, fw, int(time.time()))
+    reloader = clientreload.ClientReloader(cfg, logger, kindex, fw, clock.Clock())
+    reloader.install_signal_handler()
+    housekeeper = scheduler.Housekeeper(kindex, fw, time.time(), td, reloader=reloader,
+                                        state=state)
+
+    # set with the exception that stops the listener
+    failed = loop.create_future()
+
+    def fail(e):
+        if not failed.done():
+            failed.set_exception(e)
+
+    def process(item):
+        entry = td.match(item)
+        if entry:
+            logger.debug('Log line entry: %s', entry)
+            housekeeper.tick(int(time.time()))
+            kindex.dispatch(entry)
+
+    def on_readable():
+        try:
+            for item in td.read_available():
+                process(item)
+        except Exception as e:
+            fail(e)
+
+    async def threaded_capture():
+        # for capture backends that can only be read with blocking tail()
+        while True:
+            item = await loop.run_in_executor(None, td.tail)
+            if item:
+                process(item)
+
+    async def housekeeping_timer():
+        while True:
+            housekeeper.tick(int(time.time()))
+            # wake at the start of each second
+            await asyncio.sleep(1 - time.time() % 1)
+
+    tasks = [loop.create_task(housekeeping_timer())]
+    fd = td.async_fd()
+    if fd is None:
+        tasks.append(loop.create_task(threaded_capture()))
+    else:
+        loop.add_reader(fd, on_readable)
+
+    for t in tasks:
+        t.add_done_callback(lambda t: t.cancelled() or fail(t.exception()))
+
+    try:
+        await failed
+    except Exception as e:
+        logger.critical(e)
+        raise e
+    finally:
+        if fd is not None:
+            loop.remove_reader(fd)
+        for t in tasks:
+            t.cancel()
+        reloader.close()
+        logger.info("Attempting to add failopen rules if enabled.")
+        fw.add_failopen_rules()
+        if state:
+            state.close()
+        await fw.drain()
+
+
+# Knocks from a pcap file or from tcpdump -tt output
+def read_replay_knocks(path, td):
+    with open(path, "rb") as f:
+        is_pcap = f.read(4) in capture.PCAP_MAGIC
+        f.seek(0)
+        if is_pcap:
+            for ts, pkt in capture.read_pcap(f):
+                knock = capture.decode_packet(pkt, ts)
+                if knock:
+                    yield knock
+        else:
+            for line in f:
+                knock = td.match(line.decode(errors='replace'))
+                if knock:
+                    yield knock
+
+
+def replay_advance(housekeeper, fw, vclock, epoch):
+    # Live, housekeeping runs every second. Replay runs it at packet times,
+    # so after a gap first step through the start of the previous and the
+    # current totp windows to set up the same two totp steps as live.
+    # Expired rules are removed at their expiry time.
+    window = epoch - epoch % 30
+    for t in (window - 30, window, epoch):
+        if t <= housekeeper.last_tick:
+            continue
+        next_fw_rule_check = fw.remove_expired_rules()
+        while next_fw_rule_check <= t:
+            vclock.advance_to(next_fw_rule_check)
+            next_fw_rule_check = fw.remove_expired_rules()
+        vclock.advance_to(t)
+        housekeeper.tick(t)
+
+
+# Run recorded traffic through the same match -> process_knock path as the
+# listener, on a clock driven by packet timestamps and with a firewall that
+# only records what it would have done.
+def replay(cfg, logger, path):
+    vclock = clock.VirtualClock()
+    fw = firewall.RecordingFirewall(cfg, logger, vclock)
+    td = tcpdump.Tcpdump(cfg, logger, start=False)
+    kindex = None
+
+    knock_cnt = 0
+    start = time.perf_counter()
+    for knock in read_replay_knocks(path, td):
+        if kindex is None:
+            # totp managers set up their first totp step when created
+            vclock.advance_to(knock.ts)
+            kindex = setup_clients(cfg, logger, fw, vclock)
+            metrics.track_listener(kindex, fw)
+            housekeeper = scheduler.Housekeeper(kindex, fw, knock.ts, background=False)
+        replay_advance(housekeeper, fw, vclock, knock.ts)
+        kindex.dispatch(knock)
+        knock_cnt += 1
+    elapsed = time.perf_counter() - start
+
+    # let the rules that are still open expire
+    while fw.expiry:
+        vclock.advance_to(fw.expiry[0][0] + 1)
+        fw.remove_expired_rules()
+
+    opened = [(t, r) for t, action, r in fw.history if action == 'add']
+    print(f"Replayed {knock_cnt} knock packets in {elapsed:.3f}s " +
+          f"({knock_cnt / elapsed if elapsed else 0:,.0f}/s)")
+    print(f"Firewall rules added: {len(opened)}")
+    for t, action, r in fw.history:
+        ts = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(t))
+        port_str = f"{r.port}" + (f"/{r.proto}" if r.proto else "")
+        print(f"  {ts}Z {action:<6} {r.kind:<5} {r.id or '-'} {r.src_ip} {port_str}")
 
 
 def main(argv):
@@ -81,24 +254,51 @@ def main(argv):
                       required=False,
                       default="/etc/knockknock/knock.toml",
                       help="Path to global configuration file.")
+    argp.add_argument('--replay',
+                      required=False,
+                      default=None,
+                      metavar='FILE',
+                      help="Replay recorded traffic (pcap file or tcpdump -tt output) " + \
+                        "instead of listening. No firewall changes are made.")
 
     args = argp.parse_args()
 
     # load config
     cfg = config.Config(args.config_file, tmp_logger)
     # initialize logger
-    logger = log.Log(cfg.logging.log_level, cfg.logging.syslog)
+    logger = log.Log(cfg.logging.log_level, cfg.logging.syslog, cfg.logging.queued)
     tmp_logger = None
 
+    # runs alongside either loop, and for replay so the counts can be checked
+    exporter = metrics.Exporter(cfg, logger)
+    exporter.start()
+
+    if args.replay:
+        try:
+            replay(cfg, logger, args.replay)
+        finally:
+            exporter.stop()
+            logger.close()
+        return
+
     create_pidfile(cfg, logger)
     try:
-        main_loop(cfg, logger)
+        if cfg.listener.workers > 0:
+            if cfg.listener.state_dir:
+                logger.warning("Listener state isn't saved with workers > 0.")
+            shard.run(cfg, logger, setup_clients)
+        elif cfg.listener.event_loop == 'asyncio':
+            asyncio.run(async_main_loop(cfg, logger))
+        else:
+            main_loop(cfg, logger)
     except:
         # bare except because we want to try to remove the PID file
         # no matter what error we've encountered
         raise
     finally:
+        exporter.stop()
         os.remove(cfg.listener.pidfile)
+        logger.close()
 
 
 if __name__ == '__main__':
@@ -1,5 +1,26 @@
+from collections.abc import Mapping
+import copy
 import logging
 import logging.handlers
+import os
+import queue
+
+
+# QueueHandler that leaves formatting to the listener thread. The stdlib one
+# formats the message in the caller (prepare()), for queues that go to
+# another process. Here the record stays in the process, so the caller only
+# copies the logged arguments that could change before the record is
+# written, e.g., a session dict.
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    mutable = (dict, list, set)
+
+    def prepare(self, record):
+        args = record.args
+        if isinstance(args, Mapping):
+            record.args = dict(args)
+        elif args:
+            record.args = tuple(copy.copy(a) if isinstance(a, self.mutable) else a for a in args)
+        return record
 
 
 class Log:
@@ -14,7 +35,14 @@ class Log:
                       "ERROR": logging.ERROR,
                       "CRITICAL": logging.CRITICAL }
     
-    def __init__(self, log_level, to_syslog=True):
+    # queued Logs, to restart their listener threads in a forked child
+    queued_logs = []
+
+    # queued=True puts log records on a queue and has a thread format them
+    # and hand them to the syslog/stderr handler, so neither formatting nor a
+    # slow or blocked syslog holds up knock processing (see
+    # DeferredQueueHandler). close() writes out what's queued.
+    def __init__(self, log_level, to_syslog=True, queued=False):
         self.log_level = self.custom_levels.get(log_level.upper(), logging.WARNING)
         #self.prefix = "[KNOCK {level}] "
         self.logger = logging.getLogger("knock-knock")
@@ -30,7 +58,36 @@ class Log:
         formatter = logging.Formatter('%(name)s: %(levelname)s %(message)s')
 
         handler.setFormatter(formatter)
-        self.logger.addHandler(handler)
+        self.handler = handler
+        self.listener = None
+        if queued:
+            self.start_listener()
+            Log.queued_logs.append(self)
+        else:
+            self.logger.addHandler(handler)
+
+
+    def start_listener(self):
+        # Also run in a forked child, where the parent's listener thread
+        # doesn't exist; the child gets its own queue and thread.
+        q = queue.SimpleQueue()
+        for handler in list(self.logger.handlers):
+            self.logger.removeHandler(handler)
+        self.logger.addHandler(DeferredQueueHandler(q))
+        self.listener = logging.handlers.QueueListener(q, self.handler)
+        self.listener.start()
+
+
+    def close(self):
+        # Writes out the queued records. Anything logged after this is
+        # written right away.
+        if self.listener:
+            self.listener.stop()
+            self.listener = None
+            Log.queued_logs.remove(self)
+            for handler in list(self.logger.handlers):
+                self.logger.removeHandler(handler)
+            self.logger.addHandler(self.handler)
 
 
     def set_level(self, log_level):
@@ -43,6 +100,12 @@ class Log:
         return cls.level_names.get(log_level, None)
 
 
+    # For guarding log calls whose arguments are costly to build:
+    #   if logger.isEnabledFor(logging.DEBUG): ...
+    def isEnabledFor(self, level):
+        return self.logger.isEnabledFor(level)
+
+
     def critical(self, msg, *args, **kwargs):
         self.logger.critical(msg, *args, **kwargs)
 
@@ -57,3 +120,18 @@ class Log:
 
     def debug(self, msg, *args, **kwargs):
         self.logger.debug(msg, *args, **kwargs)
+
+
+# For forked children, which end without running the parent's cleanup
+def close_queued():
+    for l in list(Log.queued_logs):
+        l.close()
+
+
+def _after_fork_in_child():
+    for l in Log.queued_logs:
+        if l.listener:
+            l.start_listener()
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
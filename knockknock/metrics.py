@@ -0,0 +1,265 @@
+from bisect import bisect_left
+import http.server
+import os
+import socketserver
+import threading
+
+
+# Listener metrics
+#
+# Counters, gauges and histograms are module level objects, so code on the
+# packet path updates them with a plain attribute increment and doesn't need
+# a metrics object passed around. Everything is rendered in the Prometheus
+# text format, served by Exporter and/or written to a snapshot file.
+#
+# Updates aren't locked. They happen on the listener thread, and a scrape
+# from the exporter thread at worst reads a value one update old.
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def samples(self):
+        return [(self.name, self.value)]
+
+
+# The value is read from fn, if set, when rendered
+class Gauge:
+    kind = 'gauge'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.fn = None
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, fn):
+        self.fn = fn
+
+    def samples(self):
+        return [(self.name, self.fn() if self.fn else self.value)]
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.bounds = sorted(buckets)
+        # last count is the +Inf bucket
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, v):
+        self.counts[bisect_left(self.bounds, v)] += 1
+        self.sum += v
+
+    def samples(self):
+        samples = []
+        total = 0
+        for bound, cnt in zip(self.bounds + ['+Inf'], list(self.counts)):
+            total += cnt
+            samples.append((f'{self.name}_bucket{{le="{bound}"}}', total))
+        samples.append((f'{self.name}_sum', self.sum))
+        samples.append((f'{self.name}_count', total))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help):
+        return self.register(Counter(name, help))
+
+    def gauge(self, name, help):
+        return self.register(Gauge(name, help))
+
+    def histogram(self, name, help, buckets):
+        return self.register(Histogram(name, help, buckets))
+
+    # Counter and histogram counts as a flat list of numbers, for adding one
+    # process's counts to another's (see shard.py). Gauges aren't included.
+    def totals(self):
+        totals = []
+        for m in self.metrics:
+            if m.kind == 'counter':
+                totals.append(m.value)
+            elif m.kind == 'histogram':
+                totals += m.counts
+                totals.append(m.sum)
+        return totals
+
+    def add_totals(self, totals):
+        pos = 0
+        for m in self.metrics:
+            if m.kind == 'counter':
+                m.value += int(totals[pos])
+                pos += 1
+            elif m.kind == 'histogram':
+                for i in range(len(m.counts)):
+                    m.counts[i] += int(totals[pos + i])
+                pos += len(m.counts)
+                m.sum += totals[pos]
+                pos += 1
+
+    def render(self):
+        lines = []
+        for m in self.metrics:
+            lines.append(f"# HELP {m.name} {m.help}")
+            lines.append(f"# TYPE {m.name} {m.kind}")
+            for name, value in m.samples():
+                lines.append(f"{name} {value}")
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+# Seconds, from a fast ufw call to a slow iptables-restore
+FIREWALL_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Seconds to process a knock that hits the dispatch index
+KNOCK_BUCKETS = (1e-6, 5e-6, 1e-5, 5e-5, 1e-4, 5e-4, 1e-3, 5e-3, 0.01, 0.05)
+
+packets_captured = REGISTRY.counter('knock_packets_captured_total',
+                                    "Packets (or tcpdump lines) read from the capture backend.")
+packets_parsed = REGISTRY.counter('knock_packets_parsed_total',
+                                  "Captured packets parsed into knocks.")
+parse_misses = REGISTRY.counter('knock_parse_misses_total',
+                                "Captured packets (or tcpdump lines) that didn't parse as a knock.")
+index_hits = REGISTRY.counter('knock_index_hits_total',
+                              "Knocks whose port and length matched some client's sequence.")
+first_knocks = REGISTRY.counter('knock_first_knocks_total',
+                                "Knocks that matched the first knock of a client's sequence.")
+sequences_completed = REGISTRY.counter('knock_sequences_completed_total',
+                                       "Completed knock sequences, i.e., doors opened.")
+sessions_expired = REGISTRY.counter('knock_sessions_expired_total',
+                                    "Knock sessions that expired before completing.")
+sessions_evicted = REGISTRY.counter('knock_sessions_evicted_total',
+                                    "Knock sessions evicted because the session table was full.")
+sessions_evicted_per_source = REGISTRY.counter('knock_sessions_evicted_per_source_total',
+                                               "Knock sessions evicted because their source had too many.")
+rate_limited = REGISTRY.counter('knock_rate_limited_total',
+                                "Packets dropped by the per-source rate limit in the listener.")
+sources_blocked = REGISTRY.counter('knock_sources_blocked_total',
+                                   "Sources blocked for going over the rate limit.")
+process_seconds = REGISTRY.histogram('knock_process_seconds',
+                                     "Time to process a knock that matched the dispatch index.",
+                                     KNOCK_BUCKETS)
+firewall_commands = REGISTRY.counter('knock_firewall_commands_total',
+                                     "Firewall (ufw, iptables, ipset) commands run.")
+firewall_errors = REGISTRY.counter('knock_firewall_command_errors_total',
+                                   "Firewall commands that returned an error.")
+firewall_seconds = REGISTRY.histogram('knock_firewall_command_seconds',
+                                      "Firewall command duration.", FIREWALL_BUCKETS)
+sessions = REGISTRY.gauge('knock_sessions', "In-progress knock sessions.")
+firewall_rules = REGISTRY.gauge('knock_firewall_rules', "Firewall rules added by knock.")
+clients = REGISTRY.gauge('knock_clients', "Configured clients.")
+blocked_sources = REGISTRY.gauge('knock_blocked_sources', "Sources currently blocked.")
+
+
+# Gauges that read listener state when rendered
+def track_listener(kindex, fw):
+    sessions.set_function(lambda: len(kindex.sessions))
+    firewall_rules.set_function(lambda: len(fw.rules))
+    clients.set_function(lambda: len(kindex.clients))
+    if kindex.limiter:
+        blocked_sources.set_function(lambda: len(kindex.limiter.blocked))
+
+
+def write_snapshot(path, registry=REGISTRY):
+    # write and rename, so readers never see a partial file
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        f.write(registry.render())
+    os.replace(tmp, path)
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = self.server.registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # don't log every scrape
+        pass
+
+
+class UnixHTTPServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+        super().server_bind()
+
+
+# Serves the metrics over HTTP and writes the snapshot file, both from
+# daemon threads so the listener loop is never involved.
+#   listen: "host:port", "unix:/path/to/socket" or "" (no endpoint)
+class Exporter:
+    def __init__(self, cfg, logger, registry=REGISTRY):
+        self.logger = logger
+        self.registry = registry
+        self.listen = cfg.metrics.listen
+        self.snapshot_file = cfg.metrics.snapshot_file
+        self.snapshot_interval = cfg.metrics.snapshot_interval
+        self.server = None
+        self.stopped = threading.Event()
+
+
+    def start(self):
+        if self.listen:
+            if self.listen.startswith('unix:'):
+                self.server = UnixHTTPServer(self.listen[5:], MetricsHandler)
+            else:
+                host, _, port = self.listen.rpartition(':')
+                self.server = http.server.ThreadingHTTPServer((host or '127.0.0.1', int(port)),
+                                                              MetricsHandler)
+            self.server.registry = self.registry
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+            self.logger.info(f"Serving metrics on {self.listen}")
+
+        if self.snapshot_file:
+            threading.Thread(target=self.snapshot_loop, daemon=True).start()
+
+
+    def snapshot_loop(self):
+        while not self.stopped.wait(self.snapshot_interval):
+            self.snapshot()
+
+
+    def snapshot(self):
+        try:
+            write_snapshot(self.snapshot_file, self.registry)
+        except OSError as e:
+            self.logger.error(f"Error writing metrics snapshot: {e}")
+
+
+    def stop(self):
+        self.stopped.set()
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            if isinstance(self.server, UnixHTTPServer):
+                os.unlink(self.server.server_address)
+        # a last snapshot with the final counts
+        if self.snapshot_file:
+            self.snapshot()
@@ -0,0 +1,83 @@
+from collections import OrderedDict
+
+import metrics
+
+
+# Per-source token bucket in front of knock processing.
+#
+# Each source IP gets 'burst' tokens, refilled at 'rate' per second, and
+# every packet it sends to the knock port range costs one. A source that
+# runs out is blocked for block_time seconds: its packets are dropped
+# before the dispatch index, and the capture backend is given the blocklist
+# (see Capture.set_blocklist) so it can drop them in the kernel instead.
+#
+# buckets: OrderedDict { source_ip: [tokens, last_epoch], ... }  least recently seen first
+# blocked: { source_ip: unblock_epoch, ... }
+#
+# The bucket table holds at most max_sources entries, dropping the least
+# recently seen source. A source that comes back starts with a full bucket.
+class RateLimiter:
+    def __init__(self, logger, rate, burst, block_time, max_sources=65536):
+        self.rate = rate
+        self.burst = burst
+        self.block_time = block_time
+        self.max_sources = max_sources
+        self.logger = logger
+        self.buckets = OrderedDict()
+        self.blocked = {}
+        # set when the blocklist changes, until the capture backend has it
+        self.changed = False
+        # seconds for an empty bucket to refill, after which it's the same
+        # as no bucket
+        self.refill_time = burst / rate
+
+
+    def allow(self, source_ip, epoch):
+        if source_ip in self.blocked:
+            metrics.rate_limited.value += 1
+            return False
+
+        b = self.buckets.get(source_ip)
+        if b is None:
+            if len(self.buckets) >= self.max_sources:
+                self.buckets.popitem(last=False)
+            b = self.buckets[source_ip] = [self.burst, epoch]
+        else:
+            self.buckets.move_to_end(source_ip)
+            b[0] = min(self.burst, b[0] + (epoch - b[1]) * self.rate)
+            b[1] = epoch
+
+        if b[0] < 1:
+            self.block(source_ip, epoch)
+            metrics.rate_limited.value += 1
+            return False
+        b[0] -= 1
+        return True
+
+
+    def block(self, source_ip, epoch):
+        self.logger.warning(f"Blocking {source_ip} for {self.block_time}s, " + \
+                            f"over {self.rate}/s knock packet rate limit")
+        self.blocked[source_ip] = epoch + self.block_time
+        del self.buckets[source_ip]
+        self.changed = True
+        metrics.sources_blocked.value += 1
+
+
+    def housekeeping(self, epoch):
+        # Unblock sources whose time is up and drop buckets that have
+        # refilled. Both are in time order, so each loop stops at the first
+        # entry that has to stay.
+        while self.blocked:
+            sip, until = next(iter(self.blocked.items()))
+            if epoch < until:
+                break
+            self.logger.info(f"Unblocking {sip}")
+            del self.blocked[sip]
+            self.changed = True
+
+        while self.buckets:
+            sip, (tokens, last) = next(iter(self.buckets.items()))
+            if epoch - last < self.refill_time:
+                break
+            del self.buckets[sip]
@@ -0,0 +1,139 @@
+import itertools
+import threading
+
+
+# Hashed timing wheel with one second resolution.
+#
+# A timer due at epoch t goes in slot t % len(slots). Advancing the wheel
+# one second only looks at that second's slot, so scheduling, cancelling
+# and running a timer are O(1) however many timers there are. A timer more
+# than a full turn away just stays in its slot until its time comes.
+#
+# slots: [ { seq: (when, fn, args), ... }, ... ]
+class TimerWheel:
+    def __init__(self, now=0, slots=64):
+        self.slots = [{} for _ in range(slots)]
+        self.now = int(now)
+        self.seq = itertools.count()
+
+
+    def schedule(self, when, fn, *args):
+        # Returns a handle for cancel(). A timer can't be due before the
+        # next advance().
+        when = max(int(when), self.now + 1)
+        seq = next(self.seq)
+        self.slots[when % len(self.slots)][seq] = (when, fn, args)
+        return (when, seq)
+
+
+    def cancel(self, handle):
+        when, seq = handle
+        self.slots[when % len(self.slots)].pop(seq, None)
+
+
+    def advance(self, epoch):
+        # Run the timers due at or before epoch. After a gap of more than a
+        # turn, each slot is only visited once.
+        epoch = int(epoch)
+        if epoch <= self.now:
+            return
+        n = len(self.slots)
+        start = max(self.now + 1, epoch - n + 1)
+        # timers scheduled by the callbacks are relative to the new time
+        self.now = epoch
+        for t in range(start, epoch + 1):
+            slot = self.slots[t % n]
+            if not slot:
+                continue
+            due = [seq for seq, (when, fn, args) in slot.items() if when <= epoch]
+            for seq in due:
+                # an earlier callback may have cancelled it
+                timer = slot.pop(seq, None)
+                if timer:
+                    timer[1](*timer[2])
+
+
+# The listener's periodic work, run from one place once per second (tick):
+#   - session expiry (the session store's own timing wheel)
+#   - rate limiter housekeeping, and passing a changed blocklist to the
+#     capture backend
+#   - firewall rule expiry (a heap peek unless a rule is due)
+#   - totp rotation for all clients, only at the start of each 30 second
+#     totp step, from the timing wheel
+#   - halfway through each step, precomputing the next step's knock data
+#     for all clients, in a background thread (inline with background=False,
+#     e.g., for replay), so rotating only swaps in precomputed data
+#   - client config reloads (see clientreload.ClientReloader), if a reloader
+#     is given
+#   - writing the state journal (see statestore.StateStore), if a state store
+#     is given
+#
+# The loops call tick() at least once a second and before dispatching a
+# knock, so a knock is never matched against a stale totp step. Extra calls
+# in the same second return right away.
+class Housekeeper:
+    def __init__(self, kindex, fw, epoch, capture=None, background=True, reloader=None,
+                 state=None):
+        self.kindex = kindex
+        self.fw = fw
+        self.capture = capture
+        self.reloader = reloader
+        self.state = state
+        self.background = background
+        self.precompute_thread = None
+        self.last_tick = int(epoch)
+        self.wheel = TimerWheel(epoch)
+        self.schedule_rotation()
+
+
+    def schedule_rotation(self):
+        now = self.wheel.now
+        step_start = now - now % 30
+        self.wheel.schedule(step_start + 30, self.rotate_totp)
+        if now < step_start + 15:
+            self.wheel.schedule(step_start + 15, self.precompute_totp, step_start // 30 + 1)
+
+
+    def rotate_totp(self):
+        self.kindex.rotate_totp(self.wheel.now)
+        self.schedule_rotation()
+
+
+    def precompute_totp(self, step):
+        clients = list(self.kindex.clients)
+        if not self.background:
+            self.run_precompute(clients, step)
+        elif not (self.precompute_thread and self.precompute_thread.is_alive()):
+            self.precompute_thread = threading.Thread(target=self.run_precompute,
+                                                      args=(clients, step), daemon=True)
+            self.precompute_thread.start()
+
+
+    def run_precompute(self, clients, step):
+        for kt in clients:
+            kt.totp_mgr.precompute(step)
+
+
+    def tick(self, epoch):
+        if epoch <= self.last_tick:
+            return
+        self.last_tick = epoch
+
+        if self.reloader:
+            self.reloader.poll()
+
+        # a second of slop, a knock can take a moment to get processed
+        self.kindex.sessions.remove_expired(epoch - 1)
+
+        limiter = self.kindex.limiter
+        if limiter:
+            limiter.housekeeping(epoch)
+            if limiter.changed and self.capture:
+                limiter.changed = False
+                self.capture.set_blocklist(list(limiter.blocked))
+
+        self.wheel.advance(epoch)
+        self.fw.remove_expired_rules()
+
+        if self.state:
+            self.state.flush()
@@ -0,0 +1,115 @@
+from collections import OrderedDict
+import itertools
+
+import metrics
+import scheduler
+
+
+# In-progress knock sessions for all clients, with a cap on the total number
+# of sessions and on the number per source IP.
+#
+# Without caps, a (spoofed source) flood that hits a current first knock
+# creates a session per source per client until they expire. With them,
+# memory is bounded by max_sessions whatever the traffic.
+#
+# When a cap is hit the oldest session is evicted: the source's oldest for
+# the per-source cap, the oldest overall for the global cap. All sessions
+# last knock_expiration seconds, so oldest is also nearest to expiring.
+#
+# Expiry is driven by a timing wheel, so it doesn't depend on sessions
+# being created in timestamp order.
+#
+# knock_session: { kd: <ptr to Totpmgr.knock_data at start of this session>,
+#                  expiration: epoch,
+#                  knock_cnt: <number of knocks that have matched>,
+#                  kt: <KnockTrack the session belongs to>,
+#                  saddr: source_ip,
+#                  id: <unique session number>,
+#                  timer: <expiry timer handle> }
+#
+# sessions:  OrderedDict { id: knock_session, ... }   oldest first
+# by_source: { source_ip: [ knock_session, ... ], ... }   oldest first
+#
+# Insert, lookup, evict and expire are O(1): per-source lists never hold
+# more than max_per_source sessions.
+#
+# journal, if set, is told about every change (see statestore.StateStore).
+class SessionStore:
+    def __init__(self, max_sessions=65536, max_per_source=16):
+        self.max_sessions = max_sessions
+        self.max_per_source = max_per_source
+        self.sessions = OrderedDict()
+        self.by_source = {}
+        self.ids = itertools.count()
+        self.expiry = scheduler.TimerWheel()
+        self.journal = None
+
+
+    def __len__(self):
+        return len(self.sessions)
+
+
+    def has_source(self, source_ip):
+        return source_ip in self.by_source
+
+
+    def get(self, source_ip):
+        return self.by_source.get(source_ip, ())
+
+
+    def add(self, kt, kd, expiration, source_ip, knock_cnt=1):
+        source_sessions = self.by_source.get(source_ip)
+        if source_sessions is None:
+            source_sessions = self.by_source[source_ip] = []
+        elif len(source_sessions) >= self.max_per_source:
+            metrics.sessions_evicted_per_source.value += 1
+            self.remove(source_sessions[0])
+            # the source's list may have just been deleted
+            source_sessions = self.by_source.setdefault(source_ip, [])
+
+        if len(self.sessions) >= self.max_sessions:
+            metrics.sessions_evicted.value += 1
+            self.remove(next(iter(self.sessions.values())))
+            source_sessions = self.by_source.setdefault(source_ip, [])
+
+        session = dict(kd=kd, expiration=expiration, knock_cnt=knock_cnt, kt=kt,
+                       saddr=source_ip, id=next(self.ids))
+        session['timer'] = self.expiry.schedule(expiration + 1, self.expire, session)
+        self.sessions[session['id']] = session
+        source_sessions.append(session)
+        if self.journal:
+            self.journal.session_added(session)
+        return session
+
+
+    def knocked(self, session):
+        # Another knock in the session's sequence matched
+        session['knock_cnt'] += 1
+        if self.journal:
+            self.journal.session_knocked(session)
+
+
+    def remove(self, session):
+        self.expiry.cancel(session['timer'])
+        del self.sessions[session['id']]
+        source_sessions = self.by_source[session['saddr']]
+        source_sessions.remove(session)
+        if not source_sessions:
+            del self.by_source[session['saddr']]
+        if self.journal:
+            self.journal.session_removed(session)
+
+
+    def expire(self, session):
+        metrics.sessions_expired.value += 1
+        self.remove(session)
+
+
+    def remove_expired(self, epoch):
+        # Remove sessions whose expiration is before epoch
+        self.expiry.advance(epoch)
+
+
+    def remove_client(self, kt):
+        for session in [s for s in self.sessions.values() if s['kt'] is kt]:
+            self.remove(session)
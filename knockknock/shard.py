@@ -0,0 +1,379 @@
+from contextlib import contextmanager
+import multiprocessing
+import multiprocessing.connection
+import os
+import selectors
+import signal
+import socket
+import struct
+import time
+
+import capture
+import clientreload
+import clock
+import firewall
+import log
+import metrics
+import scheduler
+import tcpdump
+
+
+# Sharded listener, for listener.workers > 0
+#
+#   front end ---knocks---> worker 0..N-1 ---rules---> applier
+#
+# The front end (the listener's own process) captures and parses, and sends
+# each knock to the worker for its source IP, so all knocks from a source
+# land on the same worker. Each worker has its own clients, session store,
+# rate limiter and housekeeping, i.e., it's the single process listener for
+# its share of the sources. Completed sequences go to the applier, the one
+# process that runs firewall commands and keeps the rule table.
+#
+# Knocks and rules go over pipes as fixed size records packed with struct,
+# many to a message: the front end sends whatever it has after each read
+# from the capture backend, at most BATCH_KNOCKS knocks at a time, so there
+# is one pipe write per batch rather than per packet, and no pickling.
+#
+# The workers and the applier count knocks, sessions and firewall commands
+# in their own copy of the metrics. Once a second each sends what it has
+# counted since its last send to the front end, over a pipe of its own, and
+# the front end adds that to its metrics, which are the ones exported.
+
+# Source IPs are packed as 16 bytes, IPv4 addresses as IPv4-mapped IPv6
+# addresses (::ffff:a.b.c.d).
+V4_MAPPED = bytes(10) + b'\xff\xff'
+
+# knock: ts, source ip, dest port, length
+KNOCK = struct.Struct('!I16sHH')
+BATCH_KNOCKS = 512
+
+# rule: source ip, port, proto, open duration, client name length; followed
+# by the client name
+RULE = struct.Struct('!16sHBIH')
+PROTOS = [None, 'tcp', 'udp']
+
+
+def pack_addr(ip):
+    if ':' in ip:
+        return socket.inet_pton(socket.AF_INET6, ip)
+    return V4_MAPPED + socket.inet_aton(ip)
+
+
+def unpack_addr(addr):
+    if addr[:12] == V4_MAPPED:
+        return socket.inet_ntoa(addr[12:])
+    return socket.inet_ntop(socket.AF_INET6, addr)
+
+
+def pack_knock(knock):
+    return KNOCK.pack(knock.ts, pack_addr(knock.saddr), knock.dport, knock.len)
+
+
+def unpack_knocks(data):
+    return [capture.KnockEvent(ts, unpack_addr(saddr), dport, msg_len)
+            for ts, saddr, dport, msg_len in KNOCK.iter_unpack(data)]
+
+
+def pack_rule(src_ip, proto, dest_port, id, duration):
+    name = id.encode()
+    return RULE.pack(pack_addr(src_ip), dest_port, PROTOS.index(proto),
+                     int(duration), len(name)) + name
+
+
+def unpack_rules(data):
+    # [ (src_ip, proto, dest_port, id, duration), ... ]
+    rules = []
+    pos = 0
+    while pos < len(data):
+        saddr, port, proto, duration, name_len = RULE.unpack_from(data, pos)
+        pos += RULE.size
+        name = data[pos:pos + name_len].decode()
+        pos += name_len
+        rules.append((unpack_addr(saddr), PROTOS[proto], port, name, duration))
+    return rules
+
+
+# Front end side: collects each worker's knocks until flush()
+class Shards:
+    def __init__(self, conns):
+        self.conns = conns
+        self.batches = [bytearray() for _ in conns]
+        self.limit = BATCH_KNOCKS * KNOCK.size
+
+
+    def send(self, knock):
+        record = pack_knock(knock)
+        # hash() of bytes is keyed per process (PYTHONHASHSEED), so spoofed
+        # sources can't be picked to all land on one worker
+        i = hash(record[4:20]) % len(self.conns)
+        batch = self.batches[i]
+        batch += record
+        if len(batch) >= self.limit:
+            self.conns[i].send_bytes(batch)
+            batch.clear()
+
+
+    def flush(self):
+        for conn, batch in zip(self.conns, self.batches):
+            if batch:
+                conn.send_bytes(batch)
+                batch.clear()
+
+
+    def close(self):
+        for conn in self.conns:
+            conn.close()
+
+
+# Worker side stand-in for firewall.Firewall: rules added in a batch go to
+# the applier as one message when the batch closes. Rule expiry is the
+# applier's job.
+class FirewallProxy:
+    def __init__(self, conn):
+        self.conn = conn
+        self.batch_depth = 0
+        self.pending = bytearray()
+
+
+    @contextmanager
+    def batch(self):
+        self.batch_depth += 1
+        try:
+            yield self
+        finally:
+            self.batch_depth -= 1
+            if self.batch_depth == 0:
+                self.commit()
+
+
+    def commit(self):
+        if self.pending:
+            self.conn.send_bytes(self.pending)
+            self.pending.clear()
+
+
+    def add_new_rule(self, src_ip, proto, dest_port, id, duration):
+        self.pending += pack_rule(src_ip, proto, dest_port, id, duration)
+        if self.batch_depth == 0:
+            self.commit()
+
+
+    def remove_expired_rules(self):
+        pass
+
+
+# Child side: sends the change in the counts since the last send, at most
+# once a second
+class MetricsSender:
+    def __init__(self, conn, registry=metrics.REGISTRY):
+        self.conn = conn
+        self.registry = registry
+        # counted before the fork is the front end's
+        self.sent = registry.totals()
+        self.next_send = 0
+
+
+    def send(self, now, force=False):
+        if now < self.next_send and not force:
+            return
+        self.next_send = now + 1
+        totals = self.registry.totals()
+        if totals != self.sent:
+            delta = [t - s for t, s in zip(totals, self.sent)]
+            self.conn.send_bytes(struct.pack(f'!{len(delta)}d', *delta))
+            self.sent = totals
+
+
+    def close(self):
+        try:
+            self.send(0, force=True)
+        except OSError:
+            # the front end has gone
+            pass
+        self.conn.close()
+
+
+# Front end side: adds the children's counts to its own metrics
+class MetricsCollector:
+    def __init__(self, conns, registry=metrics.REGISTRY):
+        self.conns = list(conns)
+        self.registry = registry
+
+
+    # Returns whether anything was read
+    def poll(self, timeout=0):
+        ready = multiprocessing.connection.wait(self.conns, timeout) if self.conns else []
+        for conn in ready:
+            try:
+                data = conn.recv_bytes()
+            except EOFError:
+                self.conns.remove(conn)
+                conn.close()
+                continue
+            self.registry.add_totals(struct.unpack(f'!{len(data) // 8}d', data))
+        return bool(ready)
+
+
+    # Everything the children sent before exiting
+    def drain(self):
+        while self.poll():
+            pass
+
+
+def close_all(conns, keep=()):
+    for conn in conns:
+        if conn not in keep:
+            conn.close()
+
+
+def run_worker(cfg, logger, setup_clients, knock_conn, rule_conn, metrics_conn):
+    sender = MetricsSender(metrics_conn)
+    fw = FirewallProxy(rule_conn)
+    kindex = setup_clients(cfg, logger, fw)
+    reloader = clientreload.ClientReloader(cfg, logger, kindex, fw, clock.Clock())
+    reloader.install_signal_handler()
+    housekeeper = scheduler.Housekeeper(kindex, fw, time.time(), reloader=reloader)
+
+    try:
+        while True:
+            data = knock_conn.recv_bytes() if knock_conn.poll(1) else None
+            now = int(time.time())
+            housekeeper.tick(now)
+            if data:
+                for knock in unpack_knocks(data):
+                    kindex.dispatch(knock)
+            sender.send(now)
+    except EOFError:
+        # the front end has shut down
+        pass
+    finally:
+        reloader.close()
+        sender.close()
+
+
+def run_applier(cfg, logger, rule_conns, metrics_conn):
+    sender = MetricsSender(metrics_conn)
+    fw = firewall.Firewall(cfg, logger)
+    conns = list(rule_conns)
+    try:
+        # until every worker has gone
+        while conns:
+            for conn in multiprocessing.connection.wait(conns, timeout=1):
+                try:
+                    data = conn.recv_bytes()
+                except EOFError:
+                    conns.remove(conn)
+                    continue
+                with fw.batch():
+                    for rule in unpack_rules(data):
+                        fw.add_new_rule(*rule)
+            fw.remove_expired_rules()
+            sender.send(int(time.time()))
+    finally:
+        logger.info("Attempting to add failopen rules if enabled.")
+        fw.add_failopen_rules()
+        sender.close()
+
+
+def child_main(target, *args):
+    # Ctrl-C goes to the whole process group, but the children shut down
+    # when the front end closes their pipes, so nothing is cut off halfway.
+    # SIGHUP is passed on to the workers by the front end; workers install
+    # their own handler.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    try:
+        target(*args)
+    finally:
+        log.close_queued()
+
+
+# Runs the sharded listener until the front end is interrupted or a child
+# process dies. The children are forked, so they start from the listener's
+# config and logger; each closes the pipe ends that aren't its own, so
+# closing a pipe is seen at the other end.
+def run(cfg, logger, setup_clients):
+    n = cfg.listener.workers
+    ctx = multiprocessing.get_context('fork')
+    knock_pipes = [ctx.Pipe(duplex=False) for _ in range(n)]
+    rule_pipes = [ctx.Pipe(duplex=False) for _ in range(n)]
+    # one for each worker, and the applier's
+    metrics_pipes = [ctx.Pipe(duplex=False) for _ in range(n + 1)]
+    ends = [c for pipe in knock_pipes + rule_pipes + metrics_pipes for c in pipe]
+
+    procs = []
+    for i in range(n):
+        procs.append(ctx.Process(target=worker_main, name=f"knock-worker-{i}",
+                                 args=(cfg, logger, setup_clients, ends, knock_pipes[i][0],
+                                       rule_pipes[i][1], metrics_pipes[i][1])))
+    procs.append(ctx.Process(target=applier_main, name="knock-applier",
+                             args=(cfg, logger, ends, [recv for recv, send in rule_pipes],
+                                   metrics_pipes[n][1])))
+    for p in procs:
+        p.start()
+    metrics_recv = [recv for recv, send in metrics_pipes]
+    close_all(ends, keep=[send for recv, send in knock_pipes] + metrics_recv)
+    logger.info(f"Started {n} knock workers and the firewall applier")
+
+    # SIGHUP reloads client configs in the workers
+    signal.signal(signal.SIGHUP, lambda signum, frame: signal_workers(procs[:-1], signum))
+
+    shards = Shards([send for recv, send in knock_pipes])
+    collector = MetricsCollector(metrics_recv)
+    # capture after forking, so only the front end has the socket/tcpdump
+    td = tcpdump.open_capture(cfg, logger, timeout=1)
+    try:
+        front_end_loop(td, shards, procs, collector)
+    finally:
+        td.close()
+        shards.close()
+        for p in procs:
+            p.join(10)
+        # the final counts, before the exporter's last snapshot
+        collector.drain()
+        close_all(metrics_recv)
+
+
+def worker_main(cfg, logger, setup_clients, ends, knock_conn, rule_conn, metrics_conn):
+    close_all(ends, keep=[knock_conn, rule_conn, metrics_conn])
+    child_main(run_worker, cfg, logger, setup_clients, knock_conn, rule_conn, metrics_conn)
+
+
+def applier_main(cfg, logger, ends, rule_conns, metrics_conn):
+    close_all(ends, keep=rule_conns + [metrics_conn])
+    child_main(run_applier, cfg, logger, rule_conns, metrics_conn)
+
+
+def signal_workers(procs, signum):
+    for p in procs:
+        if p.pid:
+            os.kill(p.pid, signum)
+
+
+def front_end_loop(td, shards, procs, collector):
+    fd = td.async_fd()
+    selector = None
+    if fd is not None:
+        selector = selectors.DefaultSelector()
+        selector.register(fd, selectors.EVENT_READ)
+
+    next_check = 0
+    while True:
+        if selector:
+            # everything that's readable now goes out as one batch per worker
+            items = td.read_available() if selector.select(1) else []
+        else:
+            items = [td.tail()]
+        for item in items:
+            knock = td.match(item)
+            if knock:
+                shards.send(knock)
+        shards.flush()
+
+        now = time.time()
+        if now >= next_check:
+            next_check = now + 1
+            collector.poll()
+            for p in procs:
+                if not p.is_alive():
+                    raise RuntimeError(f"{p.name} exited with code {p.exitcode}")
@@ -0,0 +1,212 @@
+import json
+import os
+
+import firewall
+
+
+# Bump when the snapshot or journal records change
+STATE_FORMAT = 1
+
+# The journal is folded into a new snapshot once it has this many records,
+# or twice as many as there are sessions and rules, whichever is more.
+JOURNAL_MIN = 4096
+
+
+def open_state(cfg, logger):
+    if not cfg.listener.state_dir:
+        return None
+    return StateStore(cfg.listener.state_dir, logger)
+
+
+# Listener state that survives a restart: the in-progress knock sessions
+# and the firewall rule table, each with its expiry deadline.
+#
+# state.snapshot holds the whole state as of the last compaction:
+#   {format: 1,
+#    sessions: [ [id, client, step, ports, saddr, expiration, knock_cnt], ... ],
+#    rules: [ [kind, src_ip, proto, port, id, expire], ... ]}
+# state.journal has one JSON record per line for every change since:
+#   ['s+', id, client, step, ports, saddr, expiration, knock_cnt]   session added
+#   ['s=', id, knock_cnt]                                          session knock
+#   ['s-', id]                                                     session removed
+#   ['r+', kind, src_ip, proto, port, id, expire]                  rule added
+#   ['r-', kind, src_ip, proto, port, id, expire]                  rule removed
+#
+# Records are buffered and appended once per second by the Housekeeper
+# (flush()), so a crash loses at most the last second; a clean shutdown
+# (close()) writes a fresh snapshot. A session is identified by its client
+# name and totp step, and only comes back if the client still has that
+# step's knock sequence.
+class StateStore:
+    def __init__(self, state_dir, logger):
+        self.logger = logger
+        self.snapshot_file = os.path.join(state_dir, 'state.snapshot')
+        self.journal_file = os.path.join(state_dir, 'state.journal')
+        os.makedirs(state_dir, mode=0o700, exist_ok=True)
+        self.pending = []
+        self.journal_records = 0
+        self.snapshot_due = False
+        self.journal = None
+        self.sessions = None
+        self.fw = None
+
+
+    def load(self):
+        # Returns ({ session id: session record, ... }, { rule_key: Rule, ... })
+        sessions, rules = {}, {}
+        try:
+            with open(self.snapshot_file, 'rb') as f:
+                data = json.loads(f.read())
+            if data.get('format') == STATE_FORMAT:
+                for rec in data['sessions']:
+                    if len(rec) != 7:
+                        raise ValueError(f"bad session record {rec}")
+                    sessions[rec[0]] = rec
+                for rec in data['rules']:
+                    rule = firewall.Rule(*rec)
+                    rules[firewall.rule_key(rule)] = rule
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, TypeError, KeyError, AttributeError) as e:
+            self.logger.warning(f"Ignoring state snapshot {self.snapshot_file}: {e}")
+            return {}, {}
+
+        try:
+            with open(self.journal_file, 'rb') as f:
+                lines = f.read().splitlines()
+        except FileNotFoundError:
+            lines = []
+        for line in lines:
+            try:
+                self.replay(json.loads(line), sessions, rules)
+            except (ValueError, TypeError, KeyError, IndexError):
+                # e.g., a line cut short by a crash
+                self.logger.warning(f"Skipping bad state journal record: {line[:80]}")
+        return sessions, rules
+
+
+    def replay(self, rec, sessions, rules):
+        op = rec[0]
+        if op == 's+':
+            if len(rec) != 8:
+                raise ValueError(f"bad session record {rec}")
+            sessions[rec[1]] = rec[1:]
+        elif op == 's=':
+            if rec[1] in sessions:
+                sessions[rec[1]][6] = rec[2]
+        elif op == 's-':
+            sessions.pop(rec[1], None)
+        elif op == 'r+':
+            rule = firewall.Rule(*rec[1:])
+            rules[firewall.rule_key(rule)] = rule
+        elif op == 'r-':
+            rules.pop(firewall.rule_key(firewall.Rule(*rec[1:])), None)
+
+
+    def restore(self, kindex, fw, epoch):
+        # Load the saved state into a newly set up listener, then record its
+        # changes from here on.
+        sessions, rules = self.load()
+
+        clients = {kt.clicfg.name: kt for kt in kindex.clients}
+        restored = 0
+        for id, client, step, ports, saddr, expiration, knock_cnt in sessions.values():
+            kt = clients.get(client)
+            kd = kt.totp_mgr.steps.get(step) if kt else None
+            if expiration < epoch or not kd or kd['ports'] != ports:
+                continue
+            kindex.sessions.add(kt, kd, expiration, saddr, knock_cnt)
+            restored += 1
+
+        # Failopen rules left by the last shutdown aren't needed with the
+        # listener back
+        fw.restore_rules(rules.values())
+        fw.remove_failopen_rules()
+        self.logger.info(f"Restored {restored} knock sessions and " + \
+                         f"{len(fw.rules)} firewall rules")
+
+        self.sessions = kindex.sessions
+        self.fw = fw
+        kindex.sessions.journal = self
+        fw.journal = self
+        self.write_snapshot()
+
+
+    def session_added(self, s):
+        self.pending.append(['s+', s['id'], s['kt'].clicfg.name, s['kd']['step'],
+                             s['kd']['ports'], s['saddr'], s['expiration'], s['knock_cnt']])
+
+
+    def session_knocked(self, s):
+        self.pending.append(['s=', s['id'], s['knock_cnt']])
+
+
+    def session_removed(self, s):
+        self.pending.append(['s-', s['id']])
+
+
+    def rule_added(self, rule):
+        self.pending.append(['r+', *rule])
+
+
+    def rule_removed(self, rule):
+        self.pending.append(['r-', *rule])
+
+
+    def rules_replaced(self):
+        # the firewall's rule table was replaced wholesale (reconcile)
+        self.snapshot_due = True
+
+
+    def flush(self):
+        self.journal_records += len(self.pending)
+        live = len(self.sessions) + len(self.fw.rules)
+        # no journal if the last snapshot couldn't be written
+        if self.journal is None or self.snapshot_due or \
+           self.journal_records > max(JOURNAL_MIN, 2 * live):
+            self.write_snapshot()
+            return
+        if not self.pending:
+            return
+        data = ''.join(json.dumps(rec, separators=(',', ':')) + '\n' for rec in self.pending)
+        self.pending.clear()
+        try:
+            self.journal.write(data)
+            self.journal.flush()
+        except OSError as e:
+            self.logger.error(f"Error writing state journal {self.journal_file}: {e}")
+
+
+    def write_snapshot(self):
+        data = {'format': STATE_FORMAT,
+                'sessions': [[s['id'], s['kt'].clicfg.name, s['kd']['step'], s['kd']['ports'],
+                              s['saddr'], s['expiration'], s['knock_cnt']]
+                             for s in self.sessions.sessions.values()],
+                'rules': [list(r) for r in self.fw.rules.values()]}
+        tmp = self.snapshot_file + '.tmp'
+        try:
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with open(fd, 'wb') as f:
+                f.write(json.dumps(data, separators=(',', ':')).encode())
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.snapshot_file)
+            # The records so far are all in the snapshot. A crash before
+            # this only means they're replayed over it, which is harmless.
+            if self.journal:
+                self.journal.close()
+            self.journal = open(os.open(self.journal_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                                        0o600), 'w')
+        except OSError as e:
+            self.logger.error(f"Error writing state snapshot {self.snapshot_file}: {e}")
+            return
+        self.pending.clear()
+        self.journal_records = 0
+        self.snapshot_due = False
+
+
+    def close(self):
+        if self.journal:
+            self.write_snapshot()
+            self.journal.close()
+            self.journal = None
@@ -1,49 +1,195 @@
-
 import os
 import time
 
+import inotify
 
 
+# Follows a file another process writes to, like tail -F.
+#
+# read() waits on inotify for the file instead of polling it: IN_MODIFY when
+# there's new data, IN_MOVE_SELF / IN_DELETE_SELF when it's rotated away.
+# The file's directory is watched too, for the new file showing up under
+# the name after a rotation; the rest of the old file is read first. Data is
+# read in large chunks and split into lines, a trailing partial line is kept
+# until the rest of it arrives. After a read, eof says whether it got to the
+# end of the file or stopped at max_chunks; in that case the rest is already
+# there and won't come with another inotify event, so read again.
+#
+# A file that gets shorter than the read position has been truncated, and
+# is read again from the start. This is only checked after an IN_MODIFY
+# with nothing new to read.
+#
+# Without inotify (e.g., fs.inotify.max_user_instances reached) it falls
+# back to polling the file every poll_interval seconds.
 class TailLog():
+    file_mask = inotify.IN_MODIFY | inotify.IN_MOVE_SELF | inotify.IN_DELETE_SELF
+    dir_mask = inotify.IN_CREATE | inotify.IN_MOVED_TO
+    chunk_size = 65536
+    # most read per read(), so a busy file can't hold up the caller
+    max_chunks = 16
+    poll_interval = 0.33
+
     def __init__(self, cfg, logger, logfile_name):
         self.logger = logger
         self.cfg = cfg
         self.logfile_name = logfile_name
-        self.generator = self.tail()
+        self.basename = os.path.basename(logfile_name)
         self.total_line_count = 0
         self.current_line_count = 0
+        self.fd = -1
+        self.curr_inode = None
+        self.partial = b''
+        self.rotated = False
+        self.modified = False
+        self.eof = True
+
+        self.inotify = None
+        self.wd = None
+        try:
+            self.inotify = inotify.Inotify()
+            self.dir_wd = self.inotify.add_watch(os.path.dirname(os.path.abspath(logfile_name)),
+                                                 self.dir_mask)
+        except OSError as e:
+            logger.warning(f"Can't watch {logfile_name} with inotify ({e}). Polling it instead.")
+            if self.inotify:
+                self.inotify.close()
+            self.inotify = None
+
+        self._open_file(at_end=True)
+
+
+    def fileno(self):
+        # the fd to wait on for read(), None without inotify
+        return self.inotify.fileno() if self.inotify else None
+
 
     def truncate(self):
+        # the writer has truncated the file
         self.current_line_count = 0
-        self.f.seek(0, os.SEEK_SET)
+        self.partial = b''
+        if self.fd >= 0:
+            os.lseek(self.fd, 0, os.SEEK_SET)
+
 
-    def next(self):
-        return next(self.generator)
-    
-    def _open_file(self):
+    def _open_file(self, at_end=False):
         self.current_line_count = 0
-        f = open(self.logfile_name, "r")
-        f.seek(0, 2)  # seek to end of file
-        self.curr_inode = os.fstat(f.fileno()).st_ino
-        return f
+        self.partial = b''
+        try:
+            self.fd = os.open(self.logfile_name, os.O_RDONLY | os.O_CLOEXEC)
+        except FileNotFoundError:
+            # rotated, and the new file isn't there yet
+            self.fd = -1
+            self.curr_inode = None
+            return
+        if at_end:
+            os.lseek(self.fd, 0, os.SEEK_END)
+        self.curr_inode = os.fstat(self.fd).st_ino
+        if self.inotify:
+            self.wd = self.inotify.add_watch(self.logfile_name, self.file_mask)
+
+
+    def _close_file(self):
+        if self.inotify and self.wd is not None:
+            self.inotify.rm_watch(self.wd)
+            self.wd = None
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
 
     def _test_inode(self):
-        return os.stat(self.logfile_name).st_ino == self.curr_inode
+        try:
+            return os.stat(self.logfile_name).st_ino == self.curr_inode
+        except FileNotFoundError:
+            return self.fd < 0
+
 
-    def tail(self):
-        self.f = self._open_file()
+    def _handle(self, events):
+        for wd, mask, cookie, name in events:
+            if mask & inotify.IN_Q_OVERFLOW:
+                self.rotated = self.rotated or not self._test_inode()
+                self.modified = True
+            elif wd == self.wd:
+                if mask & (inotify.IN_MOVE_SELF | inotify.IN_DELETE_SELF):
+                    self.rotated = True
+                if mask & inotify.IN_MODIFY:
+                    self.modified = True
+            elif wd == self.dir_wd and name == self.basename:
+                self.rotated = True
 
+
+    def _read_fd(self, max_chunks=None):
+        # Reads to the end of the file, or max_chunks
+        max_chunks = max_chunks or self.max_chunks
+        chunks = []
+        self.eof = True
+        while self.fd >= 0:
+            if len(chunks) >= max_chunks:
+                self.eof = False
+                break
+            data = os.read(self.fd, self.chunk_size)
+            if data:
+                chunks.append(data)
+                continue
+            if chunks or not self.modified:
+                break
+            self.modified = False
+            if os.fstat(self.fd).st_size < os.lseek(self.fd, 0, os.SEEK_CUR):
+                self.logger.debug(f"{self.logfile_name} was truncated, reading from the start")
+                self.truncate()
+            else:
+                break
+        if not chunks:
+            return []
+
+        lines = (self.partial + b''.join(chunks)).split(b'\n')
+        self.partial = lines.pop()
+        self.total_line_count += len(lines)
+        self.current_line_count += len(lines)
+        return [l.decode(errors='replace') for l in lines]
+
+
+    def _read_lines(self):
+        if not self.rotated:
+            return self._read_fd()
+        self.rotated = False
+        # an event can be for a file already reopened
+        if self._test_inode():
+            return self._read_fd()
+        # all of the old file, it can't be read later
+        lines = self._read_fd(float('inf'))
+        if self.partial:
+            lines.append(self.partial.decode(errors='replace'))
+        self._close_file()
+        self._open_file()
+        self.modified = False
+        return lines + self._read_fd()
+
+
+    def read(self, timeout=0):
+        # Lines available now, or within timeout seconds (None waits for
+        # ever). Returns [] on timeout.
+        deadline = None if timeout is None else time.monotonic() + timeout
         while True:
-            l = self.f.readline()
-            if l:
-                self.total_line_count += 1
-                self.current_line_count += 1
-                yield l
+            if self.inotify:
+                self._handle(self.inotify.read())
+            else:
+                self.rotated = not self._test_inode()
+                self.modified = True
+            lines = self._read_lines()
+            if lines:
+                return lines
+
+            wait = None if deadline is None else deadline - time.monotonic()
+            if wait is not None and wait <= 0:
+                return []
+            if self.inotify:
+                self._handle(self.inotify.read(wait))
             else:
-                # Check if file has been rotated and we need to open
-                # the new file.
-                if not self._test_inode():
-                    self.f.close()
-                    self.f = self._open_file()
-                else:
-                    yield None
+                time.sleep(self.poll_interval if wait is None else min(self.poll_interval, wait))
+
+
+    def close(self):
+        self._close_file()
+        if self.inotify:
+            self.inotify.close()
@@ -1,34 +1,69 @@
+from collections import deque
 import os
 import re
+import selectors
 import subprocess
-import time
-from dateutil.parser import parse
 
+from capture import KnockEvent
 from knockutil import PORT_START, PORT_END
+import capture
+import metrics
 import taillog
 
 
-class Tcpdump:
-    def __init__(self, cfg, logger, timeout=2):
+def open_capture(cfg, logger, timeout=2):
+    backend = cfg.tcpdump.backend
+    if backend == 'afpacket':
+        return capture.AfPacket(cfg, logger, timeout)
+    elif backend != 'tcpdump':
+        logger.warning(f"Unknown capture backend '{backend}'. Using 'tcpdump'.")
+    return Tcpdump(cfg, logger, timeout)
+
+
+class Tcpdump(capture.Capture):
+    # start=False only sets up match(), e.g., to parse recorded output
+    def __init__(self, cfg, logger, timeout=2, start=True):
         self.cmd = cfg.tcpdump.cmd
+        self.capture = cfg.tcpdump.capture
         self.log_file = cfg.tcpdump.log_file
         self.max_line_count = cfg.tcpdump.truncate_size
         self.timeout = timeout
         self.logger = logger
-        self.tcpdump_args = [f'{self.cmd}', '-i', 'any', '-l', '-n', '--direction=in', '-s', '63',
+        # -tt prints epoch timestamps, which are cheap to parse and, unlike
+        # the default time of day, don't break across midnight.
+        self.tcpdump_args = [f'{self.cmd}', '-i', 'any', '-l', '-n', '-tt', '--direction=in',
+                             '-s', str(capture.SNAPLEN),
                              '--no-promiscuous-mode', 'udp', 'and', 'dst', 'portrange',
                              '{}-{}'.format(PORT_START, PORT_END), 'and', 'not', 'port', 
-                             '53', 'and', 'less', '51']
+                             '53', 'and', '(', '(', 'ip', 'and', 'ip[2:2]', '<=', str(capture.MAX_IP_LEN),
+                             ')', 'or', '(', 'ip6', 'and', 'ip6[4:2]', '<=',
+                             str(capture.MAX_IP6_LEN - capture.IP6_HDR_LEN), ')', ')']
 
         # Sample input:
-        # "00:24:19.604204 eth0  In  IP 108.185.236.147.48367 > 85.90.244.227.56965: UDP, length 16"
-        # groups() => ('00:24:19.604204', '108.185.236.147', '56965', '16')
-        # groups: timestamp, source ip, dest port, length
-        regex_str = r'^([\d:.]+)\s.+\sIn\s+IP\s+(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})\.\d{1,5}[\s>]+' \
-            r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}\.(\d{1,5}):.+UDP.+length\s+(\d+)'
+        # "1729211059.604204 eth0  In  IP 108.185.236.147.48367 > 85.90.244.227.56965: UDP, length 16"
+        # "1729211059.604204 eth0  In  IP6 2001:db8::1.48367 > 2001:db8::2.56965: UDP, length 16"
+        # groups: timestamp (whole seconds), IPv4 source ip, IPv6 source ip,
+        # dest port, length
+        regex_str = r'(\d+)\.\d+ \S+ +In +IP(?: (\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})|6 ([0-9a-fA-F:.]+))' \
+            r'\.\d+ > [0-9a-fA-F:.]+\.(\d+): UDP, length (\d+)'
         self.p = re.compile(regex_str)
-        self.process = self.run_tcpdump(self.log_file)
-        self.taillog = taillog.TailLog(cfg, logger, self.log_file)
+
+        # lines read but not yet returned by tail()
+        self.pending = deque()
+        if not start:
+            self.process = None
+        elif self.capture == 'file':
+            self.process = self.run_tcpdump(self.log_file)
+            self.taillog = taillog.TailLog(cfg, logger, self.log_file)
+        else:
+            if self.capture != 'pipe':
+                logger.warning(f"Unknown tcpdump capture mode '{self.capture}'. Using 'pipe'.")
+                self.capture = 'pipe'
+            self.process = self.run_tcpdump_pipe()
+            # any trailing partial line from the pipe
+            self.partial = b''
+            self.selector = selectors.DefaultSelector()
+            self.selector.register(self.process.stdout, selectors.EVENT_READ)
 
 
     def run_tcpdump(self, output_file_name):
@@ -41,8 +76,69 @@ class Tcpdump:
         return process
 
 
+    def run_tcpdump_pipe(self):
+        self.logger.debug(f"Starting {self.cmd}, reading output from pipe")
+        process = subprocess.Popen(self.tcpdump_args, bufsize=0,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+        return process
+
+
+    def read_chunk(self):
+        # Read whatever tcpdump has written in one go and split it into lines.
+        # The unbuffered fd is read directly (not readline()) so lines never
+        # sit in a Python buffer while select() reports nothing to read.
+        data = os.read(self.process.stdout.fileno(), 65536)
+        if not data:
+            raise RuntimeError(f"{self.cmd} exited with return code {self.process.wait()}")
+        lines = (self.partial + data).split(b'\n')
+        self.partial = lines.pop()
+        self.pending.extend(lines)
+
+
+    def read_pipe(self):
+        timeout = None if self.timeout == 0 else self.timeout
+        while not self.pending:
+            if not self.selector.select(timeout):
+                return None
+            self.read_chunk()
+
+        return self.pending.popleft().decode(errors='replace')
+
+
+    def async_fd(self):
+        if self.capture == 'file':
+            # the inotify fd, if there is one
+            return self.taillog.fileno()
+        fd = self.process.stdout.fileno()
+        os.set_blocking(fd, False)
+        return fd
+
+
+    def read_available(self):
+        if self.capture == 'file':
+            lines = list(self.pending)
+            self.pending.clear()
+            # Up to the end of the file: what's left after a read that
+            # stopped short doesn't make the inotify fd readable again.
+            lines += self.read_file(0)
+            while not self.taillog.eof:
+                lines += self.read_file(0)
+            return lines
+        try:
+            self.read_chunk()
+        except BlockingIOError:
+            pass
+        lines = [l.decode(errors='replace') for l in self.pending]
+        self.pending.clear()
+        return lines
+
+
     def check_truncate(self):
-        if self.taillog.current_line_count < self.max_line_count:
+        # Only once everything tcpdump has written has been read, else the
+        # unread lines would be lost
+        if self.taillog.current_line_count < self.max_line_count or \
+           not self.taillog.eof or self.taillog.partial:
             return
         self.logger.debug(f"Truncate output file ({self.output_file_name}) and resetting read/write position.")
         self.outfile.seek(0, os.SEEK_SET)
@@ -50,33 +146,41 @@ class Tcpdump:
         self.taillog.truncate()
 
 
+    # Parses a line in two stages. Two substring checks drop lines that
+    # can't be knocks (outgoing, not UDP, ...) without running the regex.
+    # The regex is anchored and each part only matches its own field, so it
+    # doesn't backtrack across the line.
     def match(self, log_line):
         if not log_line:
             return None
-        m = self.p.match(log_line)
+        metrics.packets_captured.value += 1
+        m = None
+        if ' In ' in log_line and ' UDP, length ' in log_line:
+            m = self.p.match(log_line)
         if m is None:
-            return m
-        else:
-            self.logger.debug('Groups from line parse: {}'.format(m.groups()))
-            return dict(ts=int(parse(m.group(1)).timestamp()), saddr=m.group(2),
-                        dport=int(m.group(3)), len=int(m.group(4)))
+            metrics.parse_misses.value += 1
+            return None
+        metrics.packets_parsed.value += 1
+        ts, saddr4, saddr6, dport, msg_len = m.groups()
+        # tuple.__new__ skips the namedtuple's own __new__, which is slower
+        return tuple.__new__(KnockEvent, (int(ts), saddr4 or saddr6, int(dport), int(msg_len)))
+
+
+    def read_file(self, timeout):
+        lines = self.taillog.read(timeout)
+        self.check_truncate()
+        return lines
 
 
     def tail(self):
-        sleep_duration = 0.33
-        sleep_countdown = self.timeout
-
-        while True:
-            l = self.taillog.next()
-            if l:
-                return l
-            else:
-                self.check_truncate()
-                if self.timeout == 0:
-                    time.sleep(sleep_duration)
-                else:
-                    if sleep_countdown <= 0:
-                        return None
-                    else:
-                        time.sleep(sleep_duration)
-                        sleep_countdown -= sleep_duration
\ No newline at end of file
+        if self.capture == 'pipe':
+            return self.read_pipe()
+
+        if not self.pending:
+            self.pending.extend(self.read_file(None if self.timeout == 0 else self.timeout))
+        return self.pending.popleft() if self.pending else None
+
+
+    def close(self):
+        if self.capture == 'file' and self.process:
+            self.taillog.close()
@@ -1,58 +1,92 @@
 
+import hmac
+
+import clock as kclock
 import knockutil as kutil
 import pyotp
-import time
-from datetime import datetime
+
+
+TOTP_STEP = 30
+
+
+# Same as pyotp.TOTP(secret).at(step * TOTP_STEP), but with the secret
+# decoded once by the caller rather than on every call, and a one-shot hmac.
+# Setting up the knock data for thousands of clients at startup is mostly
+# this.
+def totp_at(key, step):
+    digest = hmac.digest(key, step.to_bytes(8, 'big'), 'sha1')
+    offset = digest[-1] & 0xf
+    code = int.from_bytes(digest[offset:offset + 4], 'big') & 0x7fffffff
+    return f"{code % 1000000:06d}"
 
 
 class TotpMgr:
 
     # knock_data:
-    #    {'start_epoch': 0, totp': '', 'ports': [0,...], 'lens': [0,...]}
+    #    {'step': 0, 'start_epoch': 0, 'expiration': 0, 'totp': '', 'cnt': 0,
+    #     'ports': [0,...], 'lens': [0,...]}
+    #
+    # A client's clock can be off by up to clicfg.totp_skew totp steps either
+    # way, so the knock data for steps curr-skew..curr+skew is accepted (plus
+    # the previous step for a few seconds, to allow for slow knocks).
+    #
+    # steps: { step: knock_data, ... }   the live steps
+    # precomputed: { step: knock_data, ... }   steps computed ahead of time,
+    #   by precompute(), so rotating doesn't compute anything
 
-    def __init__(self, clicfg, knock_expiration, logger):
+    def __init__(self, clicfg, knock_expiration, logger, clock=None):
         self.logger = logger
+        self.clock = clock or kclock.Clock()
         self.pin = clicfg.pin
         self.port_cnt = clicfg.knock_cnt
-        self.pytotp = pyotp.TOTP(clicfg.secret)
-        self.knock_data = {'start_epoch': 0, 'expiration': 0, 'totp': '', 
-                           'cnt': 0, 'ports': [], 'lens': []}
-        self.old_knock_data = {'start_epoch': 0, 'expiration': 0, 'totp': '', 
-                               'cnt': 0, 'ports': [], 'lens': []}
-        # epoch is time self.totp was set. Use this to determine if it's time
-        # to get a new totp
-        self.totp_epoch = 0
-        self.totp = ''
-        self.curr_epoch = 0
+        self.skew = clicfg.totp_skew
+        self.key = pyotp.TOTP(clicfg.secret).byte_secret()
         self.knock_expiration = knock_expiration
-        self.totp_now()
+        self.steps = {}
+        self.precomputed = {}
+        self.curr_step = None
+        self.knock_data = None
+        self.live = []
         self.rotate_totp()
 
-    def totp_now(self):
-        self.curr_epoch = int(time.time())
-        curr_totp_age = datetime.now().second % 30
-        our_totp_age = self.curr_epoch - self.totp_epoch
+    def mk_knock_data(self, step):
+        totp = totp_at(self.key, step)
+        (ports, lens) = kutil.calc_ports_lengths(totp, self.pin, self.port_cnt, self.logger)
+        return {'step': step,
+                'start_epoch': (step - self.skew) * TOTP_STEP - 1,  # Add 1 second slop
+                'expiration': (step + self.skew) * TOTP_STEP + 35,  # 5-ish extra seconds
+                'totp': totp,
+                'cnt': self.port_cnt,
+                'ports': ports,
+                'lens': lens}
+
+    def precompute(self, step):
+        # Compute the knock data for the steps that go live when 'step'
+        # starts. Only sets dict items, so it's safe to run in another
+        # thread while the listener uses the live steps.
+        for s in range(step - self.skew - 1, step + self.skew + 1):
+            if s not in self.steps and s not in self.precomputed:
+                self.precomputed[s] = self.mk_knock_data(s)
 
-        if our_totp_age > curr_totp_age:
-            new_totp = self.pytotp.now()
-            if new_totp != self.totp:
-                self.totp_epoch = self.curr_epoch
-                self.totp = new_totp
-        
-        return self.totp
+    def live_knock_data(self):
+        # nearest to the current step first
+        return self.live
 
     def rotate_totp(self):
-        self.totp_now()
-
-        if self.totp != self.knock_data['totp']:
-            self.old_knock_data = self.knock_data
-
-            self.logger.debug(f"Setup new totp {self.totp}")
-            (ports, lens) = kutil.calc_ports_lengths(self.totp, self.pin, self.port_cnt, self.logger)
-            self.knock_data = {'start_epoch': self.curr_epoch - 1, # Add 1 second slop
-                               'expiration': self.curr_epoch + 35, # 5-ish extra seconds
-                               'totp': self.totp,
-                               'cnt': self.port_cnt,
-                               'ports': ports,
-                               'lens': lens}
-            self.logger.debug(self.knock_data)
+        # Returns True if a new totp step was set up
+        step = int(self.clock.time()) // TOTP_STEP
+        if step == self.curr_step:
+            return False
+
+        steps = {}
+        for s in range(step - self.skew - 1, step + self.skew + 1):
+            kd = self.steps.get(s) or self.precomputed.pop(s, None)
+            steps[s] = kd or self.mk_knock_data(s)
+        self.steps = steps
+        # list() so a precompute() running meanwhile can't break the loop
+        self.precomputed = {s: kd for s, kd in list(self.precomputed.items()) if s > step}
+        self.curr_step = step
+        self.knock_data = steps[step]
+        self.live = sorted(steps.values(), key=lambda kd: abs(kd['step'] - step))
+        self.logger.debug("Setup new totp %s: %s", self.knock_data['totp'], self.knock_data)
+        return True
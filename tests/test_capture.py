@@ -0,0 +1,232 @@
+import os
+import socket
+import struct
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'knockknock'))
+
+import capture
+from capture import KnockEvent
+from knockutil import PORT_START, PORT_END
+
+
+def udp(sport, dport, payload_len):
+    return struct.pack('!HHHH', sport, dport, payload_len + 8, 0) + bytes(payload_len)
+
+
+def ip4(src, sport, dport, payload_len, frag=0, proto=capture.IPPROTO_UDP):
+    body = udp(sport, dport, payload_len)
+    hdr = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + len(body), 1, frag, 64, proto, 0,
+                      socket.inet_aton(src), socket.inet_aton('192.0.2.1'))
+    return hdr + body
+
+
+def ip6(src, sport, dport, payload_len, nexthdr=capture.IPPROTO_UDP):
+    body = udp(sport, dport, payload_len)
+    hdr = struct.pack('!IHBB16s16s', 6 << 28, len(body), nexthdr, 64,
+                      socket.inet_pton(socket.AF_INET6, src),
+                      socket.inet_pton(socket.AF_INET6, '2001:db8::1'))
+    return hdr + body
+
+
+def ethernet(pkt, proto=capture.ETH_P_IP, vlan=False):
+    hdr = bytes(12)
+    if vlan:
+        hdr += b'\x81\x00\x00\x01'
+    return hdr + struct.pack('!H', proto) + pkt
+
+
+def sll(pkt, proto=capture.ETH_P_IP, pkttype=0):
+    return struct.pack('!HHH8sH', pkttype, 1, 6, bytes(8), proto) + pkt
+
+
+def sll2(pkt, proto=capture.ETH_P_IP, pkttype=0):
+    return struct.pack('!HHIHBB8s', proto, 0, 2, 1, pkttype, 6, bytes(8)) + pkt
+
+
+# Runs a classic BPF program the way the kernel does on a SOCK_DGRAM packet
+# socket: loads are from the start of the IP header, and a load past the
+# end of the packet drops it.
+def run_bpf(instrs, pkt, proto, pkttype=0):
+    ancillary = {capture.SKF_AD_OFF + capture.SKF_AD_PROTOCOL: proto,
+                 capture.SKF_AD_OFF + capture.SKF_AD_PKTTYPE: pkttype}
+    sizes = {capture.BPF_W: 4, capture.BPF_H: 2, capture.BPF_B: 1}
+    a = x = 0
+    pc = 0
+    while True:
+        code, jt, jf, k = instrs[pc]
+        pc += 1
+        cls, size, mode = code & 0x07, code & 0x18, code & 0xe0
+        if k & 0x80000000:
+            k -= 1 << 32
+        if cls == capture.BPF_RET:
+            return k
+        elif cls == capture.BPF_LD and mode == capture.BPF_LEN:
+            a = len(pkt)
+        elif cls == capture.BPF_LD:
+            off = k + (x if mode == capture.BPF_IND else 0)
+            if off in ancillary:
+                a = ancillary[off]
+                continue
+            if off < 0 or off + sizes[size] > len(pkt):
+                return 0
+            a = int.from_bytes(pkt[off:off + sizes[size]], 'big')
+        elif cls == capture.BPF_LDX and mode == capture.BPF_MSH:
+            if k >= len(pkt):
+                return 0
+            x = (pkt[k] & 0x0f) * 4
+        elif cls == capture.BPF_JMP:
+            op = code & 0xf0
+            taken = {capture.BPF_JEQ: a == k, capture.BPF_JGT: a > k,
+                     capture.BPF_JGE: a >= k, capture.BPF_JSET: bool(a & k)}[op]
+            pc += jt if taken else jf
+        else:
+            raise AssertionError(f"unexpected instruction {code:#x}")
+
+
+class DecodePacketTest(unittest.TestCase):
+    def test_ipv4_knock(self):
+        pkt = ip4('198.51.100.7', 40000, PORT_START + 5, 12)
+        self.assertEqual(capture.decode_packet(pkt, 1700000000.7),
+                         KnockEvent(1700000000, '198.51.100.7', PORT_START + 5, 12))
+
+    def test_ipv6_knock(self):
+        pkt = ip6('2001:db8::7', 40000, PORT_END, 3)
+        self.assertEqual(capture.decode_packet(pkt, 1700000000),
+                         KnockEvent(1700000000, '2001:db8::7', PORT_END, 3))
+
+    def test_dns_source_port(self):
+        self.assertIsNone(capture.decode_packet(ip4('198.51.100.7', 53, PORT_START, 12), 0))
+        self.assertIsNone(capture.decode_packet(ip6('2001:db8::7', 53, PORT_START, 12), 0))
+
+    def test_port_out_of_range(self):
+        for dport in (PORT_START - 1, PORT_END + 1, 22):
+            self.assertIsNone(capture.decode_packet(ip4('198.51.100.7', 40000, dport, 12), 0))
+            self.assertIsNone(capture.decode_packet(ip6('2001:db8::7', 40000, dport, 12), 0))
+
+    def test_not_udp(self):
+        self.assertIsNone(capture.decode_packet(ip4('198.51.100.7', 40000, PORT_START, 12, proto=6), 0))
+        self.assertIsNone(capture.decode_packet(ip6('2001:db8::7', 40000, PORT_START, 12, nexthdr=0), 0))
+
+    def test_truncated_header(self):
+        pkt4 = ip4('198.51.100.7', 40000, PORT_START, 12)
+        pkt6 = ip6('2001:db8::7', 40000, PORT_START, 12)
+        for pkt in (pkt4[:10], pkt4[:20], pkt4[:27], pkt6[:40], pkt6[:47]):
+            self.assertIsNone(capture.decode_packet(pkt, 0))
+
+
+class LinkPayloadTest(unittest.TestCase):
+    def test_link_types(self):
+        pkt4 = ip4('198.51.100.7', 40000, PORT_START, 12)
+        pkt6 = ip6('2001:db8::7', 40000, PORT_START, 12)
+        cases = [
+            (capture.LINKTYPE_ETHERNET, ethernet(pkt4), pkt4),
+            (capture.LINKTYPE_ETHERNET, ethernet(pkt4, vlan=True), pkt4),
+            (capture.LINKTYPE_ETHERNET, ethernet(pkt6, capture.ETH_P_IPV6), pkt6),
+            (capture.LINKTYPE_ETHERNET, ethernet(pkt4, 0x0806), None),
+            (capture.LINKTYPE_LINUX_SLL, sll(pkt4), pkt4),
+            (capture.LINKTYPE_LINUX_SLL, sll(pkt6, capture.ETH_P_IPV6), pkt6),
+            (capture.LINKTYPE_LINUX_SLL, sll(pkt4, pkttype=capture.PACKET_OUTGOING), None),
+            (capture.LINKTYPE_LINUX_SLL2, sll2(pkt4), pkt4),
+            (capture.LINKTYPE_LINUX_SLL2, sll2(pkt4, pkttype=capture.PACKET_OUTGOING), None),
+            (capture.LINKTYPE_NULL, struct.pack('<I', 2) + pkt4, pkt4),
+            (capture.LINKTYPE_NULL, struct.pack('>I', 30) + pkt6, pkt6),
+            (capture.LINKTYPE_NULL, struct.pack('<I', 7) + pkt4, None),
+            (capture.LINKTYPE_RAW, pkt6, pkt6),
+        ]
+        for linktype, frame, expected in cases:
+            self.assertEqual(capture.link_payload(linktype, frame), expected)
+
+    def test_decode_frames(self):
+        frame = ethernet(ip4('198.51.100.7', 40000, PORT_START, 12), vlan=True)
+        pkt = capture.link_payload(capture.LINKTYPE_ETHERNET, frame)
+        self.assertEqual(capture.decode_packet(pkt, 5), KnockEvent(5, '198.51.100.7', PORT_START, 12))
+
+
+class BpfProgramTest(unittest.TestCase):
+    blocked = [f'10.0.{i // 256}.{i % 256}' for i in range(capture.MAX_FILTER_BLOCKLIST)] + \
+              ['2001:db8::bad']
+
+    def test_length_and_jumps(self):
+        for blocked in ((), self.blocked):
+            prog = capture.bpf_program(blocked)
+            self.assertLess(len(prog), 256)
+            drop = len(prog) - 1
+            self.assertEqual(prog[drop], (capture.BPF_RET | capture.BPF_K, 0, 0, 0))
+            for i, (code, jt, jf, k) in enumerate(prog):
+                if code & 0x07 != capture.BPF_JMP:
+                    self.assertEqual((jt, jf), (0, 0))
+                    continue
+                for off in (jt, jf):
+                    self.assertTrue(0 <= off <= 255)
+                    self.assertLess(i + 1 + off, len(prog))
+        # only the IPv4 sources are in the filter
+        self.assertEqual(len(capture.bpf_program(self.blocked)), 230)
+
+    def test_filter(self):
+        prog = capture.bpf_program(self.blocked)
+        snaplen = capture.SNAPLEN
+        ip, ipv6 = capture.ETH_P_IP, capture.ETH_P_IPV6
+        cases = [
+            (ip4('198.51.100.7', 40000, PORT_START, 12), ip, snaplen),
+            (ip4('198.51.100.7', 40000, PORT_END, 23), ip, snaplen),
+            (ip6('2001:db8::7', 40000, PORT_START, 23), ipv6, snaplen),
+            # oversized
+            (ip4('198.51.100.7', 40000, PORT_START, 24), ip, 0),
+            (ip6('2001:db8::7', 40000, PORT_START, 24), ipv6, 0),
+            # by the IP header's length, not the captured length: Ethernet
+            # pads short frames
+            (ip4('198.51.100.7', 40000, PORT_START, 23) + bytes(20), ip, snaplen),
+            (ip6('2001:db8::7', 40000, PORT_START, 23) + bytes(20), ipv6, snaplen),
+            # dns, port out of range, not udp
+            (ip4('198.51.100.7', 53, PORT_START, 12), ip, 0),
+            (ip6('2001:db8::7', 53, PORT_START, 12), ipv6, 0),
+            (ip4('198.51.100.7', 40000, PORT_START - 1, 12), ip, 0),
+            (ip4('198.51.100.7', 40000, PORT_END + 1, 12), ip, 0),
+            (ip6('2001:db8::7', 40000, PORT_END + 1, 12), ipv6, 0),
+            (ip4('198.51.100.7', 40000, PORT_START, 12, proto=6), ip, 0),
+            (ip6('2001:db8::7', 40000, PORT_START, 12, nexthdr=0), ipv6, 0),
+            # non-first fragment; the first fragment (more fragments set) passes
+            (ip4('198.51.100.7', 40000, PORT_START, 12, frag=0x0003), ip, 0),
+            (ip4('198.51.100.7', 40000, PORT_START, 12, frag=0x2000), ip, snaplen),
+            # truncated
+            (ip4('198.51.100.7', 40000, PORT_START, 12)[:22], ip, 0),
+            # blocked, first and last in the filter
+            (ip4('10.0.0.0', 40000, PORT_START, 12), ip, 0),
+            (ip4(self.blocked[-2], 40000, PORT_START, 12), ip, 0),
+            # not IP
+            (ip4('198.51.100.7', 40000, PORT_START, 12), 0x0806, 0),
+        ]
+        for pkt, proto, expected in cases:
+            self.assertEqual(run_bpf(prog, pkt, proto), expected)
+        # outgoing
+        pkt = ip4('198.51.100.7', 40000, PORT_START, 12)
+        self.assertEqual(run_bpf(prog, pkt, ip, capture.PACKET_OUTGOING), 0)
+
+
+class AfPacketMatchTest(unittest.TestCase):
+    def setUp(self):
+        # match() doesn't use the socket
+        self.capture = capture.AfPacket.__new__(capture.AfPacket)
+
+    def test_timestamp_from_ancdata(self):
+        pkt = ip4('198.51.100.7', 40000, PORT_START, 12)
+        ancdata = [(socket.SOL_SOCKET, capture.SCM_TIMESTAMPNS, struct.pack('ll', 1700000000, 500000000))]
+        self.assertEqual(self.capture.match((pkt, ancdata)),
+                         KnockEvent(1700000000, '198.51.100.7', PORT_START, 12))
+
+    def test_no_timestamp(self):
+        pkt = ip6('2001:db8::7', 40000, PORT_START, 1)
+        knock = self.capture.match((pkt, []))
+        self.assertEqual(knock.saddr, '2001:db8::7')
+        self.assertGreater(knock.ts, 1700000000)
+
+    def test_not_a_knock(self):
+        ancdata = [(socket.SOL_SOCKET, capture.SCM_TIMESTAMPNS, struct.pack('ll', 1700000000, 0))]
+        self.assertIsNone(self.capture.match((ip4('198.51.100.7', 53, PORT_START, 12), ancdata)))
+        self.assertIsNone(self.capture.match(None))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+import importlib.util
+import logging
+import os
+import sys
+import tempfile
+import tomllib
+import unittest
+
+KNOCKKNOCK = os.path.join(os.path.dirname(__file__), '..', 'knockknock')
+sys.path.insert(0, KNOCKKNOCK)
+
+import config
+
+spec = importlib.util.spec_from_file_location('clientadd', os.path.join(KNOCKKNOCK, 'knock-clientadd.py'))
+clientadd = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(clientadd)
+
+
+class ProvisionTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+
+    def job(self, **row):
+        job = {'filename': 'c1', 'pin': '', 'knock_cnt': 3, 'open_duration': 10,
+               'ports': ['22/tcp'], 'client_dir': self.dir.name, 'svg_dir': None}
+        job.update(row)
+        return job
+
+    def load_client(self, path):
+        cfg = config.Config.__new__(config.Config)
+        cfg.logger = logging.getLogger('test')
+        return cfg._load_client(path)
+
+    def test_quotes_are_escaped(self):
+        result = clientadd.provision(self.job(client_name='a "b" \\ c', pin='12"3',
+                                              ports=['22/TCP', '53', 443]))
+        self.assertEqual(result['status'], 'ok')
+        client = self.load_client(result['config'])
+        self.assertEqual(client.name, 'a "b" \\ c')
+        self.assertEqual(client.pin, '12"3')
+        self.assertEqual(client.ports, [[22, 'tcp'], [53, None], [443, None]])
+        self.assertEqual((client.knock_cnt, client.open_duration), (3, 10))
+
+    def test_csv_strings(self):
+        result = clientadd.provision(self.job(knock_cnt='8', open_duration=' 30 ', pin=1234))
+        self.assertEqual(result['status'], 'ok')
+        with open(result['config'], 'rb') as f:
+            data = tomllib.load(f)
+        self.assertEqual((data['knock_cnt'], data['open_duration'], data['pin']), (8, 30, '1234'))
+
+    def test_bad_rows(self):
+        bad = [
+            {'knock_cnt': 'abc'},
+            {'knock_cnt': 0},
+            {'knock_cnt': 9},
+            {'knock_cnt': True},
+            {'open_duration': '1.5'},
+            {'open_duration': 0},
+            {'ports': []},
+            {'ports': ['ssh']},
+            {'ports': ['22/icmp']},
+            {'ports': ['70000']},
+            {'ports': ['22/tcp"]']},
+            {'pin': 'a\nb'},
+            {'client_name': 'x\x00'},
+            {'client_name': ['x']},
+        ]
+        for row in bad:
+            result = clientadd.provision(self.job(**row))
+            self.assertTrue(result['status'].startswith('error: '), row)
+            self.assertIsNone(result['config'])
+        self.assertEqual(os.listdir(self.dir.name), [])
+
+
+class TomlStrTest(unittest.TestCase):
+    def test_round_trip(self):
+        for s in ['', 'plain', '"', '\\', "it's", 'tab\there', 'del\x7f', 'café \U0001f511']:
+            self.assertEqual(tomllib.loads(f'v = {clientadd.toml_str(s)}')['v'], s)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+import logging
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'knockknock'))
+
+import clientreload
+import clock
+import config
+import firewall
+import knockindex
+import knocktrack
+
+SECRET = 'UBHRQ7SRIQYV7N2JVW6PMRBGHDKSX2O3'
+OTHER_SECRET = 'JBSWY3DPEHPK3PXPJBSWY3DPEHPK3PXP'
+
+
+class ClientDirTest(unittest.TestCase):
+    def setUp(self):
+        self.logger = logging.getLogger('test')
+        self.mtime = 1700000000 * 10**9
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir = os.path.realpath(tmp.name)
+        self.client_dir = os.path.join(self.dir, 'conf.d')
+        os.mkdir(self.client_dir)
+        self.toml_file = os.path.join(self.dir, 'knock.toml')
+        with open(self.toml_file, 'w') as f:
+            f.write(f'[listener]\nclient_cfg = "{self.client_dir}"\nclient_cache = ""\n')
+        self.write('c1', secret=SECRET)
+        self.cfg = config.Config(self.toml_file, self.logger)
+
+    def write(self, name, secret=SECRET, ports='["22/tcp"]', extra=''):
+        path = os.path.join(self.client_dir, name + '.toml')
+        with open(path, 'w') as f:
+            f.write(f'secret = "{secret}"\nports = {ports}\n{extra}')
+        # a new mtime each time, however quick the rewrite
+        self.mtime += 10**9
+        os.utime(path, ns=(self.mtime, self.mtime))
+        return path
+
+    def path(self, name):
+        return os.path.join(self.client_dir, name + '.toml')
+
+
+class ReloadTest(ClientDirTest):
+    def test_nothing_changed(self):
+        self.assertEqual(self.cfg.reload_clients(self.logger), {})
+
+    def test_add_change_remove(self):
+        c1 = self.cfg.clients[0]
+        self.write('c2')
+        changes = self.cfg.reload_clients(self.logger)
+        self.assertEqual(list(changes), [self.path('c2')])
+        old, new = changes[self.path('c2')]
+        self.assertIsNone(old)
+        self.assertEqual(new.name, 'c2')
+        self.assertEqual(len(self.cfg.clients), 2)
+
+        self.write('c1', ports='["22/tcp", 443]')
+        changes = self.cfg.reload_clients(self.logger)
+        self.assertEqual(changes, {self.path('c1'): (c1, c1._replace(ports=[[22, 'tcp'], [443, None]]))})
+
+        os.unlink(self.path('c2'))
+        changes = self.cfg.reload_clients(self.logger)
+        self.assertEqual(list(changes), [self.path('c2')])
+        self.assertIsNone(changes[self.path('c2')][1])
+        self.assertEqual([c.name for c in self.cfg.clients], ['c1'])
+
+    def test_invalid_file(self):
+        c1 = self.cfg.clients[0]
+        self.write('c1', extra='knock_cnt = "abc\n')
+        with self.assertLogs('test', 'ERROR'):
+            changes = self.cfg.reload_clients(self.logger)
+        self.assertEqual(changes, {self.path('c1'): (c1, None)})
+        self.assertEqual(self.cfg.clients, [])
+
+        # fixed again
+        self.write('c1')
+        changes = self.cfg.reload_clients(self.logger)
+        self.assertEqual(changes, {self.path('c1'): (None, c1)})
+
+    def test_paths(self):
+        self.write('c2')
+        self.write('c3')
+        changes = self.cfg.reload_clients(self.logger, {self.path('c3')})
+        self.assertEqual(list(changes), [self.path('c3')])
+        # c2 is found by the next full check
+        self.assertEqual(list(self.cfg.reload_clients(self.logger)), [self.path('c2')])
+
+
+class ClientReloaderTest(ClientDirTest):
+    def setUp(self):
+        super().setUp()
+        self.clock = clock.VirtualClock(30 * 50000 + 10)
+        self.fw = firewall.RecordingFirewall(self.cfg, self.logger, self.clock)
+        self.kindex = knockindex.KnockIndex(self.logger)
+        for c in self.cfg.clients:
+            kt = knocktrack.KnockTrack(self.cfg, c, self.logger, self.fw, self.clock,
+                                       self.kindex.sessions)
+            self.kindex.add_client(kt, self.clock.time())
+        self.reloader = clientreload.ClientReloader(self.cfg, self.logger, self.kindex, self.fw,
+                                                    self.clock)
+        self.addCleanup(self.reloader.close)
+        self.kt = self.kindex.clients[0]
+        self.kindex.sessions.add(self.kt, self.kt.totp_mgr.knock_data, self.clock.time() + 10,
+                                 '198.51.100.7')
+
+    def reload(self):
+        with self.assertLogs('test', 'INFO'):
+            self.reloader.request()
+            self.reloader.poll()
+
+    def test_same_totp_keeps_sessions(self):
+        self.write('c1', ports='[443]')
+        self.reload()
+        self.assertEqual(self.kindex.clients, [self.kt])
+        self.assertEqual(self.kt.clicfg.ports, [[443, None]])
+        self.assertEqual(len(self.kindex.sessions), 1)
+
+    def test_new_secret_replaces_client(self):
+        self.write('c1', secret=OTHER_SECRET)
+        self.reload()
+        self.assertEqual(len(self.kindex.clients), 1)
+        kt = self.kindex.clients[0]
+        self.assertIsNot(kt, self.kt)
+        self.assertEqual(kt.clicfg.secret, OTHER_SECRET)
+        self.assertEqual(len(self.kindex.sessions), 0)
+        # only the new client's knock data is indexed
+        self.assertEqual({e[1] for entries in self.kindex.index.values() for e in entries}, {kt})
+
+    def test_add_and_remove(self):
+        self.write('c2')
+        self.reload()
+        self.assertEqual([kt.clicfg.name for kt in self.kindex.clients], ['c1', 'c2'])
+        os.unlink(self.path('c1'))
+        self.reload()
+        self.assertEqual([kt.clicfg.name for kt in self.kindex.clients], ['c2'])
+        self.assertEqual(len(self.kindex.sessions), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+import json
+import logging
+import os
+import stat
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'knockknock'))
+
+import config
+
+SECRET = 'UBHRQ7SRIQYV7N2JVW6PMRBGHDKSX2O3'
+MTIME = 1700000000 * 10**9
+
+
+# Counts the client files actually parsed
+class CountingConfig(config.Config):
+    loaded = []
+
+    def _load_client(self, f):
+        self.loaded.append(os.path.basename(f))
+        return super()._load_client(f)
+
+
+class ClientCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.logger = logging.getLogger('test')
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir = os.path.realpath(tmp.name)
+        self.client_dir = os.path.join(self.dir, 'conf.d')
+        os.mkdir(self.client_dir)
+        self.cache = os.path.join(self.dir, 'cache', 'clients.cache')
+        self.toml_file = os.path.join(self.dir, 'knock.toml')
+        with open(self.toml_file, 'w') as f:
+            f.write(f'[listener]\nclient_cfg = "{self.client_dir}"\nclient_cache = "{self.cache}"\n')
+        self.write('c1.toml', f'secret = "{SECRET}"\nports = ["22/tcp"]\n')
+        self.write('c2.toml', f'secret = "{SECRET}"\nports = [443]\nknock_cnt = 4\n')
+        self.write('bad.toml', f'secret = "{SECRET}"\nknock_cnt = 20\n')
+
+    def write(self, name, text, mtime=MTIME):
+        path = os.path.join(self.client_dir, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        os.utime(path, ns=(mtime, mtime))
+        return path
+
+    def start(self):
+        CountingConfig.loaded = []
+        cfg = CountingConfig(self.toml_file, self.logger)
+        return cfg, sorted(CountingConfig.loaded), sorted(c.name for c in cfg.clients)
+
+    def test_cache(self):
+        with self.assertLogs('test', 'ERROR'):
+            cfg, loaded, clients = self.start()
+        self.assertEqual(loaded, ['bad.toml', 'c1.toml', 'c2.toml'])
+        self.assertEqual(clients, ['c1', 'c2'])
+        self.assertEqual(stat.S_IMODE(os.stat(self.cache).st_mode), 0o600)
+        with open(self.cache) as f:
+            data = json.load(f)
+        self.assertEqual(data['format'], config.CACHE_FORMAT)
+        # only valid clients are cached
+        path = os.path.join(self.client_dir, 'c2.toml')
+        st = os.stat(path)
+        self.assertEqual(sorted(data['files']), [os.path.join(self.client_dir, f) for f in ('c1.toml', 'c2.toml')])
+        self.assertEqual(data['files'][path][:3], [MTIME, st.st_size, st.st_ino])
+
+        # a restart only parses the file that isn't cached
+        cache_mtime = os.stat(self.cache).st_mtime_ns
+        with self.assertLogs('test', 'ERROR'):
+            cfg2, loaded, clients = self.start()
+        self.assertEqual(loaded, ['bad.toml'])
+        self.assertEqual(cfg2.clients, cfg.clients)
+        # and doesn't rewrite the cache
+        self.assertEqual(os.stat(self.cache).st_mtime_ns, cache_mtime)
+
+    def test_key_changes(self):
+        with self.assertLogs('test', 'ERROR'):
+            self.start()
+        c1 = os.path.join(self.client_dir, 'c1.toml')
+        text = open(c1).read()
+
+        # mtime
+        os.utime(c1, ns=(MTIME, MTIME + 1))
+        with self.assertLogs('test', 'ERROR'):
+            self.assertEqual(self.start()[1], ['bad.toml', 'c1.toml'])
+
+        # size, with the same mtime
+        self.write('c1.toml', text + '\n', mtime=MTIME + 1)
+        with self.assertLogs('test', 'ERROR'):
+            self.assertEqual(self.start()[1], ['bad.toml', 'c1.toml'])
+
+        # inode, a file with the same size and mtime moved into place
+        tmp = self.write('c1.tmp', text + '\n', mtime=MTIME + 1)
+        os.replace(tmp, c1)
+        with self.assertLogs('test', 'ERROR'):
+            self.assertEqual(self.start()[1], ['bad.toml', 'c1.toml'])
+
+        with self.assertLogs('test', 'ERROR'):
+            self.assertEqual(self.start()[1], ['bad.toml'])
+
+    def test_cached_client_is_the_same(self):
+        self.write('c2.toml', f'secret = "{SECRET}"\npin = "1"\nports = [443, "22/udp"]\ntotp_skew = 2\n')
+        with self.assertLogs('test', 'ERROR'):
+            cfg, loaded, clients = self.start()
+        with self.assertLogs('test', 'ERROR'):
+            cfg2, loaded, clients = self.start()
+        self.assertEqual(loaded, ['bad.toml'])
+        self.assertEqual(sorted(cfg2.clients), sorted(cfg.clients))
+        c2 = [c for c in cfg2.clients if c.name == 'c2'][0]
+        self.assertEqual(c2, config.Client(SECRET, '1', 'c2', [[443, None], [22, 'udp']], 3, 10, 2))
+
+    def test_bad_cache_is_ignored(self):
+        os.mkdir(os.path.dirname(self.cache))
+        for text in ('not json', '{"format": 0, "files": {}}', '{"format": 1, "files": {"x": 1}}'):
+            with open(self.cache, 'w') as f:
+                f.write(text)
+            with self.assertLogs('test', 'ERROR'):
+                self.assertEqual(self.start()[1:], (['bad.toml', 'c1.toml', 'c2.toml'], ['c1', 'c2']))
+
+    def test_removed_file(self):
+        with self.assertLogs('test', 'ERROR'):
+            self.start()
+        os.unlink(os.path.join(self.client_dir, 'c1.toml'))
+        with self.assertLogs('test', 'ERROR'):
+            self.assertEqual(self.start()[1:], (['bad.toml'], ['c2']))
+        with open(self.cache) as f:
+            self.assertEqual(list(json.load(f)['files']), [os.path.join(self.client_dir, 'c2.toml')])
+
+
+if __name__ == '__main__':
+    unittest.main()
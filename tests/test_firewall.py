@@ -0,0 +1,297 @@
+import asyncio
+import logging
+import os
+import shlex
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'knockknock'))
+
+import clock
+import config
+import firewall
+
+
+def mk_cfg(**firewall_cfg):
+    cfg = config.Config.__new__(config.Config)
+    cfg.toml_data = {'firewall': firewall_cfg}
+    cfg._process_global_config()
+    cfg.clients = []
+    return cfg
+
+
+# Stands in for iptables: keeps knock's chain as a list of rule specs, and
+# applies an iptables-restore script as one transaction, failing it all if
+# a -D doesn't match a rule.
+class FakeIptables:
+    def __init__(self):
+        self.chain = []
+        self.scripts = []
+
+    def run(self, args, stdin=None):
+        if args[-1] == '--noflush':
+            self.scripts.append(stdin.decode())
+            chain = list(self.chain)
+            for line in stdin.decode().splitlines():
+                op, *spec = shlex.split(line) if line.startswith('-') else [None]
+                if op == '-A':
+                    chain.append(spec)
+                elif op == '-D':
+                    if spec not in chain:
+                        return (1, b'', b'iptables-restore: line 2 failed\n')
+                    chain.remove(spec)
+            self.chain = chain
+            return (0, b'', b'')
+        if '-S' in args:
+            return (0, '\n'.join(shlex.join(['-A'] + spec) for spec in self.chain).encode(), b'')
+        return (0, b'', b'')
+
+
+# FakeIptables for AsyncFirewall. A delete waits until release is set, as if
+# iptables were slow.
+class AsyncFakeIptables(FakeIptables):
+    def __init__(self):
+        super().__init__()
+        self.release = asyncio.Event()
+        self.release.set()
+
+    async def arun(self, args, stdin=None):
+        if stdin and b'\n-D ' in stdin:
+            await self.release.wait()
+        return self.run(args, stdin)
+
+
+class IptablesTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = clock.VirtualClock(1000)
+        self.ipt = FakeIptables()
+        self.fw = firewall.Firewall(mk_cfg(backend='iptables'), logging.getLogger('test'),
+                                    self.ipt, self.clock)
+
+    def test_failed_delete_keeps_adds(self):
+        self.fw.add_new_rule('198.51.100.7', 'tcp', 22, 'c1', 10)
+        self.fw.add_new_rule('198.51.100.8', 'tcp', 22, 'c2', 10)
+        # removed from the firewall by hand
+        self.ipt.chain = [spec for spec in self.ipt.chain if '198.51.100.7' not in spec]
+
+        self.clock.now = 1005
+        with self.assertLogs('test', 'ERROR'):
+            with self.fw.batch():
+                # c1 knocks again, c2 expires
+                self.fw.add_new_rule('198.51.100.7', 'tcp', 22, 'c1', 10)
+                self.fw.delete_rule(('198.51.100.8', 'tcp', 22),
+                                    self.fw.rules[('198.51.100.8', 'tcp', 22)])
+        self.assertEqual([spec[2] for spec in self.ipt.chain], ['198.51.100.8', '198.51.100.7'])
+        self.assertIn('expire:1015', shlex.join(self.ipt.chain[1]))
+
+        # the next reconcile puts c2's rule back in the table, and it expires again
+        self.clock.now = 1020
+        self.fw.next_reconcile = 0
+        self.fw.remove_expired_rules()
+        self.assertEqual(self.ipt.chain, [])
+
+    def test_refresh(self):
+        self.fw.add_new_rule('198.51.100.7', 'tcp', 22, 'c1', 10)
+        self.clock.now = 1005
+        self.fw.add_new_rule('198.51.100.7', 'tcp', 22, 'c1', 10)
+        self.assertEqual(len(self.ipt.chain), 1)
+        self.assertIn('expire:1015', shlex.join(self.ipt.chain[0]))
+
+
+class AsyncFirewallTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.clock = clock.VirtualClock(1000)
+        self.ipt = AsyncFakeIptables()
+        self.fw = firewall.AsyncFirewall(mk_cfg(backend='iptables'), logging.getLogger('test'),
+                                         self.ipt, self.ipt, self.clock)
+        await self.fw.drain()
+        self.fw.add_new_rule('198.51.100.7', 'tcp', 22, 'c1', 10)
+        self.fw.add_new_rule('198.51.100.8', 'tcp', 22, 'c2', 20)
+        await self.fw.drain()
+        self.key = ('198.51.100.7', 'tcp', 22)
+
+    async def test_reconcile_after_delete_in_flight(self):
+        self.ipt.release.clear()
+        self.clock.now = 1011
+        self.fw.remove_expired_rules()
+        self.fw.reconcile()
+        await asyncio.sleep(0.01)
+        self.ipt.release.set()
+        await self.fw.drain()
+        self.assertNotIn(self.key, self.fw.rules)
+        self.assertEqual(len(self.ipt.chain), 1)
+
+    async def test_delete_after_reconcile_queued(self):
+        # the firewall still lists the rule, the table has already dropped it
+        self.fw.reconcile()
+        self.clock.now = 1011
+        self.fw.remove_expired_rules()
+        await self.fw.drain()
+        self.assertEqual(list(self.fw.rules), [('198.51.100.8', 'tcp', 22)])
+        self.assertEqual(len(self.ipt.chain), 1)
+
+    async def test_add_after_reconcile_queued(self):
+        self.ipt.release.clear()
+        self.clock.now = 1005
+        # refreshed: a delete held up, then the reconcile, then another rule
+        self.fw.add_new_rule('198.51.100.7', 'tcp', 22, 'c1', 10)
+        self.fw.reconcile()
+        self.fw.add_new_rule('198.51.100.9', 'tcp', 22, 'c3', 10)
+        self.ipt.release.set()
+        await self.fw.drain()
+        self.assertEqual(self.fw.rules[self.key].expire, 1015)
+        self.assertIn(('198.51.100.9', 'tcp', 22), self.fw.rules)
+        self.assertEqual(len(self.ipt.chain), 3)
+
+
+# The commands each backend produces for a batch, through DryRunRunner
+class BackendCommandsTest(unittest.TestCase):
+    def mk_firewall(self, backend):
+        self.clock = clock.VirtualClock(1000)
+        self.runner = firewall.DryRunRunner(logging.getLogger('test'))
+        fw = firewall.Firewall(mk_cfg(backend=backend), logging.getLogger('test'),
+                               self.runner, self.clock)
+        self.runner.commands.clear()
+        return fw
+
+    def batches(self, fw):
+        # add, refresh and expiry batches, and the commands each ran
+        steps = []
+        with fw.batch():
+            fw.add_new_rule('198.51.100.7', 'tcp', 22, 'c1', 10)
+            fw.add_new_rule('198.51.100.7', None, 443, 'c1', 10)
+        steps.append(self.runner.commands[:])
+        self.runner.commands.clear()
+
+        self.clock.now = 1005
+        fw.add_new_rule('198.51.100.7', 'tcp', 22, 'c1', 10)
+        steps.append(self.runner.commands[:])
+        self.runner.commands.clear()
+
+        self.clock.now = 1016
+        fw.remove_expired_rules()
+        steps.append(self.runner.commands[:])
+        self.runner.commands.clear()
+        return steps
+
+    def test_ufw(self):
+        ufw = '/usr/sbin/ufw'
+        add, refresh, expire = self.batches(self.mk_firewall('ufw'))
+        self.assertEqual(add, [
+            ([ufw, 'allow', 'from', '198.51.100.7', 'proto', 'tcp', 'to', 'any', 'port', '22',
+              'comment', 'knock type:allow id:c1 expire:1010'], None),
+            ([ufw, 'allow', 'from', '198.51.100.7', 'to', 'any', 'port', '443',
+              'comment', 'knock type:allow id:c1 expire:1010'], None),
+        ])
+        self.assertEqual(refresh, [
+            ([ufw, 'delete', 'allow', 'from', '198.51.100.7', 'proto', 'tcp', 'to', 'any',
+              'port', '22'], None),
+            ([ufw, 'allow', 'from', '198.51.100.7', 'proto', 'tcp', 'to', 'any', 'port', '22',
+              'comment', 'knock type:allow id:c1 expire:1015'], None),
+        ])
+        self.assertEqual(expire, [
+            ([ufw, 'delete', 'allow', 'from', '198.51.100.7', 'to', 'any', 'port', '443'], None),
+            ([ufw, 'delete', 'allow', 'from', '198.51.100.7', 'proto', 'tcp', 'to', 'any',
+              'port', '22'], None),
+        ])
+
+    def test_ufw_groups(self):
+        # one group per rule, so the async firewall can run them at once
+        fw = self.mk_firewall('ufw')
+        old = firewall.Rule('allow', '198.51.100.7', 'tcp', 22, 'c1', 1010)
+        new = old._replace(expire=1015)
+        other = old._replace(src_ip='198.51.100.8')
+        groups = fw.backend.command_groups([new, other], [old])
+        self.assertEqual([[args[1] for args, stdin in cmds] for cmds in groups],
+                         [['delete', 'allow'], ['allow']])
+
+    def test_iptables(self):
+        restore = ['/usr/sbin/iptables-restore', '--noflush']
+        rule = '-s 198.51.100.7 -p {0} -m {0} --dport {1} -m comment ' + \
+               '--comment "knock type:allow id:c1 expire:{2}" -j ACCEPT'
+        add, refresh, expire = self.batches(self.mk_firewall('iptables'))
+        self.assertEqual(add, [(restore, (
+            '*filter\n'
+            f'-A knockknock {rule.format("tcp", 22, 1010)}\n'
+            f'-A knockknock {rule.format("tcp", 443, 1010)}\n'
+            f'-A knockknock {rule.format("udp", 443, 1010)}\n'
+            'COMMIT\n').encode())])
+        self.assertEqual(refresh, [
+            (restore, f'*filter\n-A knockknock {rule.format("tcp", 22, 1015)}\nCOMMIT\n'.encode()),
+            (restore, f'*filter\n-D knockknock {rule.format("tcp", 22, 1010)}\nCOMMIT\n'.encode()),
+        ])
+        self.assertEqual(expire, [(restore, (
+            '*filter\n'
+            f'-D knockknock {rule.format("tcp", 443, 1010)}\n'
+            f'-D knockknock {rule.format("udp", 443, 1010)}\n'
+            f'-D knockknock {rule.format("tcp", 22, 1015)}\n'
+            'COMMIT\n').encode())])
+
+    def test_iptables_parse_rules(self):
+        fw = self.mk_firewall('iptables')
+        fw.add_failopen_rules()
+        fw.add_new_rule('198.51.100.7', 'udp', 443, 'my client', 10)
+        script = b''.join(stdin for args, stdin in self.runner.commands)
+        status = b'-N knockknock\n' + b'\n'.join(
+            line.replace(b'-s 198.51.100.7', b'-s 198.51.100.7/32')
+            for line in script.splitlines() if line.startswith(b'-A'))
+        allow, fail = fw.backend.parse_rules(status)
+        self.assertEqual(allow, [firewall.Rule('allow', '198.51.100.7', 'udp', 443, 'my client', 1010)])
+        self.assertEqual(fail, [firewall.Rule('fail', 'anywhere', 'tcp', 22, None, 1060)])
+
+    def test_ipset(self):
+        ipset = ['/usr/sbin/ipset', '-exist', 'restore']
+        iptables = '/usr/sbin/iptables'
+        comment = 'comment "knock type:allow id:c1 expire:{}"'
+        add, refresh, expire = self.batches(self.mk_firewall('ipset'))
+        self.assertEqual(add, [
+            (ipset, (
+                'create knock-443-tcp hash:net family inet timeout 0 comment\n'
+                'create knock-443-udp hash:net family inet timeout 0 comment\n'
+                f'add knock-22-tcp 198.51.100.7 timeout 10 {comment.format(1010)}\n'
+                f'add knock-443-tcp 198.51.100.7 timeout 10 {comment.format(1010)}\n'
+                f'add knock-443-udp 198.51.100.7 timeout 10 {comment.format(1010)}\n').encode()),
+            ([iptables, '-A', 'knockknock', '-p', 'tcp', '-m', 'tcp', '--dport', '443',
+              '-m', 'set', '--match-set', 'knock-443-tcp', 'src', '-j', 'ACCEPT'], None),
+            ([iptables, '-A', 'knockknock', '-p', 'udp', '-m', 'udp', '--dport', '443',
+              '-m', 'set', '--match-set', 'knock-443-udp', 'src', '-j', 'ACCEPT'], None),
+        ])
+        self.assertEqual(refresh, [(ipset, (
+            'del knock-22-tcp 198.51.100.7\n'
+            f'add knock-22-tcp 198.51.100.7 timeout 10 {comment.format(1015)}\n').encode())])
+        # the kernel expires allow entries
+        self.assertEqual(expire, [])
+
+    def test_ipset_failopen(self):
+        fw = self.mk_firewall('ipset')
+        fw.add_failopen_rules()
+        comment = 'comment "knock type:fail expire:1060"'
+        self.assertEqual(self.runner.commands, [(['/usr/sbin/ipset', '-exist', 'restore'], (
+            f'add knock-22-tcp 0.0.0.0/1 timeout 0 {comment}\n'
+            f'add knock-22-tcp 128.0.0.0/1 timeout 0 {comment}\n').encode())])
+        self.runner.commands.clear()
+        fw.remove_failopen_rules()
+        self.assertEqual(self.runner.commands, [(['/usr/sbin/ipset', '-exist', 'restore'],
+            b'del knock-22-tcp 0.0.0.0/1\ndel knock-22-tcp 128.0.0.0/1\n')])
+
+    def test_ipv6_source(self):
+        for backend, commands in (('ufw', 1), ('iptables', 0), ('ipset', 0)):
+            fw = self.mk_firewall(backend)
+            with self.assertNoLogs('test', 'ERROR'):
+                fw.add_new_rule('2001:db8::7', 'tcp', 22, 'c1', 10)
+            self.assertEqual(len(self.runner.commands), commands)
+
+
+class RecordingFirewallTest(unittest.TestCase):
+    def test_history(self):
+        vclock = clock.VirtualClock(1000)
+        fw = firewall.RecordingFirewall(mk_cfg(), logging.getLogger('test'), vclock)
+        fw.add_new_rule('198.51.100.7', 'tcp', 22, 'c1', 10)
+        vclock.advance_to(1011)
+        fw.remove_expired_rules()
+        rule = firewall.Rule('allow', '198.51.100.7', 'tcp', 22, 'c1', 1010)
+        self.assertEqual(fw.history, [(1000, 'add', rule), (1011, 'delete', rule)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+import asyncio
+import os
+import socket
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'knockknock'))
+
+import knockclient
+import knockutil
+
+OTP = '123456'
+
+
+class MultiKnockTest(unittest.TestCase):
+    def listen(self, family, ip, port):
+        sock = socket.socket(family, socket.SOCK_DGRAM)
+        self.addCleanup(sock.close)
+        sock.bind((ip, port))
+        sock.settimeout(1)
+        return sock
+
+    def test_ipv4_and_ipv6(self):
+        ports, lengths = knockutil.calc_ports_lengths(OTP, '', 1)
+        listeners = [self.listen(socket.AF_INET, '127.0.0.1', ports[0]),
+                     self.listen(socket.AF_INET6, '::1', ports[0])]
+        targets = [dict(host=host, pin='', cnt=1, wait=None, otp=OTP, secret=None)
+                   for host in ('127.0.0.1', '::1')]
+        results = asyncio.run(knockclient.MultiKnock(gap=0).run(targets))
+        self.assertEqual([(r['ip'], r['ok'], r['error']) for r in results],
+                         [('127.0.0.1', True, None), ('::1', True, None)])
+        for sock in listeners:
+            self.assertEqual(len(sock.recv(64)), lengths[0])
+
+    def test_lookup_failure(self):
+        targets = [dict(host='host.invalid', pin='', cnt=1, wait=None, otp=OTP, secret=None)]
+        result, = asyncio.run(knockclient.MultiKnock(gap=0).run(targets))
+        self.assertFalse(result['ok'])
+        self.assertTrue(result['error'].startswith("lookup failed"))
+
+
+if __name__ == '__main__':
+    unittest.main()
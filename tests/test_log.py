@@ -0,0 +1,65 @@
+import logging
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'knockknock'))
+
+import log
+
+
+# Records the message and the thread that formatted it
+class Handler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.written = []
+
+    def emit(self, record):
+        self.written.append((self.format(record), threading.current_thread()))
+
+
+class QueuedLogTest(unittest.TestCase):
+    def setUp(self):
+        self.log = log.Log("info", False, queued=True)
+        self.handler = Handler()
+        self.handler.setFormatter(self.log.handler.formatter)
+        # swap in the recording handler behind the queue
+        self.log.listener.stop()
+        self.log.handler = self.handler
+        self.log.start_listener()
+        self.addCleanup(self.log.close)
+
+    def test_formatted_in_listener_thread(self):
+        session = {'knock_cnt': 1}
+        ports = [22]
+        self.log.info("Session %s ports %s %d", session, ports, 3)
+        self.log.info("Session %(knock_cnt)d", session)
+        # changed before the listener gets to the records
+        session['knock_cnt'] = 2
+        ports.append(443)
+        self.log.close()
+        self.assertEqual([msg for msg, thread in self.handler.written],
+                         ["knock-knock: INFO Session {'knock_cnt': 1} ports [22] 3",
+                          "knock-knock: INFO Session 1"])
+        self.assertTrue(all(thread is not threading.current_thread()
+                            for msg, thread in self.handler.written))
+
+    def test_exception(self):
+        try:
+            1 / 0
+        except ZeroDivisionError:
+            self.log.logger.exception("failed")
+        self.log.close()
+        msg, thread = self.handler.written[0]
+        self.assertIn("ZeroDivisionError", msg)
+
+    def test_close_writes_directly(self):
+        self.log.close()
+        self.log.info("after %s", "close")
+        self.assertEqual(self.handler.written,
+                         [("knock-knock: INFO after close", threading.current_thread())])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+import logging
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'knockknock'))
+
+import clock
+from capture import KnockEvent
+import knockindex
+import ratelimit
+
+
+class RateLimiterTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = clock.VirtualClock(1000)
+        self.limiter = ratelimit.RateLimiter(logging.getLogger('test'), rate=2, burst=4,
+                                             block_time=60, max_sources=3)
+
+    def allow(self, source_ip, n=1):
+        return [self.limiter.allow(source_ip, self.clock.time()) for _ in range(n)]
+
+    def test_burst_then_block(self):
+        self.assertEqual(self.allow('198.51.100.7', 4), [True] * 4)
+        with self.assertLogs('test', 'WARNING'):
+            self.assertEqual(self.allow('198.51.100.7'), [False])
+        self.assertEqual(self.limiter.blocked, {'198.51.100.7': 1060})
+        self.assertTrue(self.limiter.changed)
+        # other sources have their own bucket
+        self.assertEqual(self.allow('198.51.100.8', 4), [True] * 4)
+
+    def test_refill(self):
+        self.allow('198.51.100.7', 4)
+        # a token every half second
+        self.clock.now = 1000.5
+        self.assertEqual(self.allow('198.51.100.7'), [True])
+        self.clock.now = 1001.5
+        self.assertEqual(self.allow('198.51.100.7', 2), [True, True])
+        self.assertEqual(self.limiter.blocked, {})
+
+    def test_refill_is_capped_at_burst(self):
+        self.allow('198.51.100.7')
+        self.clock.now = 2000
+        with self.assertLogs('test', 'WARNING'):
+            self.assertEqual(self.allow('198.51.100.7', 5), [True] * 4 + [False])
+
+    def test_unblock(self):
+        with self.assertLogs('test', 'WARNING'):
+            self.allow('198.51.100.7', 5)
+        self.limiter.changed = False
+        self.clock.now = 1059
+        self.limiter.housekeeping(self.clock.time())
+        self.assertEqual(self.allow('198.51.100.7'), [False])
+        self.assertFalse(self.limiter.changed)
+
+        self.clock.now = 1060
+        with self.assertLogs('test', 'INFO'):
+            self.limiter.housekeeping(self.clock.time())
+        self.assertEqual(self.limiter.blocked, {})
+        self.assertTrue(self.limiter.changed)
+        # back with a full bucket
+        self.assertEqual(self.allow('198.51.100.7', 4), [True] * 4)
+
+    def test_housekeeping_drops_refilled_buckets(self):
+        self.allow('198.51.100.7')
+        self.clock.now = 1001
+        self.allow('198.51.100.8')
+        # 198.51.100.7's bucket is full again at 1002
+        self.clock.now = 1002
+        self.limiter.housekeeping(self.clock.time())
+        self.assertEqual(list(self.limiter.buckets), ['198.51.100.8'])
+
+    def test_max_sources(self):
+        for i in range(3):
+            self.allow(f'198.51.100.{i}')
+        # 198.51.100.0 seen again, so .1 is the least recently seen
+        self.allow('198.51.100.0')
+        self.allow('198.51.100.3')
+        self.assertEqual(list(self.limiter.buckets),
+                         ['198.51.100.2', '198.51.100.0', '198.51.100.3'])
+
+
+# Every packet in the knock range goes through the limiter, even those that
+# don't hit the index
+class DispatchTest(unittest.TestCase):
+    def test_blocked_source_is_dropped(self):
+        limiter = ratelimit.RateLimiter(logging.getLogger('test'), rate=1, burst=2, block_time=60)
+        kindex = knockindex.KnockIndex(logging.getLogger('test'), limiter=limiter)
+        hits = []
+        kt = type('KnockTrack', (), {'process_knock': lambda self, knock: hits.append(knock)})()
+        kindex.index[(40000, 12)] = [(0, kt, {})]
+
+        knock = KnockEvent(1000, '198.51.100.7', 40000, 12)
+        miss = knock._replace(len=13)
+        with self.assertLogs('test', 'WARNING'):
+            for k in (miss, knock, knock):
+                kindex.dispatch(k)
+        self.assertEqual(hits, [knock])
+        self.assertIn('198.51.100.7', limiter.blocked)
+
+
+if __name__ == '__main__':
+    unittest.main()
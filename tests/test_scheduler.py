@@ -0,0 +1,170 @@
+import logging
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'knockknock'))
+
+import clock
+import config
+import firewall
+import knockindex
+import knocktrack
+import ratelimit
+import scheduler
+
+
+class TimerWheelTest(unittest.TestCase):
+    def setUp(self):
+        self.wheel = scheduler.TimerWheel(1000, slots=8)
+        self.fired = []
+
+    def fire(self, name):
+        self.fired.append((self.wheel.now, name))
+
+    def test_order_and_cancel(self):
+        self.wheel.schedule(1003, self.fire, 'b')
+        self.wheel.schedule(1002, self.fire, 'a')
+        handle = self.wheel.schedule(1003, self.fire, 'c')
+        self.wheel.cancel(handle)
+        self.wheel.advance(1002)
+        self.assertEqual(self.fired, [(1002, 'a')])
+        self.wheel.advance(1005)
+        self.assertEqual(self.fired, [(1002, 'a'), (1005, 'b')])
+        # cancelling a timer that already ran is harmless
+        self.wheel.cancel(handle)
+
+    def test_past_timer_runs_on_next_advance(self):
+        self.wheel.schedule(990, self.fire, 'late')
+        self.wheel.advance(1000)
+        self.assertEqual(self.fired, [])
+        self.wheel.advance(1001)
+        self.assertEqual(self.fired, [(1001, 'late')])
+
+    def test_more_than_a_turn_away(self):
+        # same slot as 1002, a turn later
+        self.wheel.schedule(1010, self.fire, 'far')
+        self.wheel.advance(1002)
+        self.assertEqual(self.fired, [])
+        self.wheel.advance(1010)
+        self.assertEqual(self.fired, [(1010, 'far')])
+
+    def test_gap_longer_than_a_turn(self):
+        for t in range(1001, 1030, 3):
+            self.wheel.schedule(t, self.fire, t)
+        self.wheel.advance(1100)
+        self.assertEqual(sorted(name for now, name in self.fired), list(range(1001, 1030, 3)))
+
+    def test_callback_reschedules(self):
+        def tick(n):
+            self.fire(n)
+            if n < 3:
+                self.wheel.schedule(self.wheel.now + 1, tick, n + 1)
+        self.wheel.schedule(1001, tick, 1)
+        self.wheel.advance(1010)
+        # timers scheduled by a callback wait for the next advance
+        self.assertEqual(self.fired, [(1010, 1)])
+        self.wheel.advance(1011)
+        self.wheel.advance(1012)
+        self.assertEqual([n for now, n in self.fired], [1, 2, 3])
+
+    def test_callback_cancels(self):
+        handles = []
+        self.wheel.schedule(1001, lambda: self.wheel.cancel(handles[0]))
+        handles.append(self.wheel.schedule(1001, self.fire, 'cancelled'))
+        self.wheel.advance(1001)
+        self.assertEqual(self.fired, [])
+
+
+class Capture:
+    def __init__(self):
+        self.blocklists = []
+
+    def set_blocklist(self, source_ips):
+        self.blocklists.append(source_ips)
+
+
+class HousekeeperTest(unittest.TestCase):
+    def setUp(self):
+        logger = logging.getLogger('test')
+        cfg = config.Config.__new__(config.Config)
+        cfg.toml_data = {}
+        cfg._process_global_config()
+        cfg.clients = []
+        # 10 seconds into a totp step
+        self.clock = clock.VirtualClock(30 * 50000 + 10)
+        self.fw = firewall.RecordingFirewall(cfg, logger, self.clock)
+        self.limiter = ratelimit.RateLimiter(logger, rate=1, burst=1, block_time=5)
+        self.kindex = knockindex.KnockIndex(logger, limiter=self.limiter)
+        clicfg = config.Client('UBHRQ7SRIQYV7N2JVW6PMRBGHDKSX2O3', '', 'c1', [[22, 'tcp']], 3, 10, 0)
+        self.kt = knocktrack.KnockTrack(cfg, clicfg, logger, self.fw, self.clock, self.kindex.sessions)
+        self.kindex.add_client(self.kt, self.clock.time())
+        self.capture = Capture()
+        self.hk = scheduler.Housekeeper(self.kindex, self.fw, self.clock.time(), self.capture,
+                                        background=False)
+
+    def run_to(self, epoch):
+        while self.clock.now < epoch:
+            self.clock.now += 1
+            self.hk.tick(self.clock.now)
+
+    def test_session_expiry(self):
+        start = self.clock.now
+        self.kindex.sessions.add(self.kt, {}, start + 3, '198.51.100.7')
+        # expires after start + 3, with a second of slop
+        self.run_to(start + 4)
+        self.assertEqual(len(self.kindex.sessions), 1)
+        self.run_to(start + 5)
+        self.assertEqual(len(self.kindex.sessions), 0)
+
+    def test_totp_precompute_and_rotation(self):
+        mgr = self.kt.totp_mgr
+        step = mgr.curr_step
+        self.run_to(step * 30 + 14)
+        self.assertEqual(mgr.precomputed, {})
+        self.run_to(step * 30 + 15)
+        self.assertIn(step + 1, mgr.precomputed)
+        self.run_to(step * 30 + 29)
+        self.assertEqual(mgr.curr_step, step)
+        self.run_to(step * 30 + 30)
+        self.assertEqual(mgr.curr_step, step + 1)
+        self.assertEqual(mgr.precomputed, {})
+        # the new step's first knock is in the index
+        kd = mgr.knock_data
+        self.assertTrue(any(e[2] is kd for e in self.kindex.lookup(kd['ports'][0], kd['lens'][0])))
+        # and the next rotation is scheduled
+        self.run_to(step * 30 + 60)
+        self.assertEqual(mgr.curr_step, step + 2)
+
+    def test_blocklist_goes_to_capture(self):
+        with self.assertLogs('test', 'WARNING'):
+            for i in range(2):
+                self.limiter.allow('198.51.100.7', self.clock.now)
+        start = self.clock.now
+        self.run_to(start + 1)
+        self.assertEqual(self.capture.blocklists, [['198.51.100.7']])
+        self.run_to(start + 4)
+        self.assertEqual(len(self.capture.blocklists), 1)
+        with self.assertLogs('test', 'INFO'):
+            self.run_to(start + 5)
+        self.assertEqual(self.capture.blocklists, [['198.51.100.7'], []])
+
+    def test_rule_expiry(self):
+        start = self.clock.now
+        self.fw.add_new_rule('198.51.100.7', 'tcp', 22, 'c1', 2)
+        self.run_to(start + 3)
+        self.assertEqual([op for epoch, op, rule in self.fw.history], ['add', 'delete'])
+        self.assertEqual(self.fw.history[1][0], start + 3)
+
+    def test_once_a_second(self):
+        calls = []
+        self.fw.remove_expired_rules = lambda: calls.append(self.clock.now)
+        self.clock.now += 1
+        for i in range(3):
+            self.hk.tick(self.clock.now)
+        self.hk.tick(self.clock.now - 1)
+        self.assertEqual(len(calls), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'knockknock'))
+
+import metrics
+import sessionstore
+
+
+class SessionStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.store = sessionstore.SessionStore(max_sessions=4, max_per_source=2)
+
+    def sources(self):
+        return [s['saddr'] for s in self.store.sessions.values()]
+
+    def test_add_and_get(self):
+        kt, kd = object(), {}
+        session = self.store.add(kt, kd, 1010, '198.51.100.7')
+        self.assertEqual(len(self.store), 1)
+        self.assertTrue(self.store.has_source('198.51.100.7'))
+        self.assertEqual(self.store.get('198.51.100.7'), [session])
+        self.assertEqual(self.store.get('198.51.100.8'), ())
+        self.assertEqual((session['kt'], session['kd'], session['knock_cnt']), (kt, kd, 1))
+        self.store.knocked(session)
+        self.assertEqual(session['knock_cnt'], 2)
+
+    def test_per_source_cap(self):
+        evicted = metrics.sessions_evicted_per_source.value
+        first = self.store.add(object(), {}, 1010, '198.51.100.7')
+        second = self.store.add(object(), {}, 1011, '198.51.100.7')
+        other = self.store.add(object(), {}, 1011, '198.51.100.8')
+        third = self.store.add(object(), {}, 1012, '198.51.100.7')
+        self.assertEqual(self.store.get('198.51.100.7'), [second, third])
+        self.assertEqual(self.store.get('198.51.100.8'), [other])
+        self.assertNotIn(first['id'], self.store.sessions)
+        self.assertEqual(metrics.sessions_evicted_per_source.value, evicted + 1)
+
+    def test_global_cap(self):
+        evicted = metrics.sessions_evicted.value
+        for i in range(6):
+            self.store.add(object(), {}, 1010 + i, f'198.51.100.{i}')
+        self.assertEqual(len(self.store), 4)
+        self.assertEqual(self.sources(), [f'198.51.100.{i}' for i in range(2, 6)])
+        self.assertFalse(self.store.has_source('198.51.100.0'))
+        self.assertEqual(metrics.sessions_evicted.value, evicted + 2)
+
+    def test_both_caps(self):
+        # the per-source eviction makes room, so nothing else goes
+        for i in range(3):
+            self.store.add(object(), {}, 1010, f'198.51.100.{i}')
+        self.store.add(object(), {}, 1010, '198.51.100.0')
+        self.store.add(object(), {}, 1011, '198.51.100.0')
+        self.assertEqual(len(self.store), 4)
+        self.assertEqual(sorted(self.store.by_source),
+                         ['198.51.100.0', '198.51.100.1', '198.51.100.2'])
+        self.assertEqual(len(self.store.get('198.51.100.0')), 2)
+
+    def test_expiry(self):
+        self.store.add(object(), {}, 1010, '198.51.100.7')
+        # created out of expiration order
+        self.store.add(object(), {}, 1005, '198.51.100.8')
+        self.store.remove_expired(1005)
+        self.assertEqual(len(self.store), 2)
+        self.store.remove_expired(1006)
+        self.assertEqual(self.sources(), ['198.51.100.7'])
+        self.store.remove_expired(1011)
+        self.assertEqual(len(self.store), 0)
+        self.assertEqual(self.store.by_source, {})
+
+    def test_removed_session_doesnt_expire(self):
+        session = self.store.add(object(), {}, 1010, '198.51.100.7')
+        self.store.remove(session)
+        expired = metrics.sessions_expired.value
+        self.store.remove_expired(1011)
+        self.assertEqual(metrics.sessions_expired.value, expired)
+
+    def test_remove_client(self):
+        kt1, kt2 = object(), object()
+        self.store.add(kt1, {}, 1010, '198.51.100.7')
+        kept = self.store.add(kt2, {}, 1010, '198.51.100.7')
+        self.store.add(kt1, {}, 1010, '198.51.100.8')
+        self.store.remove_client(kt1)
+        self.assertEqual(list(self.store.sessions.values()), [kept])
+        self.assertEqual(list(self.store.by_source), ['198.51.100.7'])
+
+
+if __name__ == '__main__':
+    unittest.main()
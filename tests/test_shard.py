@@ -0,0 +1,66 @@
+import multiprocessing
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'knockknock'))
+
+import metrics
+import shard
+
+
+def mk_registry():
+    registry = metrics.Registry()
+    registry.counter('knocks_total', "Knocks.")
+    registry.gauge('sessions', "Sessions.")
+    registry.histogram('seconds', "Seconds.", (0.1, 1))
+    return registry
+
+
+class MetricsTest(unittest.TestCase):
+    def setUp(self):
+        self.front_end = mk_registry()
+        self.children = [mk_registry(), mk_registry()]
+        pipes = [multiprocessing.Pipe(duplex=False) for _ in self.children]
+        # counted before the fork
+        self.children[0].metrics[0].inc(5)
+        self.senders = [shard.MetricsSender(send, registry)
+                        for (recv, send), registry in zip(pipes, self.children)]
+        self.collector = shard.MetricsCollector([recv for recv, send in pipes], self.front_end)
+
+    def test_counts_added(self):
+        self.front_end.metrics[0].inc(1)
+        for registry in self.children:
+            registry.metrics[0].inc(2)
+            registry.metrics[1].set(7)
+            registry.metrics[2].observe(0.5)
+        for sender in self.senders:
+            sender.send(100)
+        self.collector.drain()
+        self.assertEqual(self.front_end.metrics[0].value, 5)
+        # gauges are the front end's own
+        self.assertEqual(self.front_end.metrics[1].value, 0)
+        self.assertEqual(self.front_end.metrics[2].counts, [0, 2, 0])
+        self.assertEqual(self.front_end.metrics[2].sum, 1.0)
+        self.assertIn('knocks_total 5\n', self.front_end.render())
+
+        # only what's new, and at most once a second
+        self.children[0].metrics[0].inc(3)
+        self.senders[0].send(100)
+        self.assertFalse(self.collector.poll())
+        self.senders[0].send(101)
+        self.collector.drain()
+        self.assertEqual(self.front_end.metrics[0].value, 8)
+
+    def test_final_counts(self):
+        self.senders[1].send(100)
+        self.children[1].metrics[0].inc(4)
+        for sender in self.senders:
+            sender.close()
+        self.collector.drain()
+        self.assertEqual(self.front_end.metrics[0].value, 4)
+        self.assertEqual(self.collector.conns, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
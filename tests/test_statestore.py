@@ -0,0 +1,176 @@
+import json
+import logging
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'knockknock'))
+
+import clock
+import config
+import firewall
+import knockindex
+import knocktrack
+import statestore
+
+SECRET = 'UBHRQ7SRIQYV7N2JVW6PMRBGHDKSX2O3'
+START = 30 * 50000 + 10
+
+
+class StateStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.logger = logging.getLogger('test')
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.state_dir = os.path.join(tmp.name, 'state')
+        self.cfg = config.Config.__new__(config.Config)
+        self.cfg.toml_data = {'listener': {'state_dir': self.state_dir}}
+        self.cfg._process_global_config()
+        self.cfg.clients = [config.Client(SECRET, '', 'c1', [[22, 'tcp']], 3, 10, 0)]
+        self.clock = clock.VirtualClock(START)
+        self.start()
+
+    def start(self):
+        # a listener (re)starting on the same state_dir
+        self.fw = firewall.RecordingFirewall(self.cfg, self.logger, self.clock)
+        self.kindex = knockindex.KnockIndex(self.logger)
+        for c in self.cfg.clients:
+            self.kindex.add_client(knocktrack.KnockTrack(self.cfg, c, self.logger, self.fw, self.clock,
+                                                         self.kindex.sessions), self.clock.time())
+        self.kt = self.kindex.clients[0]
+        self.state = statestore.open_state(self.cfg, self.logger)
+        with self.assertLogs('test', 'INFO') as logs:
+            self.state.restore(self.kindex, self.fw, int(self.clock.time()))
+        self.warnings = [r for r in logs.records if r.levelno >= logging.WARNING]
+
+    def add_session(self, saddr, expiration=START + 10):
+        return self.kindex.sessions.add(self.kt, self.kt.totp_mgr.knock_data, expiration, saddr)
+
+    def sessions(self):
+        return sorted((s['saddr'], s['knock_cnt'], s['expiration'])
+                      for s in self.kindex.sessions.sessions.values())
+
+    def journal(self):
+        with open(self.state.journal_file) as f:
+            return [json.loads(line) for line in f]
+
+    def test_journal_replayed_after_crash(self):
+        kept = self.add_session('198.51.100.7')
+        self.kindex.sessions.knocked(kept)
+        gone = self.add_session('198.51.100.8')
+        self.kindex.sessions.remove(gone)
+        self.fw.add_new_rule('198.51.100.9', 'tcp', 22, 'c1', 10)
+        self.state.flush()
+        self.assertEqual([rec[0] for rec in self.journal()], ['s+', 's=', 's+', 's-', 'r+'])
+
+        # no close()
+        self.start()
+        self.assertEqual(self.sessions(), [('198.51.100.7', 2, START + 10)])
+        self.assertEqual(list(self.fw.rules.values()),
+                         [firewall.Rule('allow', '198.51.100.9', 'tcp', 22, 'c1', START + 10)])
+        # the restored sessions are in a fresh snapshot
+        self.assertEqual(self.journal(), [])
+
+    def test_close_writes_snapshot(self):
+        self.add_session('198.51.100.7')
+        self.state.close()
+        with open(self.state.snapshot_file) as f:
+            data = json.load(f)
+        self.assertEqual(data['format'], statestore.STATE_FORMAT)
+        self.assertEqual([s[4] for s in data['sessions']], ['198.51.100.7'])
+        self.assertEqual(self.journal(), [])
+        self.assertEqual(os.stat(self.state.snapshot_file).st_mode & 0o777, 0o600)
+
+    def test_stale_sessions_not_restored(self):
+        self.add_session('198.51.100.7', expiration=START + 5)
+        self.add_session('198.51.100.8', expiration=START + 20)
+        self.state.flush()
+        self.clock.now = START + 10
+        self.start()
+        self.assertEqual([s[0] for s in self.sessions()], ['198.51.100.8'])
+
+        # the totp step is gone by the time the listener is back
+        self.state.flush()
+        self.clock.now = START + 120
+        self.start()
+        self.assertEqual(self.sessions(), [])
+
+    def test_removed_client(self):
+        self.add_session('198.51.100.7')
+        self.state.close()
+        self.cfg.clients = [self.cfg.clients[0]._replace(name='c2')]
+        self.start()
+        self.assertEqual(self.sessions(), [])
+
+    def test_failopen_rules_removed(self):
+        self.fw.add_failopen_rules()
+        self.fw.add_new_rule('198.51.100.9', 'tcp', 22, 'c1', 10)
+        self.state.flush()
+        self.start()
+        self.assertEqual([r.kind for r in self.fw.rules.values()], ['allow'])
+        self.assertEqual([(op, r.kind) for epoch, op, r in self.fw.history], [('delete', 'fail')])
+
+    def test_expired_rules_removed(self):
+        self.fw.add_new_rule('198.51.100.9', 'tcp', 22, 'c1', 10)
+        self.state.close()
+        self.clock.now = START + 20
+        self.start()
+        self.fw.remove_expired_rules()
+        self.assertEqual(self.fw.rules, {})
+        self.assertEqual([op for epoch, op, r in self.fw.history], ['delete'])
+
+    def test_bad_journal_record(self):
+        self.add_session('198.51.100.7')
+        self.add_session('198.51.100.8')
+        self.state.flush()
+        # cut short by a crash
+        with open(self.state.journal_file, 'r+') as f:
+            f.truncate(os.path.getsize(self.state.journal_file) - 5)
+        self.start()
+        self.assertEqual(len(self.warnings), 1)
+        self.assertEqual([s[0] for s in self.sessions()], ['198.51.100.7'])
+
+    def test_bad_snapshot(self):
+        with open(self.state.snapshot_file, 'w') as f:
+            f.write('{"format": 1, "sessions": [[1]], "rules": []}')
+        self.start()
+        self.assertEqual(len(self.warnings), 1)
+        self.assertEqual(self.sessions(), [])
+
+    def test_bad_journal_session(self):
+        with open(self.state.journal_file, 'w') as f:
+            f.write('["s+", 1]\n["r+", "allow", "198.51.100.9", "tcp", 22, "c1", %d]\n' % (START + 10))
+        self.start()
+        self.assertEqual(len(self.warnings), 1)
+        self.assertEqual(self.sessions(), [])
+        self.assertEqual(len(self.fw.rules), 1)
+
+    def test_compaction(self):
+        min_records = statestore.JOURNAL_MIN
+        statestore.JOURNAL_MIN = 4
+        self.addCleanup(setattr, statestore, 'JOURNAL_MIN', min_records)
+        session = self.add_session('198.51.100.7')
+        self.kindex.sessions.knocked(session)
+        self.state.flush()
+        self.assertEqual(len(self.journal()), 2)
+        # more than twice the number of live sessions and rules
+        self.add_session('198.51.100.8')
+        for i in range(3):
+            self.kindex.sessions.knocked(session)
+        self.state.flush()
+        # folded into the snapshot
+        self.assertEqual(self.journal(), [])
+        with open(self.state.snapshot_file) as f:
+            self.assertEqual(len(json.load(f)['sessions']), 2)
+
+    def test_reconcile_writes_snapshot(self):
+        self.add_session('198.51.100.7')
+        self.state.flush()
+        self.fw.update_rule_table([], [])
+        self.state.flush()
+        self.assertEqual(self.journal(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+import logging
+import os
+import sys
+import unittest
+
+import pyotp
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'knockknock'))
+
+import clock
+import config
+import knocktrack
+import knockutil
+import totpmgr
+
+SECRET = 'UBHRQ7SRIQYV7N2JVW6PMRBGHDKSX2O3'
+STEP = 50000
+
+
+def mk_client(skew):
+    return config.Client(SECRET, '1234', 'c1', [[22, 'tcp']], 3, 10, skew)
+
+
+class TotpMgrTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = clock.VirtualClock(STEP * 30 + 10)
+
+    def mk_mgr(self, skew):
+        return totpmgr.TotpMgr(mk_client(skew), 10, logging.getLogger('test'), self.clock)
+
+    def test_totp_at(self):
+        totp = pyotp.TOTP(SECRET)
+        for step in (0, 1, STEP, 2**26):
+            self.assertEqual(totpmgr.totp_at(totp.byte_secret(), step), totp.at(step * 30))
+
+    def test_knock_data(self):
+        kd = self.mk_mgr(0).knock_data
+        totp = pyotp.TOTP(SECRET).at(STEP * 30)
+        self.assertEqual((kd['step'], kd['totp'], kd['cnt']), (STEP, totp, 3))
+        self.assertEqual((kd['ports'], kd['lens']), knockutil.calc_ports_lengths(totp, '1234', 3))
+        self.assertEqual((kd['start_epoch'], kd['expiration']), (STEP * 30 - 1, STEP * 30 + 35))
+
+    def test_no_skew(self):
+        # the current step, and the previous one for slow knocks
+        mgr = self.mk_mgr(0)
+        self.assertEqual([kd['step'] for kd in mgr.live_knock_data()], [STEP, STEP - 1])
+
+    def test_skew_window(self):
+        mgr = self.mk_mgr(2)
+        self.assertEqual([kd['step'] for kd in mgr.live_knock_data()],
+                         [STEP, STEP - 1, STEP + 1, STEP - 2, STEP + 2, STEP - 3])
+        # a step's knock data is accepted skew steps either side of it
+        kd = mgr.steps[STEP + 2]
+        self.assertEqual((kd['start_epoch'], kd['expiration']), (STEP * 30 - 1, (STEP + 4) * 30 + 35))
+        now = self.clock.time()
+        live = [kd['step'] for kd in mgr.live_knock_data() if kd['start_epoch'] <= now <= kd['expiration']]
+        self.assertEqual(sorted(live), list(range(STEP - 2, STEP + 3)))
+
+    def test_rotation(self):
+        mgr = self.mk_mgr(1)
+        self.assertFalse(mgr.rotate_totp())
+        kept = mgr.steps[STEP + 1]
+        self.clock.now = (STEP + 1) * 30
+        self.assertTrue(mgr.rotate_totp())
+        self.assertEqual(sorted(mgr.steps), [STEP - 1, STEP, STEP + 1, STEP + 2])
+        self.assertIs(mgr.knock_data, kept)
+
+    def test_precompute(self):
+        mgr = self.mk_mgr(1)
+        mgr.precompute(STEP + 1)
+        # only the step not already live
+        self.assertEqual(list(mgr.precomputed), [STEP + 2])
+        kd = mgr.precomputed[STEP + 2]
+        self.clock.now = (STEP + 1) * 30
+        mgr.rotate_totp()
+        self.assertIs(mgr.steps[STEP + 2], kd)
+        self.assertEqual(mgr.precomputed, {})
+
+
+class KnockTrackSkewTest(unittest.TestCase):
+    # A client whose clock is two steps ahead
+    def test_first_knock(self):
+        vclock = clock.VirtualClock(STEP * 30 + 10)
+        cfg = config.Config.__new__(config.Config)
+        cfg.toml_data = {}
+        cfg._process_global_config()
+        ahead = totpmgr.TotpMgr(mk_client(0), 10, logging.getLogger('test'),
+                                clock.VirtualClock((STEP + 2) * 30)).knock_data
+        now = vclock.time()
+        for skew, expected in ((1, False), (2, True)):
+            kt = knocktrack.KnockTrack(cfg, mk_client(skew), logging.getLogger('test'), None, vclock)
+            kd = kt.test_first_knock(now, ahead['ports'][0], ahead['lens'][0])
+            self.assertEqual(kd is not None and kd['step'] == STEP + 2, expected)
+
+
+if __name__ == '__main__':
+    unittest.main()